@@ -0,0 +1,285 @@
+"""
+Benchmark suite for pyBaf2Sql that runs against synthetic datasets and the synthetic Baf2Sql library from
+synthetic_baf2sql.py, so it does not need the vendor library or vendor data.
+
+For each run size, the suite measures:
+    - BafData open time, with lazily loaded and with preloaded metadata tables.
+    - Per-spectrum extraction throughput in raw, centroid, profile, and centroid from profile modes, and in profile
+      mode binned per spectrum and onto shared run-level bin edges.
+    - Metadata lookup cost through the Spectra index, the Variables table, and BafSpectrum.
+    - Peak traced memory of opening a dataset and iterating over all spectra.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --output results.json
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --compare results.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyBaf2Sql
+from pyBaf2Sql.baf import extract_baf_spectrum
+from pyBaf2Sql.classes import BafData, BafSpectrum
+from synthetic_baf2sql import SyntheticBaf2Sql, make_synthetic_dataset
+
+
+EXTRACTION_CASES = (('raw', 'raw', 0, False),
+                    ('centroid', 'centroid', 0, False),
+                    ('profile', 'profile', 0, False),
+                    ('profile_binned', 'profile', 1000, False),
+                    ('profile_run_bins', 'profile', 1000, True),
+                    ('centroid_from_profile', 'centroid_from_profile', 0, False))
+
+
+def time_call(func, repeat):
+    """
+    Time a function call.
+
+    :param func: Function to call without arguments.
+    :type func: collections.abc.Callable
+    :param repeat: Number of times to call the function.
+    :type repeat: int
+    :return: Median wall clock time in seconds.
+    :rtype: float
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_open(bruker_d_folder_name, baf2sql, repeat):
+    """
+    Measure the time to open a dataset.
+
+    :param bruker_d_folder_name: Path to the synthetic .d directory.
+    :type bruker_d_folder_name: str
+    :param baf2sql: Synthetic Baf2Sql library.
+    :type baf2sql: synthetic_baf2sql.SyntheticBaf2Sql
+    :param repeat: Number of repetitions.
+    :type repeat: int
+    :return: Dictionary of open times in seconds.
+    :rtype: dict
+    """
+    def open_lazy():
+        BafData(bruker_d_folder_name, baf2sql).close()
+
+    def open_preloaded():
+        BafData(bruker_d_folder_name, baf2sql, preload_tables=None).close()
+
+    return {'open_lazy_s': time_call(open_lazy, repeat),
+            'open_preloaded_s': time_call(open_preloaded, repeat)}
+
+
+def bench_extraction(baf_data, frames, repeat):
+    """
+    Measure per-spectrum extraction throughput with pyBaf2Sql.baf.extract_baf_spectrum().
+
+    :param baf_data: Opened synthetic dataset.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param frames: IDs of the frames to extract.
+    :type frames: numpy.array
+    :param repeat: Number of repetitions.
+    :type repeat: int
+    :return: Dictionary of throughputs in spectra per second.
+    :rtype: dict
+    """
+    results = {}
+    for name, mode, profile_bins, run_bins in EXTRACTION_CASES:
+        bin_edges = baf_data.get_run_bin_edges(profile_bins) if run_bins else None
+
+        def extract():
+            for frame in frames:
+                extract_baf_spectrum(baf_data, int(frame), mode, profile_bins, bin_edges=bin_edges)
+
+        results['extract_' + name + '_spectra_per_s'] = frames.size / time_call(extract, repeat)
+
+    def iterate():
+        for _ in baf_data.iter_spectra(mode='centroid', frames=frames, copy=False):
+            pass
+
+    results['iter_spectra_centroid_spectra_per_s'] = frames.size / time_call(iterate, repeat)
+    return results
+
+
+def bench_lookup(baf_data, frames, repeat):
+    """
+    Measure the cost of metadata lookups for random frames.
+
+    :param baf_data: Opened synthetic dataset.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param frames: IDs of the frames to look up.
+    :type frames: numpy.array
+    :param repeat: Number of repetitions.
+    :type repeat: int
+    :return: Dictionary of lookup costs in microseconds per lookup.
+    :rtype: dict
+    """
+    baf_data.build_indexes()
+    msms_frames = baf_data.select(ms_level=2)
+    msms_frames = msms_frames[np.isin(msms_frames, frames)] if msms_frames.size != 0 else msms_frames
+
+    def spectra_index():
+        for frame in frames:
+            baf_data.spectra_index[int(frame)]
+
+    def get_variable():
+        for frame in msms_frames:
+            baf_data.get_variable(int(frame), 7)
+
+    def baf_spectrum():
+        for frame in frames:
+            BafSpectrum(baf_data, int(frame), 'centroid')
+
+    return {'lookup_spectra_index_us': time_call(spectra_index, repeat) / max(frames.size, 1) * 1e6,
+            'lookup_get_variable_us': time_call(get_variable, repeat) / max(msms_frames.size, 1) * 1e6,
+            'lookup_baf_spectrum_us': time_call(baf_spectrum, repeat) / max(frames.size, 1) * 1e6,
+            'lookup_spectrum_metadata_us': time_call(lambda: baf_data.get_spectrum_metadata(mode=None),
+                                                     repeat) / baf_data.get_frames().size * 1e6}
+
+
+def bench_memory(bruker_d_folder_name, baf2sql):
+    """
+    Measure the peak memory traced by tracemalloc while opening a dataset with all metadata tables and iterating over
+    all spectra in centroid and profile modes.
+
+    :param bruker_d_folder_name: Path to the synthetic .d directory.
+    :type bruker_d_folder_name: str
+    :param baf2sql: Synthetic Baf2Sql library.
+    :type baf2sql: synthetic_baf2sql.SyntheticBaf2Sql
+    :return: Dictionary of peak memory in MiB.
+    :rtype: dict
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with BafData(bruker_d_folder_name, baf2sql, preload_tables=None) as baf_data:
+            baf_data.build_indexes()
+            open_peak = tracemalloc.get_traced_memory()[1]
+            for mode in ('centroid', 'profile'):
+                for _ in baf_data.iter_spectra(mode=mode, copy=False):
+                    pass
+        iter_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'peak_memory_open_mib': open_peak / 2 ** 20,
+            'peak_memory_iter_mib': iter_peak / 2 ** 20}
+
+
+def run_size(num_spectra, args, work_dir):
+    """
+    Run all benchmarks for one run size.
+
+    :param num_spectra: Number of spectra in the synthetic dataset.
+    :type num_spectra: int
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :param work_dir: Directory in which to create the synthetic dataset.
+    :type work_dir: str
+    :return: Dictionary of results.
+    :rtype: dict
+    """
+    bruker_d_folder_name = os.path.join(work_dir, 'synthetic_' + str(num_spectra) + '.d')
+    make_synthetic_dataset(bruker_d_folder_name, num_spectra=num_spectra, profile_points=args.profile_points,
+                           centroid_points=args.centroid_points, seed=args.seed)
+    baf2sql = SyntheticBaf2Sql()
+    results = {'num_spectra': num_spectra}
+    results.update(bench_open(bruker_d_folder_name, baf2sql, args.repeat))
+    with BafData(bruker_d_folder_name, baf2sql) as baf_data:
+        frames = baf_data.get_frames()
+        rng = np.random.default_rng(args.seed)
+        sample = rng.choice(frames, size=min(args.sample, frames.size), replace=False)
+        results.update(bench_extraction(baf_data, sample, args.repeat))
+        results.update(bench_lookup(baf_data, sample, args.repeat))
+    results.update(bench_memory(bruker_d_folder_name, baf2sql))
+    shutil.rmtree(bruker_d_folder_name, ignore_errors=True)
+    return results
+
+
+def print_results(results, baseline=None):
+    """
+    Print benchmark results as a table, with the ratio to a baseline run of the same size if provided.
+
+    :param results: List of result dictionaries from run_size().
+    :type results: list[dict]
+    :param baseline: List of result dictionaries from a previous run.
+    :type baseline: list[dict] | None
+    """
+    baseline = {i['num_spectra']: i for i in baseline} if baseline is not None else {}
+    for result in results:
+        print('num_spectra = ' + str(result['num_spectra']))
+        previous = baseline.get(result['num_spectra'], {})
+        for key, value in result.items():
+            if key == 'num_spectra':
+                continue
+            line = '    {:<40}{:>16.4f}'.format(key, value)
+            if previous.get(key):
+                line += '    x{:.3f} vs baseline'.format(value / previous[key])
+            print(line)
+
+
+def get_args():
+    """
+    Parse command line arguments.
+
+    :return: Parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Benchmark pyBaf2Sql against synthetic BAF datasets.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='Numbers of spectra in the synthetic runs.')
+    parser.add_argument('--profile_points', type=int, default=2000, help='Number of points per profile spectrum.')
+    parser.add_argument('--centroid_points', type=int, default=200, help='Average number of peaks per centroid '
+                                                                         'spectrum.')
+    parser.add_argument('--sample', type=int, default=1000, help='Number of random spectra to extract and look up.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions; the median time is reported.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--work_dir', type=str, default=None, help='Directory for the synthetic datasets, defaults '
+                                                                   'to a temporary directory.')
+    parser.add_argument('--output', type=str, default=None, help='Path of a JSON file to write the results to.')
+    parser.add_argument('--compare', type=str, default=None, help='Path of a JSON file from a previous run to '
+                                                                  'compare the results to.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='pyBaf2Sql_benchmarks_')
+    try:
+        results = [run_size(num_spectra, args, work_dir) for num_spectra in args.sizes]
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as compare_file:
+            baseline = json.load(compare_file)['results']
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'pyBaf2Sql': getattr(pyBaf2Sql, '__version__', None),
+                       'results': results},
+                      output_file,
+                      indent=4)
+
+
+if __name__ == '__main__':
+    main()
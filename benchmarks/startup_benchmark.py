@@ -0,0 +1,176 @@
+"""
+Cold start benchmark for pyBaf2Sql that measures the latency of short-lived processes, e.g. command line tools or
+serverless functions that look up one spectrum or one property, against a synthetic dataset and the synthetic Baf2Sql
+library from synthetic_baf2sql.py.
+
+Every case is run in a fresh Python interpreter, so module imports are not cached between repetitions. For each case,
+the suite reports the time measured inside the interpreter from before the first pyBaf2Sql import to the end of the
+case, and the wall clock time of the whole process including interpreter startup:
+    - python: Interpreter startup without pyBaf2Sql.
+    - import_package: import pyBaf2Sql.
+    - import_bafdata: from pyBaf2Sql import BafData.
+    - property / property_reuse_sqlite: Open a dataset and look up one property from the Properties table, letting
+      Baf2Sql check analysis.sqlite or reusing the existing analysis.sqlite.
+    - spectrum / spectrum_reuse_sqlite: Open a dataset and extract one centroid spectrum.
+
+Usage:
+    python benchmarks/startup_benchmark.py --output startup.json
+    python benchmarks/startup_benchmark.py --compare startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from synthetic_baf2sql import make_synthetic_dataset
+
+
+CASE_PREAMBLE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path[:0] = [{package_dir!r}, {benchmarks_dir!r}]
+"""
+CASE_EPILOGUE = """
+print(json.dumps(time.perf_counter() - start))
+"""
+OPEN_CASE = """
+from pyBaf2Sql import BafData
+from synthetic_baf2sql import SyntheticBaf2Sql
+baf_data = BafData({bruker_d_folder_name!r}, SyntheticBaf2Sql(), reuse_sqlite_cache={reuse_sqlite_cache!r})
+"""
+STARTUP_CASES = {'python': None,
+                 'import_package': 'import pyBaf2Sql',
+                 'import_bafdata': 'from pyBaf2Sql import BafData',
+                 'property': OPEN_CASE + "baf_data.analysis['Properties'].get('InstrumentName')",
+                 'property_reuse_sqlite': OPEN_CASE + "baf_data.analysis['Properties'].get('InstrumentName')",
+                 'spectrum': OPEN_CASE + "from pyBaf2Sql import extract_baf_spectrum\n"
+                                         "extract_baf_spectrum(baf_data, 1, 'centroid')",
+                 'spectrum_reuse_sqlite': OPEN_CASE + "from pyBaf2Sql import extract_baf_spectrum\n"
+                                                      "extract_baf_spectrum(baf_data, 1, 'centroid')"}
+
+
+def get_case_source(name, bruker_d_folder_name):
+    """
+    Get the source code of a benchmark case to run in a fresh interpreter.
+
+    :param name: Name of the case in STARTUP_CASES.
+    :type name: str
+    :param bruker_d_folder_name: Path to the synthetic .d directory.
+    :type bruker_d_folder_name: str
+    :return: Source code that prints the time spent in the case as JSON.
+    :rtype: str
+    """
+    if STARTUP_CASES[name] is None:
+        return 'pass'
+    source = CASE_PREAMBLE + STARTUP_CASES[name] + '\n' + CASE_EPILOGUE
+    return source.format(package_dir=os.path.dirname(BENCHMARKS_DIR),
+                         benchmarks_dir=BENCHMARKS_DIR,
+                         bruker_d_folder_name=bruker_d_folder_name,
+                         reuse_sqlite_cache=name.endswith('_reuse_sqlite'))
+
+
+def run_case(name, bruker_d_folder_name, repeat):
+    """
+    Run a benchmark case in fresh interpreters.
+
+    :param name: Name of the case in STARTUP_CASES.
+    :type name: str
+    :param bruker_d_folder_name: Path to the synthetic .d directory.
+    :type bruker_d_folder_name: str
+    :param repeat: Number of repetitions.
+    :type repeat: int
+    :return: Dictionary of the median in-process and process wall clock times in seconds.
+    :rtype: dict
+    """
+    source = get_case_source(name, bruker_d_folder_name)
+    in_process_times = []
+    process_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', source], check=True, capture_output=True, text=True).stdout
+        process_times.append(time.perf_counter() - start)
+        if output.strip():
+            in_process_times.append(json.loads(output.strip().splitlines()[-1]))
+    results = {name + '_process': statistics.median(process_times)}
+    if in_process_times:
+        results[name] = statistics.median(in_process_times)
+    return results
+
+
+def print_results(results, baseline=None):
+    """
+    Print benchmark results as a table, with the ratio to a baseline run if provided.
+
+    :param results: Dictionary of results from run_case().
+    :type results: dict
+    :param baseline: Dictionary of results from a previous run.
+    :type baseline: dict | None
+    """
+    baseline = baseline if baseline is not None else {}
+    for key, value in results.items():
+        line = '    {:<40}{:>16.4f}'.format(key, value)
+        if baseline.get(key):
+            line += '    x{:.3f} vs baseline'.format(value / baseline[key])
+        print(line)
+
+
+def get_args():
+    """
+    Parse command line arguments.
+
+    :return: Parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the cold start latency of pyBaf2Sql.')
+    parser.add_argument('--num_spectra', type=int, default=1000, help='Number of spectra in the synthetic run.')
+    parser.add_argument('--cases', type=str, nargs='+', default=list(STARTUP_CASES.keys()),
+                        choices=list(STARTUP_CASES.keys()), help='Cases to run.')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of repetitions; the median time is reported.')
+    parser.add_argument('--work_dir', type=str, default=None, help='Directory for the synthetic dataset, defaults '
+                                                                   'to a temporary directory.')
+    parser.add_argument('--output', type=str, default=None, help='Path of a JSON file to write the results to.')
+    parser.add_argument('--compare', type=str, default=None, help='Path of a JSON file from a previous run to '
+                                                                  'compare the results to.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='pyBaf2Sql_benchmarks_')
+    bruker_d_folder_name = os.path.join(work_dir, 'synthetic_startup.d')
+    results = {}
+    try:
+        make_synthetic_dataset(bruker_d_folder_name, num_spectra=args.num_spectra)
+        for name in args.cases:
+            results.update(run_case(name, bruker_d_folder_name, args.repeat))
+    finally:
+        shutil.rmtree(bruker_d_folder_name, ignore_errors=True)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as compare_file:
+            baseline = json.load(compare_file)['results']
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'num_spectra': args.num_spectra,
+                       'results': results},
+                      output_file,
+                      indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Synthetic stand-in for the Baf2Sql library and generator for synthetic Bruker .d datasets used by the benchmark suite.
+
+The synthetic library mimics the baf2sql_array_* and baf2sql_get_* functions of the ctypes interface returned by
+pyBaf2Sql.init_baf2sql.init_baf2sql_api(), so pyBaf2Sql can be benchmarked on machines without the vendor library or
+vendor data. Arrays are stored in analysis.baf as a single flat float64 file with a sidecar index of array offsets
+and lengths, which is memory-mapped when a dataset is opened.
+"""
+
+import os
+import sqlite3
+import numpy as np
+
+
+ARRAY_INDEX_FILE_NAME = 'analysis.baf.index.npy'
+
+
+class SyntheticFunction(object):
+    """
+    Callable standing in for a ctypes function pointer, including the argtypes and restype attributes.
+
+    :param func: Function to call.
+    :type func: collections.abc.Callable
+    """
+    def __init__(self, func):
+        """
+        Constructor Method
+        """
+        self.func = func
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+
+class SyntheticBaf2Sql(object):
+    """
+    Synthetic replacement for the library returned by pyBaf2Sql.init_baf2sql.init_baf2sql_api() that reads datasets
+    written by make_synthetic_dataset().
+
+    :param num_threads: Number of threads reported to baf2sql_set_num_threads, unused.
+    :type num_threads: int
+    """
+    def __init__(self, num_threads=1):
+        """
+        Constructor Method
+        """
+        self._name = 'synthetic'
+        self.num_threads = num_threads
+        self.storages = {}
+        self.next_handle = 1
+        self.last_error = b''
+        for name in ('array_open_storage', 'array_close_storage', 'array_get_num_elements', 'array_read_double',
+                     'array_read_float', 'array_read_uint32', 'get_last_error_string', 'get_sqlite_cache_filename',
+                     'get_sqlite_cache_filename_v2', 'set_num_threads'):
+            setattr(self, 'baf2sql_' + name, SyntheticFunction(getattr(self, '_' + name)))
+
+    def _array_open_storage(self, raw_calibration, baf_file_name):
+        baf_file_name = os.fsdecode(baf_file_name)
+        index_file_name = os.path.join(os.path.dirname(baf_file_name), ARRAY_INDEX_FILE_NAME)
+        if not os.path.exists(baf_file_name) or not os.path.exists(index_file_name):
+            self.last_error = b'Unable to open ' + os.fsencode(baf_file_name)
+            return 0
+        handle = self.next_handle
+        self.next_handle += 1
+        self.storages[handle] = (np.memmap(baf_file_name, dtype=np.float64, mode='r'), np.load(index_file_name))
+        return handle
+
+    def _array_close_storage(self, handle):
+        self.storages.pop(handle, None)
+
+    def _get_array(self, handle, identity):
+        storage = self.storages.get(int(handle))
+        if storage is None:
+            self.last_error = b'Invalid handle'
+            return None
+        data, index = storage
+        identity = int(identity)
+        if identity < 1 or identity > index.shape[0]:
+            self.last_error = b'Invalid array ID ' + str(identity).encode('utf-8')
+            return None
+        offset, length = index[identity - 1]
+        return data[offset:offset + length]
+
+    def _array_get_num_elements(self, handle, identity, num_elements):
+        array = self._get_array(handle, identity)
+        if array is None:
+            return 0
+        num_elements.value = array.size
+        return 1
+
+    def _read(self, handle, identity, pointer, dtype):
+        array = self._get_array(handle, identity)
+        if array is None:
+            return 0
+        np.ctypeslib.as_array(pointer, shape=(array.size,))[:] = array.astype(dtype, copy=False)
+        return 1
+
+    def _array_read_double(self, handle, identity, pointer):
+        return self._read(handle, identity, pointer, np.float64)
+
+    def _array_read_float(self, handle, identity, pointer):
+        return self._read(handle, identity, pointer, np.float32)
+
+    def _array_read_uint32(self, handle, identity, pointer):
+        return self._read(handle, identity, pointer, np.uint32)
+
+    def _get_last_error_string(self, buf, length):
+        if buf is not None and length > 0:
+            buf.value = self.last_error[:length - 1]
+        return len(self.last_error) + 1
+
+    def _get_sqlite_cache_filename(self, buf, length, baf_file_name):
+        return self._get_sqlite_cache_filename_v2(buf, length, baf_file_name, 0)
+
+    def _get_sqlite_cache_filename_v2(self, buf, length, baf_file_name, all_variables):
+        sqlite_file_name = os.path.join(os.path.dirname(os.fsdecode(baf_file_name)), 'analysis.sqlite')
+        if not os.path.exists(sqlite_file_name):
+            self.last_error = b'Unable to find ' + os.fsencode(sqlite_file_name)
+            return 0
+        sqlite_file_name = os.fsencode(sqlite_file_name)
+        if buf is not None and length > 0:
+            buf.value = sqlite_file_name[:length - 1]
+        return len(sqlite_file_name) + 1
+
+    def _set_num_threads(self, num_threads):
+        self.num_threads = num_threads
+
+
+def make_synthetic_dataset(bruker_d_folder_name, num_spectra=1000, profile_points=2000, centroid_points=200,
+                           mz_range=(100.0, 1000.0), msms_per_cycle=3, seed=0):
+    """
+    Write a synthetic Bruker .d directory with an analysis.sqlite database following the Baf2Sql schema and an
+    analysis.baf array store readable by SyntheticBaf2Sql. Spectra alternate between one MS1 spectrum and
+    msms_per_cycle Auto MS/MS spectra with precursor steps and variables.
+
+    :param bruker_d_folder_name: Path to the .d directory to create.
+    :type bruker_d_folder_name: str
+    :param num_spectra: Number of spectra.
+    :type num_spectra: int
+    :param profile_points: Number of points in each profile spectrum.
+    :type profile_points: int
+    :param centroid_points: Average number of peaks in each centroid spectrum.
+    :type centroid_points: int
+    :param mz_range: Lower and upper m/z of the acquisition range.
+    :type mz_range: tuple[float]
+    :param msms_per_cycle: Number of MS/MS spectra acquired after each MS1 spectrum.
+    :type msms_per_cycle: int
+    :param seed: Seed of the random number generator.
+    :type seed: int
+    :return: Path to the .d directory.
+    :rtype: str
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(bruker_d_folder_name, exist_ok=True)
+    sqlite_file_name = os.path.join(bruker_d_folder_name, 'analysis.sqlite')
+    if os.path.exists(sqlite_file_name):
+        os.remove(sqlite_file_name)
+
+    profile_mz = np.linspace(mz_range[0], mz_range[1], profile_points)
+    spectra_rows = []
+    steps_rows = []
+    variables_rows = []
+    index = np.zeros((num_spectra * 4, 2), dtype=np.int64)
+    offset = 0
+    array_id = 0
+    parent = None
+    with open(os.path.join(bruker_d_folder_name, 'analysis.baf'), 'wb') as baf_file:
+        for frame in range(1, num_spectra + 1):
+            is_msms = (frame - 1) % (msms_per_cycle + 1) != 0
+            if not is_msms:
+                parent = frame
+            profile_intensity = rng.exponential(10.0, profile_points)
+            num_peaks = int(rng.integers(centroid_points // 2, centroid_points * 3 // 2 + 1))
+            centroid_mz = np.sort(rng.uniform(mz_range[0], mz_range[1], num_peaks))
+            centroid_intensity = rng.exponential(1000.0, num_peaks)
+            array_ids = []
+            for array in (profile_mz, profile_intensity, centroid_mz, centroid_intensity):
+                array = np.ascontiguousarray(array, dtype=np.float64)
+                index[array_id] = (offset, array.size)
+                baf_file.write(array.tobytes())
+                offset += array.size
+                array_id += 1
+                array_ids.append(array_id)
+            spectra_rows.append((frame, frame * 0.5, 1, 2 if is_msms else 1, parent if is_msms else None,
+                                 mz_range[0], mz_range[1], float(centroid_intensity.sum()),
+                                 float(centroid_intensity.max()), 0, array_ids[0], array_ids[1], None, array_ids[2],
+                                 array_ids[3], None, None, None))
+            variables_rows.extend([(frame, 1, 1.5), (frame, 2, 3.0)])
+            if is_msms:
+                precursor_mz = float(rng.uniform(mz_range[0] + 100, mz_range[1] - 100))
+                steps_rows.append((frame, 1, 0, 0, 2, precursor_mz))
+                variables_rows.extend([(frame, 5, 25.0), (frame, 6, 2.0), (frame, 7, precursor_mz),
+                                       (frame, 8, 2.0)])
+    np.save(os.path.join(bruker_d_folder_name, ARRAY_INDEX_FILE_NAME), index[:array_id])
+
+    conn = sqlite3.connect(sqlite_file_name)
+    try:
+        conn.execute('CREATE TABLE Spectra (Id INTEGER PRIMARY KEY, Rt REAL, Segment INTEGER, AcquisitionKey INTEGER, '
+                     'Parent INTEGER, MzAcqRangeLower REAL, MzAcqRangeUpper REAL, SumIntensity REAL, '
+                     'MaxIntensity REAL, TransformatorId INTEGER, ProfileMzId INTEGER, ProfileIntensityId INTEGER, '
+                     'LineIndexId INTEGER, LineMzId INTEGER, LineIntensityId INTEGER, LineIndexWidthId INTEGER, '
+                     'LinePeakAreaId INTEGER, LineSnrId INTEGER)')
+        conn.execute('CREATE TABLE AcquisitionKeys (Id INTEGER PRIMARY KEY, Polarity INTEGER, ScanMode INTEGER, '
+                     'AcquisitionMode INTEGER, MsLevel INTEGER)')
+        conn.execute('CREATE TABLE Steps (TargetSpectrum INTEGER, Number INTEGER, IsolationType INTEGER, '
+                     'ReactionType INTEGER, MsLevel INTEGER, Mass REAL)')
+        conn.execute('CREATE TABLE Variables (Spectrum INTEGER, Variable INTEGER, Value REAL)')
+        conn.execute('CREATE TABLE SupportedVariables (Variable INTEGER, PermanentName TEXT, Type INTEGER, '
+                     'DisplayGroupName TEXT, DisplayName TEXT, DisplayValueText TEXT, DisplayFormat TEXT, '
+                     'DisplayDimension TEXT)')
+        conn.execute('CREATE TABLE Properties (Key TEXT PRIMARY KEY, Value TEXT)')
+        conn.executemany('INSERT INTO AcquisitionKeys VALUES (?, ?, ?, ?, ?)', [(1, 0, 0, 0, 0), (2, 0, 2, 0, 1)])
+        conn.executemany('INSERT INTO SupportedVariables (Variable, PermanentName) VALUES (?, ?)',
+                         [(1, 'Synthetic_Variable_1'), (2, 'Synthetic_Variable_2'), (5, 'Collision_Energy_Act'),
+                          (6, 'MSMS_PreCursorChargeState'), (7, 'MSMS_IsolationMass_Act'),
+                          (8, 'Quadrupole_IsolationResolution_Act')])
+        conn.executemany('INSERT INTO Properties VALUES (?, ?)',
+                         [('InstrumentName', 'synthetic'), ('AcquisitionSoftware', 'pyBaf2Sql benchmarks')])
+        conn.executemany('INSERT INTO Spectra VALUES (' + ', '.join(['?'] * 18) + ')', spectra_rows)
+        conn.executemany('INSERT INTO Steps VALUES (?, ?, ?, ?, ?, ?)', steps_rows)
+        conn.executemany('INSERT INTO Variables VALUES (?, ?, ?)', variables_rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return bruker_d_folder_name
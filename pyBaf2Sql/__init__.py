@@ -1,12 +1,82 @@
-import os
-import platform
-import sqlite3
-from ctypes import c_uint64, POINTER, c_double, c_float, c_uint32, create_string_buffer
-import numpy as np
-import pandas as pd
-
-from pyBaf2Sql.init_baf2sql import *
-from pyBaf2Sql.classes import *
-from pyBaf2Sql.baf import *
-from pyBaf2Sql.error import *
-from pyBaf2Sql.util import *
\ No newline at end of file
+import importlib
+
+
+# Public names of each submodule. Submodules are only imported the first time one of their names is accessed from
+# the package (PEP 562), so "import pyBaf2Sql" does not import numpy, pandas, or the optional dependencies.
+_SUBMODULE_ATTRIBUTES = {
+    'aio': ('get_default_executor', 'AsyncBafData'),
+    'init_baf2sql': ('init_baf2sql_api',),
+    'classes': ('BafSpectrumArrays', 'SPECTRUM_METADATA_DTYPE', 'KEY_COLUMNS', 'read_sql_table', 'AnalysisTables',
+                'BafData', 'BafSpectrumRecord', 'BafSpectrum'),
+    'baf': ('close_storage', 'get_num_elements', 'open_storage', 'read_array', 'read_double', 'read_float',
+            'read_uint32', 'ArrayBuffer', 'get_sqlite_cache_filename', 'get_sqlite_cache_filename_v2',
+            'find_sqlite_cache_filename', 'set_num_threads', 'extract_baf_spectrum'),
+    'batch': ('BATCH_FORMATS', 'BATCH_STATE_FILE_NAME', 'find_runs', 'get_output_file_name', 'convert_runs',
+              'print_progress', 'get_args', 'main'),
+    'cache': ('METADATA_CACHE_VERSION', 'METADATA_CACHE_DIR_NAME', 'get_metadata_cache_dir', 'get_metadata_cache_key',
+              'is_metadata_cache_valid', 'save_metadata_cache', 'load_metadata_cache', 'clear_metadata_cache',
+              'prune_metadata_cache', 'SpectrumCache'),
+    'error': ('throw_last_baf2sql_error',),
+    'export': ('EXPORT_FORMATS', 'EXPORT_LAYOUT_VERSION', 'DEFAULT_COMPRESSION', 'get_export_format',
+               'ParquetSpectrumWriter', 'HDF5SpectrumWriter', 'ZarrSpectrumWriter', 'SPECTRUM_WRITERS',
+               'iter_spectrum_chunks', 'export_spectra'),
+    'imaging': ('SPOT_NAME_PATTERN', 'COORDINATE_FRAME_COLUMNS', 'COORDINATE_X_COLUMNS', 'COORDINATE_Y_COLUMNS',
+                'COORDINATE_SPOT_COLUMNS', 'parse_spot_names', 'find_coordinates', 'SparseIonCube', 'get_image'),
+    'instrumentation': ('STAGES', 'StageStats', 'Instrumentation', 'get_logging_hook'),
+    'mzml': ('MZML_EXTENSIONS', 'MZML_COMPRESSIONS', 'NUMPRESS_ENCODINGS', 'COMPRESSION_CV_PARAMS', 'SPECTRUM_INDENT',
+             'encode_array', 'write_mzml'),
+    'util': ('get_encoding_dtype', 'get_centroid_status', 'get_profile_bin_edges', 'get_bin_indices',
+             'bin_profile_spectrum', 'bin_profile_spectra', 'bin_spectra_sparse', 'centroid_profile_spectrum',
+             'centroid_profile_spectra', 'get_window_sums', 'get_spectrum_summary', 'get_spectra_summary'),
+    'parallel': ('iter_spectra_parallel',),
+    'pool': ('get_default_handle_pool', 'get_storage_key', 'StorageLease', 'HandlePool'),
+    'store': ('SPECTRUM_STORE_VERSION', 'SPECTRUM_STORE_DIR_NAME', 'get_spectrum_store_dir', 'get_spectrum_store_key',
+              'materialize_spectra', 'SpectrumStore'),
+}
+_ATTRIBUTE_SUBMODULES = {name: submodule
+                         for submodule, names in _SUBMODULE_ATTRIBUTES.items()
+                         for name in names}
+# Modules and ctypes names that the package namespace has always re-exported, as (module, attribute) pairs.
+_REEXPORTS = {'np': ('numpy', None),
+              'pd': ('pandas', None),
+              'os': ('os', None),
+              'platform': ('platform', None),
+              'sqlite3': ('sqlite3', None),
+              'cdll': ('ctypes', 'cdll'),
+              'create_string_buffer': ('ctypes', 'create_string_buffer'),
+              'POINTER': ('ctypes', 'POINTER'),
+              'c_char_p': ('ctypes', 'c_char_p'),
+              'c_double': ('ctypes', 'c_double'),
+              'c_float': ('ctypes', 'c_float'),
+              'c_int': ('ctypes', 'c_int'),
+              'c_uint32': ('ctypes', 'c_uint32'),
+              'c_uint64': ('ctypes', 'c_uint64')}
+
+__all__ = list(_ATTRIBUTE_SUBMODULES.keys()) + list(_REEXPORTS.keys())
+
+
+def __getattr__(name):
+    """
+    Import the submodule or module that provides a public name the first time the name is accessed from the package.
+
+    :param name: Name of the attribute.
+    :type name: str
+    :return: Attribute.
+    """
+    if name in _SUBMODULE_ATTRIBUTES:
+        return importlib.import_module('pyBaf2Sql.' + name)
+    if name in _ATTRIBUTE_SUBMODULES:
+        value = getattr(importlib.import_module('pyBaf2Sql.' + _ATTRIBUTE_SUBMODULES[name]), name)
+    elif name in _REEXPORTS:
+        module_name, attribute = _REEXPORTS[name]
+        value = importlib.import_module(module_name)
+        if attribute is not None:
+            value = getattr(value, attribute)
+    else:
+        raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__) | set(_SUBMODULE_ATTRIBUTES.keys()))
@@ -0,0 +1,196 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pyBaf2Sql.baf import extract_baf_spectrum
+from pyBaf2Sql.classes import BafData, BafSpectrum
+
+
+_default_executor = None
+
+
+def get_default_executor():
+    """
+    Get the bounded thread pool shared by all pyBaf2Sql.aio.AsyncBafData instances that are not given their own
+    executor. The pool is created on first use with min(8, number of CPUs) threads.
+
+    :return: Shared executor.
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                                               thread_name_prefix='pyBaf2Sql')
+    return _default_executor
+
+
+class AsyncBafData(object):
+    """
+    Asyncio facade for pyBaf2Sql.classes.BafData. Blocking Baf2Sql and SQLite work is run on a bounded executor, and
+    the number of calls running at once against the underlying storage handle is limited by a semaphore, so that many
+    concurrent requests can share a small number of open datasets without blocking the event loop. Instances should be
+    created with pyBaf2Sql.aio.AsyncBafData.open().
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param executor: Executor to run blocking calls on, defaults to pyBaf2Sql.aio.get_default_executor().
+    :type executor: concurrent.futures.Executor | None
+    :param max_concurrency: Maximum number of blocking calls running at once against the storage handle, defaults
+        to 1.
+    :type max_concurrency: int
+    """
+    def __init__(self, baf_data, executor=None, max_concurrency=1):
+        """
+        Constructor Method
+        """
+        self.baf_data = baf_data
+        self.executor = executor if executor is not None else get_default_executor()
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    @classmethod
+    async def open(cls, bruker_d_folder_name, baf2sql, executor=None, max_concurrency=1, **kwargs):
+        """
+        Open a BAF dataset on the executor without blocking the event loop.
+
+        :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+        :type bruker_d_folder_name: str
+        :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+        :type baf2sql: ctypes.CDLL
+        :param executor: Executor to run blocking calls on, defaults to pyBaf2Sql.aio.get_default_executor().
+        :type executor: concurrent.futures.Executor | None
+        :param max_concurrency: Maximum number of blocking calls running at once against the storage handle,
+            defaults to 1.
+        :type max_concurrency: int
+        :param kwargs: Keyword arguments passed to pyBaf2Sql.classes.BafData.
+        :return: Opened dataset.
+        :rtype: pyBaf2Sql.aio.AsyncBafData
+        """
+        if executor is None:
+            executor = get_default_executor()
+        baf_data = await asyncio.get_running_loop().run_in_executor(executor,
+                                                                    partial(BafData,
+                                                                            bruker_d_folder_name,
+                                                                            baf2sql,
+                                                                            **kwargs))
+        return cls(baf_data, executor, max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the executor once a slot of the storage handle is available.
+
+        :param func: Function to run.
+        :type func: collections.abc.Callable
+        :param args: Positional arguments passed to func.
+        :param kwargs: Keyword arguments passed to func.
+        :return: Return value of func.
+        """
+        async with self.semaphore:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Keep the slot until the call has actually finished using the storage handle.
+                await asyncio.wait([future])
+                raise
+
+    async def get_spectrum(self, frame, mode='centroid', profile_bins=0, mz_encoding=64, intensity_encoding=64):
+        """
+        Extract the m/z and intensity arrays of a spectrum with pyBaf2Sql.baf.extract_baf_spectrum().
+
+        :param frame: Frame to extract spectrum from.
+        :type frame: int
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Tuple of mz_array (np.array) and intensity_array (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        return await self.run(extract_baf_spectrum, self.baf_data, frame, mode, profile_bins, mz_encoding,
+                              intensity_encoding)
+
+    async def get_baf_spectrum(self, frame, mode='centroid', profile_bins=0, mz_encoding=64, intensity_encoding=64):
+        """
+        Get a spectrum with its metadata as a pyBaf2Sql.classes.BafSpectrum.
+
+        :param frame: ID of the frame of interest.
+        :type frame: int
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Spectrum.
+        :rtype: pyBaf2Sql.classes.BafSpectrum
+        """
+        return await self.run(BafSpectrum, self.baf_data, frame, mode, profile_bins, mz_encoding, intensity_encoding)
+
+    async def iter_spectra(self, mode='centroid', frames=None, batch_size=100, profile_bins=0, mz_encoding=64,
+                           intensity_encoding=64):
+        """
+        Asynchronously iterate over spectra with pyBaf2Sql.classes.BafData.iter_spectra(). Spectra are read on the
+        executor batch_size at a time, and the next batch is read while the current batch is being consumed.
+
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param frames: IDs of the frames to read in the order they should be yielded, defaults to all frames in ID
+            order.
+        :type frames: list[int] | numpy.array | None
+        :param batch_size: Number of spectra read per call on the executor.
+        :type batch_size: int
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Asynchronous generator of spectrum records.
+        :rtype: collections.abc.AsyncIterator[pyBaf2Sql.classes.BafSpectrumArrays]
+        """
+        if frames is None:
+            frames = await self.run(self.baf_data.get_frames)
+
+        def read_batch(batch):
+            return list(self.baf_data.iter_spectra(mode=mode, frames=batch, batch_size=batch_size,
+                                                   profile_bins=profile_bins, mz_encoding=mz_encoding,
+                                                   intensity_encoding=intensity_encoding, copy=True))
+
+        batches = [frames[start:start + batch_size] for start in range(0, len(frames), batch_size)]
+        next_batch = asyncio.ensure_future(self.run(read_batch, batches[0])) if batches else None
+        try:
+            for index in range(len(batches)):
+                spectra = await next_batch
+                next_batch = None
+                if index + 1 < len(batches):
+                    next_batch = asyncio.ensure_future(self.run(read_batch, batches[index + 1]))
+                for spectrum in spectra:
+                    yield spectrum
+        finally:
+            if next_batch is not None:
+                next_batch.cancel()
+
+    async def close(self):
+        """
+        Close the dataset with pyBaf2Sql.classes.BafData.close() once all running calls have finished.
+        """
+        for _ in range(self.max_concurrency):
+            await self.semaphore.acquire()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.baf_data.close)
+        finally:
+            for _ in range(self.max_concurrency):
+                self.semaphore.release()
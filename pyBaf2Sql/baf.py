@@ -3,9 +3,12 @@
 
 
 import os
+import sqlite3
+from contextlib import closing
 from ctypes import c_uint64, POINTER, c_double, c_float, c_uint32, create_string_buffer
+from time import perf_counter
 import numpy as np
-from pyBaf2Sql.util import get_encoding_dtype, bin_profile_spectrum
+from pyBaf2Sql.util import get_encoding_dtype, bin_profile_spectrum, centroid_profile_spectrum
 from pyBaf2Sql.error import throw_last_baf2sql_error
 
 
@@ -69,7 +72,42 @@ def open_storage(baf2sql, bruker_d_folder_name, raw_calibration=False):
     return handle
 
 
-def read_double(baf2sql, handle, identity):
+def read_array(baf2sql, handle, identity, dtype=np.float64, out=None):
+    """
+    Read array into a numpy.array using the Baf2Sql reader that natively matches the requested dtype. The data will be
+    converted to the requested type on the fly.
+
+    :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+    :type baf2sql: ctypes.CDLL
+    :param handle: Handle value for BAF dataset initialized using pyBaf2Sql.baf.open_storage().
+    :type handle: int
+    :param identity: ID of the desired array.
+    :type identity: str | int
+    :param dtype: Numpy dtype of the array, either float64, float32, or uint32, defaults to float64.
+    :type dtype: numpy.dtype
+    :param out: Optional contiguous buffer of the same dtype to read into. The buffer must be large enough to hold the
+        entire array, defaults to allocating a new array.
+    :type out: numpy.array | None
+    :return: Array from the specified ID; if out is provided, a view of its first N elements.
+    :rtype: numpy.array
+    """
+    num_elements = get_num_elements(baf2sql, handle, identity)
+    if out is None:
+        buf = np.empty(shape=num_elements, dtype=dtype)
+    else:
+        if out.dtype != np.dtype(dtype):
+            raise ValueError('Output buffer dtype ' + str(out.dtype) + ' does not match ' + str(np.dtype(dtype)))
+        if not out.flags['C_CONTIGUOUS']:
+            raise ValueError('Output buffer must be C contiguous')
+        if out.size < num_elements:
+            raise ValueError('Output buffer with ' + str(out.size) + ' elements is too small for array with ' +
+                             str(num_elements) + ' elements')
+        buf = out.reshape(-1)[:num_elements]
+    _read_into(baf2sql, handle, identity, buf)
+    return buf
+
+
+def read_double(baf2sql, handle, identity, out=None):
     """
     Read array into a user provided buffer. The data will be converted to the requested type on the fly. The provided
     buffer must be large enough to hold the entire array.
@@ -80,16 +118,15 @@ def read_double(baf2sql, handle, identity):
     :type handle: int
     :param identity: ID of the desired array.
     :type identity: str | int
+    :param out: Optional float64 buffer to read into, defaults to allocating a new array.
+    :type out: numpy.array | None
     :return: Double array from the specified ID.
     :rtype: numpy.array
     """
-    buf = np.empty(shape=get_num_elements(baf2sql, handle, identity), dtype=np.float64)
-    if not baf2sql.baf2sql_array_read_double(handle, identity, buf.ctypes.data_as(POINTER(c_double))):
-        throw_last_baf2sql_error(baf2sql)
-    return buf
+    return read_array(baf2sql, handle, identity, np.float64, out)
 
 
-def read_float(baf2sql, handle, identity):
+def read_float(baf2sql, handle, identity, out=None):
     """
     Read array into a user provided buffer. The data will be converted to the requested type on the fly. The provided
     buffer must be large enough to hold the entire array.
@@ -100,16 +137,15 @@ def read_float(baf2sql, handle, identity):
     :type handle: int
     :param identity: ID of the desired array.
     :type identity: str | int
+    :param out: Optional float32 buffer to read into, defaults to allocating a new array.
+    :type out: numpy.array | None
     :return: Float array from the specified ID.
     :rtype: numpy.array
     """
-    buf = np.empty(shape=get_num_elements(baf2sql, handle, identity), dtype=np.float32)
-    if not baf2sql.baf2sql_array_read_float(handle, identity, buf.ctypes.data_as(POINTER(c_float))):
-        throw_last_baf2sql_error(baf2sql)
-    return buf
+    return read_array(baf2sql, handle, identity, np.float32, out)
 
 
-def read_uint32(baf2sql, handle, identity):
+def read_uint32(baf2sql, handle, identity, out=None):
     """
     Read array into a user provided buffer. The data will be converted to the requested type on the fly. The provided
     buffer must be large enough to hold the entire array.
@@ -120,13 +156,74 @@ def read_uint32(baf2sql, handle, identity):
     :type handle: int
     :param identity: ID of the desired array.
     :type identity: str | int
+    :param out: Optional uint32 buffer to read into, defaults to allocating a new array.
+    :type out: numpy.array | None
     :return: uint32 array from the specified ID.
     :rtype: numpy.array
     """
-    buf = np.empty(shape=get_num_elements(baf2sql, handle, identity), dtype=np.uint32)
-    if not baf2sql.baf2sql_array_read_uint32(handle, identity, buf.ctypes.data_as(POINTER(c_uint32))):
+    return read_array(baf2sql, handle, identity, np.uint32, out)
+
+
+def _read_into(baf2sql, handle, identity, buf):
+    """
+    Read array into a preallocated contiguous numpy.array using the Baf2Sql reader matching the buffer dtype.
+
+    :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+    :type baf2sql: ctypes.CDLL
+    :param handle: Handle value for BAF dataset initialized using pyBaf2Sql.baf.open_storage().
+    :type handle: int
+    :param identity: ID of the desired array.
+    :type identity: str | int
+    :param buf: Buffer large enough to hold the entire array with dtype float64, float32, or uint32.
+    :type buf: numpy.array
+    """
+    if buf.dtype == np.float64:
+        success = baf2sql.baf2sql_array_read_double(handle, identity, buf.ctypes.data_as(POINTER(c_double)))
+    elif buf.dtype == np.float32:
+        success = baf2sql.baf2sql_array_read_float(handle, identity, buf.ctypes.data_as(POINTER(c_float)))
+    elif buf.dtype == np.uint32:
+        success = baf2sql.baf2sql_array_read_uint32(handle, identity, buf.ctypes.data_as(POINTER(c_uint32)))
+    else:
+        raise ValueError('Unsupported buffer dtype: ' + str(buf.dtype))
+    if not success:
         throw_last_baf2sql_error(baf2sql)
-    return buf
+
+
+class ArrayBuffer(object):
+    """
+    Reusable buffer for reading arrays from a BAF dataset. The buffer grows to the size of the largest array read so
+    far, so arrays returned by read() are views into the buffer and are overwritten by the next read.
+
+    :param dtype: Numpy dtype of the buffer, either float64, float32, or uint32, defaults to float64.
+    :type dtype: numpy.dtype
+    :param size: Initial number of elements to allocate, defaults to 0.
+    :type size: int
+    """
+    def __init__(self, dtype=np.float64, size=0):
+        """
+        Constructor Method
+        """
+        self.buffer = np.empty(shape=size, dtype=dtype)
+
+    def read(self, baf2sql, handle, identity):
+        """
+        Read array into the buffer, growing the buffer first if the array is larger than any array read so far.
+
+        :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+        :type baf2sql: ctypes.CDLL
+        :param handle: Handle value for BAF dataset initialized using pyBaf2Sql.baf.open_storage().
+        :type handle: int
+        :param identity: ID of the desired array.
+        :type identity: str | int
+        :return: View of the buffer containing the array from the specified ID.
+        :rtype: numpy.array
+        """
+        num_elements = get_num_elements(baf2sql, handle, identity)
+        if num_elements > self.buffer.size:
+            self.buffer = np.empty(shape=num_elements, dtype=self.buffer.dtype)
+        buf = self.buffer[:num_elements]
+        _read_into(baf2sql, handle, identity, buf)
+        return buf
 
 
 def get_sqlite_cache_filename(baf2sql, bruker_d_folder_name):
@@ -173,6 +270,28 @@ def get_sqlite_cache_filename_v2(baf2sql, bruker_d_folder_name, all_variables=Fa
     return buf.value
 
 
+def find_sqlite_cache_filename(bruker_d_folder_name):
+    """
+    Find an existing SQLite cache "analysis.sqlite" for the specified BAF file without calling the Baf2Sql library,
+    which checks the cache against analysis.baf and regenerates it if needed. The cache is considered valid if it is
+    not older than analysis.baf and contains the Spectra table.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :return: SQLite filename, or None if no valid SQLite cache exists.
+    :rtype: str | None
+    """
+    sqlite_file_name = os.path.join(bruker_d_folder_name, 'analysis.sqlite')
+    try:
+        if os.path.getmtime(sqlite_file_name) < os.path.getmtime(os.path.join(bruker_d_folder_name, 'analysis.baf')):
+            return None
+        with closing(sqlite3.connect(sqlite_file_name)) as conn:
+            tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Spectra'").fetchall()
+    except (OSError, sqlite3.Error):
+        return None
+    return sqlite_file_name if tables else None
+
+
 def set_num_threads(baf2sql, num_threads):
     """
     Set the number of threads that this DLL is allowed to use internally. The index <-> m/z transformation is
@@ -187,16 +306,21 @@ def set_num_threads(baf2sql, num_threads):
     baf2sql.baf2sql_set_num_threads(num_threads)
 
 
-def extract_baf_spectrum(baf_data, frame, mode, profile_bins=0, mz_encoding=64, intensity_encoding=64):
+def extract_baf_spectrum(baf_data, frame, mode, profile_bins=0, mz_encoding=64, intensity_encoding=64, out=None,
+                         bin_edges=None):
     """
     Extract spectrum from BAF data with m/z and intensity arrays. Spectrum can either be centroid or profile mode. If
-    "raw" mode is chosen, centroid mode will automatically be used.
+    "raw" mode is chosen, centroid mode will automatically be used. If "centroid_from_profile" mode is chosen, the
+    profile mode spectrum is centroided with pyBaf2Sql.util.centroid_profile_spectrum() instead of reading the line
+    spectrum. Arrays are read with the Baf2Sql reader matching the requested encoding, so no intermediate copy or
+    conversion is made. If baf_data has a spectrum cache, arrays are served from and added to the cache; cached arrays
+    are read-only. If baf_data has instrumentation enabled, the ctypes, binning, and centroiding stages are recorded.
 
     :param baf_data: baf_data object containing metadata from analysis.sqlite database.
     :type baf_data: timsconvert.classes.TimsconvertBafData
     :param frame: Frame to extract spectrum from.
     :type frame: int
-    :param mode: Mode command line parameter, either "profile", "centroid", or "raw".
+    :param mode: Mode command line parameter, either "profile", "centroid", "centroid_from_profile", or "raw".
     :type mode: str
     :param profile_bins: Number of bins to bin spectrum to.
     :type profile_bins: int
@@ -204,20 +328,93 @@ def extract_baf_spectrum(baf_data, frame, mode, profile_bins=0, mz_encoding=64,
     :type mz_encoding: int
     :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
     :type intensity_encoding: int
+    :param out: Optional tuple of (mz_out, intensity_out) buffers with dtypes matching mz_encoding and
+        intensity_encoding to write the arrays into; the returned arrays are then views of these buffers. The buffers
+        must be large enough to hold the unbinned arrays.
+    :type out: tuple[numpy.array] | None
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to instead of binning each spectrum over its own m/z range.
+    :type bin_edges: numpy.array | None
     :return: Tuple of mz_array (np.array) and intensity_array (np.array).
     :rtype: tuple[numpy.array]
     """
-    frames_dict = baf_data.analysis['Spectra'][baf_data.analysis['Spectra']['Id'] == frame].to_dict(orient='records')[0]
+    spectrum_cache = getattr(baf_data, 'spectrum_cache', None)
+    if spectrum_cache is not None:
+        binning = None
+        if mode == 'profile' and bin_edges is not None:
+            binning = (float(bin_edges[0]), float(bin_edges[-1]), bin_edges.size)
+        elif mode == 'profile':
+            binning = profile_bins
+        key = (frame, 'centroid' if mode == 'raw' else mode, binning, mz_encoding, intensity_encoding)
+        arrays = spectrum_cache.get(key)
+        if arrays is not None:
+            if out is None:
+                return arrays
+            return _copy_to(arrays[0], out[0]), _copy_to(arrays[1], out[1])
+    instrumentation = getattr(baf_data, 'instrumentation', None)
+    frames_dict = baf_data.spectra_index[frame]
+    mz_out, intensity_out = (None, None) if out is None else out
+    start = perf_counter()
     if mode == 'raw' or mode == 'centroid':
-        mz_array = np.array(read_double(baf_data.api, baf_data.handle, int(frames_dict['LineMzId'])),
-                            dtype=get_encoding_dtype(mz_encoding))
-        intensity_array = np.array(read_double(baf_data.api, baf_data.handle, int(frames_dict['LineIntensityId'])),
-                                   dtype=get_encoding_dtype(intensity_encoding))
-    elif mode == 'profile':
-        mz_array = np.array(read_double(baf_data.api, baf_data.handle, int(frames_dict['ProfileMzId'])),
-                            dtype=get_encoding_dtype(mz_encoding))
-        intensity_array = np.array(read_double(baf_data.api, baf_data.handle, int(frames_dict['ProfileIntensityId'])),
-                                   dtype=get_encoding_dtype(intensity_encoding))
-        if profile_bins != 0:
-            mz_array, intensity_array = bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding)
+        mz_array = read_array(baf_data.api, baf_data.handle, int(frames_dict['LineMzId']),
+                              get_encoding_dtype(mz_encoding), mz_out)
+        intensity_array = read_array(baf_data.api, baf_data.handle, int(frames_dict['LineIntensityId']),
+                                     get_encoding_dtype(intensity_encoding), intensity_out)
+    elif mode == 'profile' or mode == 'centroid_from_profile':
+        binned = mode == 'profile' and (profile_bins != 0 or bin_edges is not None)
+        if binned or mode == 'centroid_from_profile':
+            mz_out, intensity_out = None, None
+        mz_array = read_array(baf_data.api, baf_data.handle, int(frames_dict['ProfileMzId']),
+                              get_encoding_dtype(mz_encoding), mz_out)
+        intensity_array = read_array(baf_data.api, baf_data.handle, int(frames_dict['ProfileIntensityId']),
+                                     get_encoding_dtype(intensity_encoding), intensity_out)
+    else:
+        raise ValueError('Unsupported mode: ' + str(mode))
+    if instrumentation is not None:
+        instrumentation.record('ctypes', perf_counter() - start, mz_array.nbytes + intensity_array.nbytes,
+                               source_file=baf_data.source_file, frame=frame)
+    if mode == 'centroid_from_profile':
+        start = perf_counter()
+        mz_array, intensity_array = centroid_profile_spectrum(mz_array, intensity_array, mz_encoding=mz_encoding,
+                                                              intensity_encoding=intensity_encoding)
+        if out is not None:
+            mz_array = _copy_to(mz_array, out[0])
+            intensity_array = _copy_to(intensity_array, out[1])
+        if instrumentation is not None:
+            instrumentation.record('centroiding', perf_counter() - start, mz_array.nbytes + intensity_array.nbytes,
+                                   source_file=baf_data.source_file, frame=frame)
+    if mode == 'profile' and binned:
+        start = perf_counter()
+        mz_array, intensity_array = bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding,
+                                                         bin_edges)
+        if out is not None:
+            mz_array = _copy_to(mz_array, out[0])
+            intensity_array = _copy_to(intensity_array, out[1])
+        if instrumentation is not None:
+            instrumentation.record('binning', perf_counter() - start, mz_array.nbytes + intensity_array.nbytes,
+                                   source_file=baf_data.source_file, frame=frame)
+    if spectrum_cache is not None:
+        if out is None:
+            spectrum_cache.put(key, mz_array, intensity_array)
+        else:
+            spectrum_cache.put(key, mz_array.copy(), intensity_array.copy())
     return mz_array, intensity_array
+
+
+def _copy_to(array, out):
+    """
+    Copy an array into the first N elements of a caller provided buffer.
+
+    :param array: Array to copy.
+    :type array: numpy.array
+    :param out: Buffer large enough to hold the array.
+    :type out: numpy.array
+    :return: View of the buffer containing the copied array.
+    :rtype: numpy.array
+    """
+    if out.size < array.size:
+        raise ValueError('Output buffer with ' + str(out.size) + ' elements is too small for array with ' +
+                         str(array.size) + ' elements')
+    view = out.reshape(-1)[:array.size]
+    view[:] = array
+    return view
@@ -0,0 +1,420 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+from pyBaf2Sql.init_baf2sql import init_baf2sql_api
+from pyBaf2Sql.classes import BafData
+from pyBaf2Sql.export import EXPORT_FORMATS, export_spectra
+from pyBaf2Sql.mzml import MZML_EXTENSIONS, write_mzml
+
+
+BATCH_FORMATS = dict(EXPORT_FORMATS, mzml=MZML_EXTENSIONS)
+BATCH_STATE_FILE_NAME = 'pyBaf2Sql_batch.json'
+
+# Baf2Sql library loaded once in each worker process by _init_worker().
+_worker = {}
+
+
+def find_runs(inputs):
+    """
+    Find Bruker .d directories from a list of paths and glob patterns. Paths to .d directories are used as is, and
+    other directories are searched for .d directories one level deep.
+
+    :param inputs: Paths or glob patterns, e.g. "/data/2024-*/*.d".
+    :type inputs: list[str] | str
+    :return: List of paths to .d directories in input order without duplicates.
+    :rtype: list[str]
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    runs = []
+    for pattern in inputs:
+        paths = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        found = []
+        for path in paths:
+            path = os.path.normpath(path)
+            if not os.path.isdir(path):
+                continue
+            if path.lower().endswith('.d'):
+                found.append(path)
+            else:
+                found.extend(sorted(entry.path for entry in os.scandir(path)
+                                    if entry.is_dir() and entry.name.lower().endswith('.d')))
+        if not found:
+            raise ValueError('No .d directories found for ' + pattern)
+        runs.extend(found)
+    unique_runs = []
+    seen = set()
+    for run in runs:
+        if os.path.abspath(run) not in seen:
+            seen.add(os.path.abspath(run))
+            unique_runs.append(run)
+    return unique_runs
+
+
+def get_output_file_name(bruker_d_folder_name, output_dir=None, export_format='parquet'):
+    """
+    Get the path of the output of a run, named after the .d directory with the first extension of the export format.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory.
+    :type bruker_d_folder_name: str
+    :param output_dir: Directory to write the output to, defaults to the directory containing the .d directory.
+    :type output_dir: str | None
+    :param export_format: Export format, either "parquet", "hdf5", "zarr", or "mzml".
+    :type export_format: str
+    :return: Path of the output file, or directory for Zarr.
+    :rtype: str
+    """
+    bruker_d_folder_name = os.path.normpath(bruker_d_folder_name)
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(bruker_d_folder_name))
+    name = os.path.splitext(os.path.basename(bruker_d_folder_name))[0]
+    return os.path.join(output_dir, name + BATCH_FORMATS[export_format][0])
+
+
+def _get_run_size(bruker_d_folder_name):
+    """
+    Get the size of analysis.baf of a run, used to schedule the largest runs first.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory.
+    :type bruker_d_folder_name: str
+    :return: Size in bytes, or 0 if analysis.baf cannot be found.
+    :rtype: int
+    """
+    try:
+        return os.path.getsize(os.path.join(bruker_d_folder_name, 'analysis.baf'))
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    """
+    Remove a file or directory if it exists.
+
+    :param path: Path to remove.
+    :type path: str
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _init_worker(bruker_api_file_name):
+    """
+    Initialize a worker process by loading the Baf2Sql library once for all runs converted by the worker.
+
+    :param bruker_api_file_name: Path to Baf2Sql library.
+    :type bruker_api_file_name: str
+    """
+    _worker['api'] = init_baf2sql_api(bruker_api_file_name)
+
+
+def _convert_run(bruker_d_folder_name, output_file_name, export_format, raw_calibration, metadata_cache,
+                 export_options):
+    """
+    Convert a run in a worker process. The output is written to a temporary name next to output_file_name and renamed
+    once the run is complete.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory.
+    :type bruker_d_folder_name: str
+    :param output_file_name: Path of the output file, or directory for Zarr.
+    :type output_file_name: str
+    :param export_format: Export format, either "parquet", "hdf5", "zarr", or "mzml".
+    :type export_format: str
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True).
+    :type raw_calibration: bool
+    :param metadata_cache: Whether to use a memory-mapped metadata cache; see pyBaf2Sql.cache.
+    :type metadata_cache: bool
+    :param export_options: Keyword arguments passed to pyBaf2Sql.export.export_spectra() or
+        pyBaf2Sql.mzml.write_mzml().
+    :type export_options: dict
+    :return: Dictionary of num_spectra, seconds, and pid of the worker.
+    :rtype: dict
+    """
+    start = perf_counter()
+    temp_file_name = output_file_name + '.partial'
+    _remove(temp_file_name)
+    try:
+        with BafData(bruker_d_folder_name, _worker['api'], raw_calibration=raw_calibration,
+                     metadata_cache=metadata_cache) as baf_data:
+            if export_format == 'mzml':
+                num_spectra = write_mzml(baf_data, temp_file_name, **export_options)
+            else:
+                num_spectra = export_spectra(baf_data, temp_file_name, export_format, **export_options)
+        _remove(output_file_name)
+        os.replace(temp_file_name, output_file_name)
+    except BaseException:
+        _remove(temp_file_name)
+        raise
+    return {'num_spectra': num_spectra, 'seconds': perf_counter() - start, 'pid': os.getpid()}
+
+
+def _write_state(state_file_name, results):
+    """
+    Atomically write the results of a batch to its JSON state file.
+
+    :param state_file_name: Path of the state file.
+    :type state_file_name: str
+    :param results: List of result dictionaries.
+    :type results: list[dict]
+    """
+    temp_file_name = state_file_name + '.tmp'
+    with open(temp_file_name, 'w') as state_file:
+        json.dump({'runs': [i for i in results if i is not None]}, state_file, indent=4)
+    os.replace(temp_file_name, state_file_name)
+
+
+def convert_runs(inputs, output_dir=None, export_format='parquet', mode='centroid', profile_bins=0, mz_encoding=64,
+                 intensity_encoding=64, chunk_size=10000, compression='default', raw_calibration=False,
+                 metadata_cache=False, num_workers=None, bruker_api_file_name='', overwrite=False, max_attempts=2,
+                 progress_callback=None, state_file_name=None, mp_context=None, mz_numpress=None,
+                 intensity_numpress=None):
+    """
+    Convert many BAF runs with pyBaf2Sql.export.export_spectra() or pyBaf2Sql.mzml.write_mzml() across a pool of worker
+    processes that each load the Baf2Sql library once. Runs whose output already exists are skipped unless overwrite is
+    True, so an interrupted batch can be resumed by running it again. Runs that raise an error are recorded as failed
+    without stopping the batch, and runs that were in flight when a worker process crashed are retried one at a time in
+    a new worker up to max_attempts times in total.
+
+    Since each worker converts whole runs, the SQLite loading of one run overlaps with the spectrum extraction of the
+    others and throughput scales with the number of workers. Runs are scheduled largest first to balance the load.
+    Every output is written to a temporary name and renamed when the run is complete, so a failed or interrupted batch
+    never leaves partial outputs behind. The result of every run is stored in a JSON state file in the output
+    directory.
+
+    :param inputs: Paths to .d directories, directories containing .d directories, or glob patterns; see
+        pyBaf2Sql.batch.find_runs().
+    :type inputs: list[str] | str
+    :param output_dir: Directory to write the outputs and state file to, defaults to writing each output next to its
+        .d directory without a state file.
+    :type output_dir: str | None
+    :param export_format: Export format, either "parquet", "hdf5", "zarr", or "mzml".
+    :type export_format: str
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param chunk_size: Number of spectra per chunk, i.e. per Parquet row group.
+    :type chunk_size: int
+    :param compression: Compression codec of the chosen format, None to disable compression, or "default" to use
+        pyBaf2Sql.export.DEFAULT_COMPRESSION or zlib for mzML.
+    :type compression: str | None
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True), defaults to False.
+    :type raw_calibration: bool
+    :param metadata_cache: Whether to use a memory-mapped metadata cache; see pyBaf2Sql.cache.
+    :type metadata_cache: bool
+    :param num_workers: Number of worker processes, defaults to the number of CPUs.
+    :type num_workers: int | None
+    :param bruker_api_file_name: Path to Baf2Sql library to load in each worker, defaults to the packaged library.
+    :type bruker_api_file_name: str
+    :param overwrite: Whether to convert runs whose output already exists, defaults to False.
+    :type overwrite: bool
+    :param max_attempts: Maximum number of times a run is submitted when worker processes crash, defaults to 2.
+    :type max_attempts: int
+    :param progress_callback: Callable called in the main process with the result dictionary of each run as it
+        finishes or is skipped.
+    :type progress_callback: collections.abc.Callable | None
+    :param state_file_name: Path of the JSON state file to record the results in, defaults to
+        pyBaf2Sql.batch.BATCH_STATE_FILE_NAME in output_dir.
+    :type state_file_name: str | None
+    :param mp_context: Multiprocessing context used to start the worker processes, defaults to the platform default.
+    :type mp_context: multiprocessing.context.BaseContext | None
+    :param mz_numpress: MS-Numpress encoding of the m/z arrays for mzML, either "linear" or None.
+    :type mz_numpress: str | None
+    :param intensity_numpress: MS-Numpress encoding of the intensity arrays for mzML, either "slof", "pic", or None.
+    :type intensity_numpress: str | None
+    :return: List of result dictionaries in input order with the keys index, total, source_file, output_file, status
+        ("done", "skipped", or "failed"), attempts, num_spectra, seconds, and error.
+    :rtype: list[dict]
+    """
+    if export_format not in BATCH_FORMATS:
+        raise ValueError('Unsupported export format: ' + str(export_format))
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    runs = find_runs(inputs)
+    output_file_names = [get_output_file_name(run, output_dir, export_format) for run in runs]
+    if len(set(os.path.abspath(i) for i in output_file_names)) != len(output_file_names):
+        raise ValueError('Runs with the same name would be written to the same output; use separate output '
+                         'directories.')
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        if state_file_name is None:
+            state_file_name = os.path.join(output_dir, BATCH_STATE_FILE_NAME)
+    export_options = {'mode': mode,
+                      'profile_bins': profile_bins,
+                      'mz_encoding': mz_encoding,
+                      'intensity_encoding': intensity_encoding,
+                      'chunk_size': chunk_size,
+                      'compression': compression}
+    if export_format == 'mzml':
+        export_options['compression'] = 'zlib' if compression == 'default' else compression
+        export_options['mz_numpress'] = mz_numpress
+        export_options['intensity_numpress'] = intensity_numpress
+
+    results = [None] * len(runs)
+    attempts = [0] * len(runs)
+
+    def finish(index, status, num_spectra=None, seconds=None, error=None):
+        results[index] = {'index': index,
+                          'total': len(runs),
+                          'source_file': runs[index],
+                          'output_file': output_file_names[index],
+                          'status': status,
+                          'attempts': attempts[index],
+                          'num_spectra': num_spectra,
+                          'seconds': seconds,
+                          'error': error}
+        if state_file_name is not None:
+            _write_state(state_file_name, results)
+        if progress_callback is not None:
+            progress_callback(results[index])
+
+    queue = []
+    for index, output_file_name in enumerate(output_file_names):
+        if not overwrite and os.path.exists(output_file_name):
+            finish(index, 'skipped')
+        else:
+            queue.append(index)
+    queue.sort(key=lambda index: _get_run_size(runs[index]))
+
+    def run_pool(queue, pool_size):
+        # Returns the runs that were lost when a worker process crashed and may be retried.
+        lost = []
+        while queue:
+            with ProcessPoolExecutor(max_workers=pool_size,
+                                     mp_context=mp_context,
+                                     initializer=_init_worker,
+                                     initargs=(bruker_api_file_name,)) as pool:
+                pending = {}
+                broken = False
+                while (queue and not broken) or pending:
+                    while queue and not broken and len(pending) < 2 * pool_size:
+                        index = queue.pop()
+                        attempts[index] += 1
+                        future = pool.submit(_convert_run, runs[index], output_file_names[index], export_format,
+                                             raw_calibration, metadata_cache, export_options)
+                        pending[future] = index
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = pending.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            result = future.result()
+                            finish(index, 'done', result['num_spectra'], result['seconds'])
+                        elif isinstance(error, BrokenProcessPool) and attempts[index] < max_attempts:
+                            broken = True
+                            lost.append(index)
+                        else:
+                            finish(index, 'failed',
+                                   error=''.join(traceback.format_exception_only(type(error), error)).strip())
+        return lost
+
+    lost = run_pool(queue, num_workers)
+    # A crash takes down every run in flight in the pool, so lost runs are retried one at a time in their own worker
+    # to keep a run that crashes its worker from failing the others.
+    while lost:
+        lost = [i for index in lost for i in run_pool([index], 1)]
+    return results
+
+
+def print_progress(result):
+    """
+    Print the result of a run as one line, e.g. as the progress_callback of pyBaf2Sql.batch.convert_runs().
+
+    :param result: Result dictionary of a run.
+    :type result: dict
+    """
+    line = '[' + str(result['index'] + 1) + '/' + str(result['total']) + '] ' + result['source_file'] + ': ' + \
+        result['status']
+    if result['status'] == 'done':
+        line += ' (' + str(result['num_spectra']) + ' spectra in ' + '{:.1f}'.format(result['seconds']) + ' s)'
+    elif result['status'] == 'failed':
+        line += ' (' + result['error'] + ')'
+    print(line, flush=True)
+
+
+def get_args(argv=None):
+    """
+    Parse command line arguments.
+
+    :param argv: Command line arguments, defaults to sys.argv[1:].
+    :type argv: list[str] | None
+    :return: Parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Convert many Bruker BAF runs with a pool of worker processes.')
+    parser.add_argument('inputs', type=str, nargs='+', help='Paths to .d directories, directories containing .d '
+                                                            'directories, or glob patterns.')
+    parser.add_argument('--output_dir', type=str, default=None, help='Directory to write the outputs and state file '
+                                                                     'to, defaults to next to each .d directory.')
+    parser.add_argument('--format', type=str, default='parquet', choices=list(BATCH_FORMATS.keys()),
+                        help='Export format.')
+    parser.add_argument('--mode', type=str, default='centroid',
+                        choices=['profile', 'centroid', 'centroid_from_profile', 'raw'], help='Data array mode.')
+    parser.add_argument('--profile_bins', type=int, default=0, help='Number of bins to bin profile spectra to.')
+    parser.add_argument('--mz_encoding', type=int, default=64, choices=[32, 64], help='m/z encoding.')
+    parser.add_argument('--intensity_encoding', type=int, default=64, choices=[32, 64], help='Intensity encoding.')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Number of spectra per chunk.')
+    parser.add_argument('--compression', type=str, default='default', help='Compression codec, "default" for the '
+                                                                           'default of the format or "none".')
+    parser.add_argument('--mz_numpress', type=str, default=None, choices=['linear'], help='MS-Numpress encoding of '
+                                                                                         'the m/z arrays for mzML.')
+    parser.add_argument('--intensity_numpress', type=str, default=None, choices=['slof', 'pic'],
+                        help='MS-Numpress encoding of the intensity arrays for mzML.')
+    parser.add_argument('--raw_calibration', action='store_true', help='Use raw instead of recalibrated data.')
+    parser.add_argument('--metadata_cache', action='store_true', help='Use memory-mapped metadata caches.')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of worker processes, defaults to the '
+                                                                      'number of CPUs.')
+    parser.add_argument('--bruker_api_file_name', type=str, default='', help='Path to Baf2Sql library, defaults to '
+                                                                             'the packaged library.')
+    parser.add_argument('--overwrite', action='store_true', help='Convert runs whose output already exists.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the pyBaf2Sql-batch console script, which runs pyBaf2Sql.batch.convert_runs() from the command
+    line, e.g. pyBaf2Sql-batch "/data/2024-*/*.d" --output_dir /data/parquet --format parquet --num_workers 16.
+
+    :param argv: Command line arguments, defaults to sys.argv[1:].
+    :type argv: list[str] | None
+    :return: Exit code, 1 if any run failed and 0 otherwise.
+    :rtype: int
+    """
+    args = get_args(argv)
+    results = convert_runs(args.inputs,
+                           output_dir=args.output_dir,
+                           export_format=args.format,
+                           mode=args.mode,
+                           profile_bins=args.profile_bins,
+                           mz_encoding=args.mz_encoding,
+                           intensity_encoding=args.intensity_encoding,
+                           chunk_size=args.chunk_size,
+                           compression=None if args.compression.lower() == 'none' else args.compression,
+                           raw_calibration=args.raw_calibration,
+                           metadata_cache=args.metadata_cache,
+                           num_workers=args.num_workers,
+                           bruker_api_file_name=args.bruker_api_file_name,
+                           overwrite=args.overwrite,
+                           progress_callback=print_progress,
+                           mz_numpress=args.mz_numpress,
+                           intensity_numpress=args.intensity_numpress)
+    statuses = [i['status'] for i in results]
+    print(str(statuses.count('done')) + ' converted, ' + str(statuses.count('skipped')) + ' skipped, ' +
+          str(statuses.count('failed')) + ' failed')
+    return 1 if 'failed' in statuses else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
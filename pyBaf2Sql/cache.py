@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+METADATA_CACHE_VERSION = 2
+METADATA_CACHE_DIR_NAME = 'pyBaf2Sql_cache'
+
+
+def get_metadata_cache_dir(bruker_d_folder_name, cache_dir=None):
+    """
+    Get the directory used to cache the metadata of a BAF dataset. By default, the cache is stored in a
+    "pyBaf2Sql_cache" directory inside the .d directory. If a shared cache directory is provided, each dataset is
+    cached in a subdirectory named after a hash of its absolute path.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param cache_dir: Shared directory in which to store metadata caches, defaults to None.
+    :type cache_dir: str | None
+    :return: Path to the metadata cache directory.
+    :rtype: str
+    """
+    if cache_dir is None:
+        return os.path.join(bruker_d_folder_name, METADATA_CACHE_DIR_NAME)
+    path_hash = hashlib.sha1(os.path.abspath(bruker_d_folder_name).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, path_hash)
+
+
+def get_metadata_cache_key(bruker_d_folder_name, all_variables):
+    """
+    Get the key identifying the state of a BAF dataset, made of the modification time and size of analysis.baf and
+    analysis.sqlite. A metadata cache is only valid if its key matches the current key of the dataset.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param all_variables: Whether all variables were loaded from analysis.sqlite database.
+    :type all_variables: bool
+    :return: Dictionary describing the dataset, or None if analysis.baf or analysis.sqlite do not exist.
+    :rtype: dict | None
+    """
+    key = {'version': METADATA_CACHE_VERSION, 'all_variables': bool(all_variables)}
+    for file_name in ('analysis.baf', 'analysis.sqlite'):
+        try:
+            stat = os.stat(os.path.join(bruker_d_folder_name, file_name))
+        except FileNotFoundError:
+            return None
+        key[file_name] = [stat.st_mtime_ns, stat.st_size]
+    return key
+
+
+def _read_manifest(metadata_cache_dir):
+    """
+    Read the manifest of a metadata cache.
+
+    :param metadata_cache_dir: Path to the metadata cache directory.
+    :type metadata_cache_dir: str
+    :return: Manifest, or None if it does not exist or cannot be read.
+    :rtype: dict | None
+    """
+    try:
+        with open(os.path.join(metadata_cache_dir, 'manifest.json'), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_metadata_cache_valid(bruker_d_folder_name, all_variables, cache_dir=None):
+    """
+    Check whether a metadata cache exists for a BAF dataset and matches its current state.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param all_variables: Whether all variables are loaded from analysis.sqlite database.
+    :type all_variables: bool
+    :param cache_dir: Shared directory in which metadata caches are stored, defaults to None.
+    :type cache_dir: str | None
+    :return: Whether the metadata cache is valid.
+    :rtype: bool
+    """
+    key = get_metadata_cache_key(bruker_d_folder_name, all_variables)
+    manifest = _read_manifest(get_metadata_cache_dir(bruker_d_folder_name, cache_dir))
+    return key is not None and manifest is not None and manifest['key'] == key
+
+
+def save_metadata_cache(analysis, bruker_d_folder_name, all_variables, cache_dir=None):
+    """
+    Save the metadata tables of a BAF dataset to a metadata cache. Each column is stored as a .npy file so that it can
+    be memory-mapped when the cache is loaded. Columns mixing text and numbers, which SQLite's dynamic typing allows,
+    are stored as pickled object arrays that are read into memory instead. The lookup indexes of
+    pyBaf2Sql.classes.BafData are not stored, since they hold Python objects; they are rebuilt from the cached tables
+    the first time they are accessed. The cache is written to a temporary directory that replaces any existing cache
+    once it is complete.
+
+    :param analysis: Mapping of table names to tables as found in pyBaf2Sql.classes.BafData.analysis.
+    :type analysis: collections.abc.Mapping
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param all_variables: Whether all variables were loaded from analysis.sqlite database.
+    :type all_variables: bool
+    :param cache_dir: Shared directory in which to store metadata caches, defaults to None.
+    :type cache_dir: str | None
+    :return: Path to the metadata cache directory.
+    :rtype: str
+    """
+    import pandas as pd
+    metadata_cache_dir = get_metadata_cache_dir(bruker_d_folder_name, cache_dir)
+    parent_dir = os.path.dirname(os.path.abspath(metadata_cache_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent_dir)
+    try:
+        manifest = {'key': get_metadata_cache_key(bruker_d_folder_name, all_variables),
+                    'source': os.path.abspath(bruker_d_folder_name),
+                    'tables': {}}
+        for table_index, (name, table) in enumerate(analysis.items()):
+            if isinstance(table, dict):
+                manifest['tables'][name] = {'properties': table}
+                continue
+            columns = []
+            for column_index, column in enumerate(table.columns):
+                file_name = str(table_index) + '_' + str(column_index)
+                values = table[column].to_numpy()
+                column_entry = {'name': column, 'file': file_name + '.npy', 'null_file': None, 'pickled': False}
+                if values.dtype == object:
+                    null_mask = table[column].isna().values
+                    non_null = values[~null_mask]
+                    if all(isinstance(value, str) for value in non_null):
+                        values = np.array(['' if is_null else value for value, is_null in zip(values, null_mask)],
+                                          dtype=str)
+                    elif all(isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+                             for value in non_null):
+                        values = pd.to_numeric(table[column]).values.astype(np.float64)
+                    else:
+                        column_entry['pickled'] = True
+                        null_mask = np.zeros(values.size, dtype=bool)
+                    if null_mask.any():
+                        column_entry['null_file'] = file_name + '_null.npy'
+                        np.save(os.path.join(temp_dir, column_entry['null_file']), null_mask)
+                np.save(os.path.join(temp_dir, column_entry['file']), np.ascontiguousarray(values),
+                        allow_pickle=column_entry['pickled'])
+                columns.append(column_entry)
+            manifest['tables'][name] = {'columns': columns}
+        with open(os.path.join(temp_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        clear_metadata_cache(bruker_d_folder_name, cache_dir)
+        os.replace(temp_dir, metadata_cache_dir)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return metadata_cache_dir
+
+
+def load_metadata_cache(bruker_d_folder_name, all_variables, cache_dir=None):
+    """
+    Load the metadata tables of a BAF dataset from its metadata cache. Numeric and text columns are memory-mapped
+    rather than read into memory. Stale caches are not loaded.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param all_variables: Whether all variables are loaded from analysis.sqlite database.
+    :type all_variables: bool
+    :param cache_dir: Shared directory in which metadata caches are stored, defaults to None.
+    :type cache_dir: str | None
+    :return: Dictionary of table names to tables, or None if no valid metadata cache exists.
+    :rtype: dict | None
+    """
+    import pandas as pd
+    metadata_cache_dir = get_metadata_cache_dir(bruker_d_folder_name, cache_dir)
+    manifest = _read_manifest(metadata_cache_dir)
+    key = get_metadata_cache_key(bruker_d_folder_name, all_variables)
+    if key is None or manifest is None or manifest['key'] != key:
+        return None
+    tables = {}
+    for name, table_entry in manifest['tables'].items():
+        if 'properties' in table_entry:
+            tables[name] = table_entry['properties']
+            continue
+        columns = {}
+        for column_entry in table_entry['columns']:
+            if column_entry['pickled']:
+                values = np.load(os.path.join(metadata_cache_dir, column_entry['file']), allow_pickle=True)
+                columns[column_entry['name']] = values
+                continue
+            values = np.load(os.path.join(metadata_cache_dir, column_entry['file']), mmap_mode='r')
+            if values.dtype.kind == 'U' or column_entry['null_file'] is not None:
+                values = values.astype(object)
+                if column_entry['null_file'] is not None:
+                    values[np.load(os.path.join(metadata_cache_dir, column_entry['null_file']))] = None
+            columns[column_entry['name']] = values
+        tables[name] = pd.DataFrame(columns, copy=False)
+    # Record the access time for pyBaf2Sql.cache.prune_metadata_cache(); caches on read-only storage are still used.
+    try:
+        os.utime(os.path.join(metadata_cache_dir, 'manifest.json'))
+    except OSError:
+        pass
+    return tables
+
+
+def clear_metadata_cache(bruker_d_folder_name, cache_dir=None):
+    """
+    Delete the metadata cache of a BAF dataset if it exists.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param cache_dir: Shared directory in which metadata caches are stored, defaults to None.
+    :type cache_dir: str | None
+    """
+    shutil.rmtree(get_metadata_cache_dir(bruker_d_folder_name, cache_dir), ignore_errors=True)
+
+
+def prune_metadata_cache(cache_dir, max_age=None, max_size=None):
+    """
+    Delete metadata caches from a shared cache directory. Caches whose dataset no longer exists or has changed since
+    the cache was written are always deleted. Caches that have not been loaded within max_age seconds are deleted, then
+    the least recently loaded caches are deleted until the total size is at most max_size bytes.
+
+    :param cache_dir: Shared directory in which metadata caches are stored.
+    :type cache_dir: str
+    :param max_age: Maximum number of seconds since a cache was last loaded, defaults to no limit.
+    :type max_age: float | None
+    :param max_size: Maximum total size of all caches in bytes, defaults to no limit.
+    :type max_size: int | None
+    :return: List of deleted metadata cache directories.
+    :rtype: list[str]
+    """
+    entries = []
+    deleted = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir():
+            continue
+        if entry.name.startswith('.tmp_'):
+            continue
+        manifest = _read_manifest(entry.path)
+        if manifest is None or manifest['key'] != get_metadata_cache_key(manifest['source'],
+                                                                        manifest['key']['all_variables']):
+            deleted.append(entry.path)
+            continue
+        last_access = os.stat(os.path.join(entry.path, 'manifest.json')).st_mtime
+        if max_age is not None and time.time() - last_access > max_age:
+            deleted.append(entry.path)
+            continue
+        size = sum(i.stat().st_size for i in os.scandir(entry.path) if i.is_file())
+        entries.append((last_access, size, entry.path))
+    if max_size is not None:
+        entries.sort()
+        total_size = sum(i[1] for i in entries)
+        for last_access, size, path in entries:
+            if total_size <= max_size:
+                break
+            deleted.append(path)
+            total_size -= size
+    for path in deleted:
+        shutil.rmtree(path, ignore_errors=True)
+    return deleted
+
+
+class SpectrumCache(object):
+    """
+    Least recently used cache of decoded spectrum arrays bounded by the total number of bytes held. Cached arrays are
+    marked as read-only since they are shared between callers.
+
+    :param max_bytes: Maximum number of bytes of array data to hold.
+    :type max_bytes: int
+    """
+    def __init__(self, max_bytes):
+        """
+        Constructor Method
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spectra = OrderedDict()
+
+    def __len__(self):
+        return len(self.spectra)
+
+    def __contains__(self, key):
+        return key in self.spectra
+
+    def get(self, key):
+        """
+        Get the arrays of a cached spectrum and mark it as most recently used.
+
+        :param key: Tuple of (frame, mode, profile_bins, mz_encoding, intensity_encoding).
+        :type key: tuple
+        :return: Tuple of mz_array (np.array) and intensity_array (np.array), or None if the spectrum is not cached.
+        :rtype: tuple[numpy.array] | None
+        """
+        arrays = self.spectra.get(key)
+        if arrays is None:
+            self.misses += 1
+            return None
+        self.spectra.move_to_end(key)
+        self.hits += 1
+        return arrays
+
+    def put(self, key, mz_array, intensity_array):
+        """
+        Add the arrays of a spectrum to the cache, evicting the least recently used spectra until the cache fits within
+        max_bytes. Spectra larger than max_bytes are not cached.
+
+        :param key: Tuple of (frame, mode, profile_bins, mz_encoding, intensity_encoding).
+        :type key: tuple
+        :param mz_array: Array containing m/z values.
+        :type mz_array: numpy.array
+        :param intensity_array: Array containing intensity values.
+        :type intensity_array: numpy.array
+        """
+        num_bytes = mz_array.nbytes + intensity_array.nbytes
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.spectra:
+            self._remove(key)
+        mz_array.setflags(write=False)
+        intensity_array.setflags(write=False)
+        self.spectra[key] = (mz_array, intensity_array)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            self._remove(next(iter(self.spectra)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Remove a spectrum from the cache.
+
+        :param key: Tuple of (frame, mode, profile_bins, mz_encoding, intensity_encoding).
+        :type key: tuple
+        """
+        mz_array, intensity_array = self.spectra.pop(key)
+        self.num_bytes -= mz_array.nbytes + intensity_array.nbytes
+
+    def clear(self):
+        """
+        Remove all spectra from the cache. Counters are not reset.
+        """
+        self.spectra.clear()
+        self.num_bytes = 0
+
+    def get_stats(self):
+        """
+        Get the cache counters.
+
+        :return: Dictionary of hits, misses, evictions, number of cached spectra, bytes held, and maximum bytes.
+        :rtype: dict
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spectra': len(self.spectra),
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes}
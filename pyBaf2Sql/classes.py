@@ -2,13 +2,279 @@
 # For more information see: https://github.com/gtluu/timsconvert/tree/manuscript_v1.0.0
 
 
+import logging
 import sqlite3
-import pandas as pd
+from collections import namedtuple
+from collections.abc import Mapping
+from contextlib import closing
+from functools import cached_property
+from time import perf_counter
 from pyBaf2Sql.baf import *
+from pyBaf2Sql.cache import SpectrumCache, load_metadata_cache, save_metadata_cache
+from pyBaf2Sql.imaging import SparseIonCube, find_coordinates, get_image
+from pyBaf2Sql.pool import HandlePool, get_default_handle_pool
+from pyBaf2Sql.instrumentation import Instrumentation
 from pyBaf2Sql.util import *
 from pyBaf2Sql.error import *
 
 
+BafSpectrumArrays = namedtuple('BafSpectrumArrays', ['frame', 'mz_array', 'intensity_array'])
+BafSpectrumArrays.__doc__ = """
+Lightweight record yielded by pyBaf2Sql.classes.BafData.iter_spectra() containing the frame ID and data arrays of a
+spectrum.
+"""
+
+SPECTRUM_METADATA_DTYPE = np.dtype([('frame', np.int32),
+                                    ('parent_frame', np.int32),
+                                    ('ms_level', np.int8),
+                                    ('scan_mode', np.int8),
+                                    ('polarity', 'U1'),
+                                    ('retention_time', np.float64),
+                                    ('total_ion_current', np.float64),
+                                    ('base_peak_mz', np.float64),
+                                    ('base_peak_intensity', np.float64),
+                                    ('low_mz', np.float64),
+                                    ('high_mz', np.float64),
+                                    ('target_mz', np.float64),
+                                    ('isolation_width', np.float32),
+                                    ('selected_ion_mz', np.float64),
+                                    ('charge_state', np.float32),
+                                    ('collision_energy', np.float32)])
+"""
+Packed NumPy structured dtype of the run-level spectrum metadata returned by
+pyBaf2Sql.classes.BafData.get_spectrum_metadata(). Missing integer values are -1 (parent_frame) or 0 (ms_level) and
+missing floating point values are NaN.
+"""
+
+
+KEY_COLUMNS = ('Spectrum', 'TargetSpectrum', 'Parent', 'AcquisitionKey', 'Variable', 'Segment')
+"""
+Names of analysis.sqlite columns holding IDs or references to other tables, which pyBaf2Sql.classes.read_sql_table()
+keeps as int64 alongside all columns whose names end with "Id".
+"""
+
+
+def read_sql_table(conn, name, sql_chunksize=1000, narrow_dtypes=True):
+    """
+    Read a table from an SQLite database into a pandas.DataFrame. Rows are fetched from the cursor sql_chunksize at a
+    time and written straight into preallocated numpy.array columns, so the table is only held in memory once. Integer
+    columns containing NULL values become float64 columns with NaN, columns with only NULL values or non-numeric values
+    become object columns with None, and if narrow_dtypes is True, integer value columns are stored in the smallest
+    integer dtype that holds all of their values. ID and key columns (see pyBaf2Sql.classes.KEY_COLUMNS) are always
+    int64 so that IDs can be compared and combined without overflowing.
+
+    :param conn: SQL database connection.
+    :type conn: sqlite3.Connection
+    :param name: Name of the table.
+    :type name: str
+    :param sql_chunksize: Number of rows to read from SQL database query at once.
+    :type sql_chunksize: int
+    :param narrow_dtypes: Whether to narrow integer value columns to the smallest integer dtype, defaults to True.
+    :type narrow_dtypes: bool
+    :return: Table.
+    :rtype: pandas.DataFrame
+    """
+    import pandas as pd
+    num_rows = conn.execute('SELECT COUNT(*) FROM ' + name).fetchone()[0]
+    cursor = conn.execute('SELECT * FROM ' + name)
+    column_names = [column[0] for column in cursor.description]
+    columns = [None] * len(column_names)
+    null_masks = [None] * len(column_names)
+    start = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(sql_chunksize)
+            if not rows:
+                break
+            stop = start + len(rows)
+            for index, values in enumerate(zip(*rows)):
+                columns[index], null_masks[index] = _fill_column(columns[index], null_masks[index], values, start,
+                                                                 stop, num_rows)
+            start = stop
+    finally:
+        cursor.close()
+
+    table = {}
+    for column_name, column, null_mask in zip(column_names, columns, null_masks):
+        if column is None:
+            column = np.full(start, None, dtype=object)
+        else:
+            column = column[:start]
+            if null_mask is not None and null_mask[:start].any():
+                if column.dtype.kind in 'iu':
+                    column = column.astype(np.float64)
+                column[null_mask[:start]] = np.nan if column.dtype.kind == 'f' else None
+            elif (narrow_dtypes and column.dtype.kind == 'i' and column.size != 0 and
+                  not column_name.endswith('Id') and column_name not in KEY_COLUMNS):
+                column = column.astype(np.result_type(np.min_scalar_type(int(column.min())),
+                                                      np.min_scalar_type(-int(column.max()) - 1)))
+        table[column_name] = column
+    return pd.DataFrame(table, columns=column_names, copy=False)
+
+
+def _fill_column(column, null_mask, values, start, stop, num_rows):
+    """
+    Write a chunk of values fetched from an SQLite cursor into a preallocated column, promoting the column from int64
+    to float64 or object if the chunk requires it and recording NULL values in a mask.
+
+    :param column: Preallocated column or None if no non-NULL value has been read yet.
+    :type column: numpy.array | None
+    :param null_mask: Mask of NULL values or None if no NULL value has been read yet.
+    :type null_mask: numpy.array | None
+    :param values: Values of the column in the chunk.
+    :type values: tuple
+    :param start: Row of the first value in the chunk.
+    :type start: int
+    :param stop: Row after the last value in the chunk.
+    :type stop: int
+    :param num_rows: Number of rows in the table.
+    :type num_rows: int
+    :return: Tuple of the column and the mask of NULL values.
+    :rtype: tuple
+    """
+    chunk = np.array(values)
+    if chunk.dtype.kind not in 'iuf':
+        nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        if nulls.any():
+            if null_mask is None:
+                null_mask = np.zeros(max(num_rows, stop), dtype=bool)
+            null_mask[start:stop] = nulls
+        non_null = [value for value, is_null in zip(values, nulls) if not is_null]
+        if len(non_null) == 0:
+            return column, null_mask
+        if all(isinstance(value, (int, float)) for value in non_null):
+            chunk = np.array([np.nan if is_null else value for value, is_null in zip(values, nulls)])
+            if chunk.dtype.kind == 'f' and np.array(non_null).dtype.kind == 'i':
+                chunk = np.array([0 if is_null else value for value, is_null in zip(values, nulls)])
+        else:
+            chunk = np.empty(len(values), dtype=object)
+            chunk[:] = values
+    if column is None:
+        column = np.empty(max(num_rows, stop), dtype=np.int64 if chunk.dtype.kind in 'iu' else chunk.dtype)
+    elif column.size < stop:
+        column = np.concatenate((column, np.empty(stop - column.size, dtype=column.dtype)))
+    if column.dtype.kind in 'iu' and chunk.dtype.kind not in 'iu':
+        column = column.astype(chunk.dtype if chunk.dtype.kind == 'f' else object)
+    elif column.dtype.kind == 'f' and chunk.dtype.kind == 'O':
+        column = column.astype(object)
+    if null_mask is not None and null_mask.size < stop:
+        null_mask = np.concatenate((null_mask, np.zeros(stop - null_mask.size, dtype=bool)))
+    column[start:stop] = chunk
+    return column, null_mask
+
+
+class AnalysisTables(Mapping):
+    """
+    Lazy mapping of table names found in the analysis.sqlite SQLite database to their tables. Each table is read into a
+    pandas.DataFrame the first time it is accessed, except for the Properties table, which is read into a dictionary
+    of keys and values.
+
+    :param sqlite_file_name: Path to analysis.sqlite.
+    :type sqlite_file_name: str
+    :param sql_chunksize: Number of rows to read from SQL database query at once when reading tables/views from
+        analysis.sqlite.
+    :type sql_chunksize: int
+    :param tables: Dictionary of table names to tables that have already been loaded, e.g. from a metadata cache; if
+        provided, analysis.sqlite is only opened for tables that are not in the dictionary.
+    :type tables: dict | None
+    :param instrumentation: Instrumentation to record the sql stage to when tables are read, defaults to None.
+    :type instrumentation: pyBaf2Sql.instrumentation.Instrumentation | None
+    """
+    def __init__(self, sqlite_file_name, sql_chunksize=1000, tables=None, instrumentation=None):
+        """
+        Constructor Method
+        """
+        self.sqlite_file_name = sqlite_file_name
+        self.sql_chunksize = sql_chunksize
+        self.instrumentation = instrumentation
+        if tables is not None:
+            self.tables = dict(tables)
+            self.table_names = list(self.tables.keys())
+        else:
+            self.tables = {}
+            with closing(sqlite3.connect(self.sqlite_file_name)) as conn:
+                self.table_names = [table[0]
+                                    for table in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
+                                    if table[0] != 'SupportedVariables']
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            if name not in self.table_names:
+                raise KeyError(name)
+            self.load(name)
+        return self.tables[name]
+
+    def __setitem__(self, name, table):
+        if name not in self.table_names:
+            self.table_names.append(name)
+        self.tables[name] = table
+
+    def __iter__(self):
+        return iter(self.table_names)
+
+    def __len__(self):
+        return len(self.table_names)
+
+    def is_loaded(self, name):
+        """
+        Check whether a table has already been read from analysis.sqlite.
+
+        :param name: Name of the table.
+        :type name: str
+        :return: Whether the table is loaded.
+        :rtype: bool
+        """
+        return name in self.tables
+
+    def get_columns(self, name):
+        """
+        Get the column names of a table without reading the table if it is not already loaded.
+
+        :param name: Name of the table.
+        :type name: str
+        :return: List of column names.
+        :rtype: list[str]
+        """
+        if name not in self.table_names:
+            raise KeyError(name)
+        if name in self.tables:
+            table = self.tables[name]
+            return ['Key', 'Value'] if isinstance(table, dict) else list(table.columns)
+        with closing(sqlite3.connect(self.sqlite_file_name)) as conn:
+            return [column[1] for column in conn.execute('PRAGMA table_info("' + name.replace('"', '""') + '");')]
+
+    def load(self, name, conn=None):
+        """
+        Read a table from analysis.sqlite, replacing any previously loaded copy.
+
+        :param name: Name of the table.
+        :type name: str
+        :param conn: Open SQL database connection to analysis.sqlite to read from, defaults to opening a temporary
+            connection.
+        :type conn: sqlite3.Connection | None
+        """
+        if conn is None:
+            with closing(sqlite3.connect(self.sqlite_file_name)) as conn:
+                return self.load(name, conn)
+        start = perf_counter()
+        table = read_sql_table(conn, name, self.sql_chunksize)
+        if self.instrumentation is not None:
+            self.instrumentation.record('sql', perf_counter() - start, int(table.memory_usage(index=False).sum()),
+                                        source_file=os.path.dirname(self.sqlite_file_name), table=name)
+        if name == 'Properties':
+            table = dict(zip(table['Key'], table['Value']))
+        self.tables[name] = table
+
+    def unload(self, name):
+        """
+        Release a loaded table from memory; it will be read again from analysis.sqlite on the next access.
+
+        :param name: Name of the table.
+        :type name: str
+        """
+        self.tables.pop(name, None)
+
+
 class BafData(object):
     """
     Class containing metadata from BAF files and methods from Baf2Sql library to work with BAF format data.
@@ -24,76 +290,896 @@ class BafData(object):
     :param sql_chunksize: Number of rows to read from SQL database query at once when reading tables/views from
             analysis.sqlite.
     :type sql_chunksize: int
+    :param preload_tables: Names of tables to read from analysis.sqlite when the dataset is opened; all other tables
+        are read the first time they are accessed from pyBaf2Sql.classes.BafData.analysis, defaults to no tables.
+    :type preload_tables: list[str] | tuple[str] | None
+    :param metadata_cache: Whether to store the metadata tables in a memory-mapped cache when the dataset is opened
+        for the first time and to load them from the cache instead of analysis.sqlite afterwards, defaults to False.
+        The cache is rebuilt whenever analysis.baf or analysis.sqlite change; see pyBaf2Sql.cache. The lookup indexes
+        are not cached and are rebuilt from the tables on first access. If the cache cannot be read or written, e.g.
+        in a read-only directory, a warning is logged and the dataset is opened without it.
+    :type metadata_cache: bool
+    :param metadata_cache_dir: Shared directory in which to store metadata caches, defaults to storing the cache
+        inside the .d directory.
+    :type metadata_cache_dir: str | None
+    :param spectrum_cache_size: Maximum number of bytes of spectrum arrays returned by
+        pyBaf2Sql.baf.extract_baf_spectrum() to keep in a least recently used cache, defaults to 0 (no cache).
+    :type spectrum_cache_size: int
+    :param handle_pool: Pool to lease the storage handle from, or True to use the process-wide pool from
+        pyBaf2Sql.pool.get_default_handle_pool(), defaults to opening a handle owned by this object. Datasets opened
+        from a pool share their metadata tables with other objects opened from the same pooled handle.
+    :type handle_pool: pyBaf2Sql.pool.HandlePool | bool | None
+    :param instrumentation: Instrumentation to record per-stage call counts, wall clock time, and bytes read to, or
+        True to create a new pyBaf2Sql.instrumentation.Instrumentation, defaults to None (no instrumentation).
+    :type instrumentation: pyBaf2Sql.instrumentation.Instrumentation | bool | None
+    :param reuse_sqlite_cache: Whether to use an existing analysis.sqlite found with
+        pyBaf2Sql.baf.find_sqlite_cache_filename() as is instead of having Baf2Sql check it against analysis.baf and
+        regenerate it, defaults to False. Together with the default of not preloading tables, this makes opening a
+        dataset for a single spectrum or property lookup cheap.
+    :type reuse_sqlite_cache: bool
     """
     def __init__(self, bruker_d_folder_name: str, baf2sql, raw_calibration=False, all_variables=True,
-                 sql_chunksize=1000):
+                 sql_chunksize=1000, preload_tables=(), metadata_cache=False, metadata_cache_dir=None,
+                 spectrum_cache_size=0, handle_pool=None, instrumentation=None, reuse_sqlite_cache=False):
         """
         Constructor Method
         """
         self.api = baf2sql
         self.source_file = bruker_d_folder_name
-        self.handle = open_storage(self.api, self.source_file, raw_calibration)
-        if self.handle == 0:
-            throw_last_baf2sql_error(self.api)
+        self.raw_calibration = raw_calibration
+        self.lease = None
+        self.conn = None
+        self.instrumentation = Instrumentation() if instrumentation is True else instrumentation
+        if handle_pool is True:
+            handle_pool = get_default_handle_pool()
+        start = perf_counter()
+        if isinstance(handle_pool, HandlePool):
+            self.lease = handle_pool.acquire(self.api, self.source_file, self.raw_calibration)
+            self.handle = self.lease.handle
+        else:
+            self.handle = open_storage(self.api, self.source_file, self.raw_calibration)
+            if self.handle == 0:
+                throw_last_baf2sql_error(self.api)
+        if self.instrumentation is not None:
+            self.instrumentation.record('open', perf_counter() - start, source_file=self.source_file)
         self.all_variables = all_variables
+        self.spectrum_cache = SpectrumCache(spectrum_cache_size) if spectrum_cache_size > 0 else None
+
+        if self.lease is not None and self.all_variables in self.lease.analysis:
+            self.analysis = self.lease.analysis[self.all_variables]
+            return
 
-        get_sqlite_cache_filename_v2(self.api, self.source_file, self.all_variables)
+        cached_tables = None
+        if metadata_cache:
+            try:
+                cached_tables = load_metadata_cache(self.source_file, self.all_variables, metadata_cache_dir)
+            except Exception:
+                logging.getLogger('pyBaf2Sql').warning('Unable to load the metadata cache of %s.', self.source_file,
+                                                       exc_info=True)
+        if cached_tables is not None:
+            self.analysis = AnalysisTables(os.path.join(bruker_d_folder_name, 'analysis.sqlite'), sql_chunksize,
+                                           cached_tables, self.instrumentation)
+            if self.lease is not None:
+                self.lease.analysis[self.all_variables] = self.analysis
+            return
+
+        start = perf_counter()
+        if not reuse_sqlite_cache or find_sqlite_cache_filename(self.source_file) is None:
+            get_sqlite_cache_filename_v2(self.api, self.source_file, self.all_variables)
+        if self.instrumentation is not None:
+            self.instrumentation.record('sqlite_cache', perf_counter() - start, source_file=self.source_file)
         self.conn = sqlite3.connect(os.path.join(bruker_d_folder_name, 'analysis.sqlite'))
 
-        self.analysis = None
+        self.analysis = AnalysisTables(os.path.join(bruker_d_folder_name, 'analysis.sqlite'), sql_chunksize,
+                                       instrumentation=self.instrumentation)
 
-        self.get_db_tables(sql_chunksize=sql_chunksize)
+        if metadata_cache:
+            preload_tables = None
+        if preload_tables is None or len(preload_tables) != 0:
+            self.get_db_tables(sql_chunksize=sql_chunksize, tables=preload_tables)
         self.close_sql_connection()
+        if metadata_cache:
+            try:
+                save_metadata_cache(self.analysis, self.source_file, self.all_variables, metadata_cache_dir)
+            except Exception:
+                # The dataset is still usable without a cache, e.g. if the cache directory is read-only.
+                logging.getLogger('pyBaf2Sql').warning('Unable to save the metadata cache of %s.', self.source_file,
+                                                       exc_info=True)
+        if self.lease is not None:
+            self.lease.analysis[self.all_variables] = self.analysis
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
         """
         Close connection to raw data handle.
         """
-        if hasattr(self, 'handle'):
-            close_storage(self.api, self.handle, self.conn)
+        self.close()
 
-    def get_db_tables(self, sql_chunksize=1000):
+    def close(self):
+        """
+        Close the raw data handle and the connection to analysis.sqlite, or release the lease of the handle if it was
+        opened from a pyBaf2Sql.pool.HandlePool. Closing a dataset more than once has no effect.
         """
-        Get a dictionary of all tables found in the analysis.sqlite SQLite database in which the table names act as
-        keys and the tables as a pandas.DataFrame of values; this is stored in pyBaf2Sql.classes.BafData.analysis.
+        if getattr(self, 'lease', None) is not None:
+            self.lease.release()
+            self.lease = None
+            self.handle = None
+        if getattr(self, 'handle', None):
+            self.handle = close_storage(self.api, self.handle, None)[0]
+        if getattr(self, 'conn', None) is not None:
+            self.close_sql_connection()
+            self.conn = None
+
+    def get_db_tables(self, sql_chunksize=1000, tables=None):
+        """
+        Read tables found in the analysis.sqlite SQLite database into pyBaf2Sql.classes.BafData.analysis, in which the
+        table names act as keys and the tables as a pandas.DataFrame of values. Tables that are not read here are
+        read the first time they are accessed.
 
         :param sql_chunksize: Number of rows to read from SQL database query at once when reading tables/views from
             analysis.sqlite.
         :type sql_chunksize: int
+        :param tables: Names of the tables to read, defaults to all tables.
+        :type tables: list[str] | tuple[str] | None
         """
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        table_names = cursor.fetchall()
-        table_names = [table[0] for table in table_names]
-        self.analysis = {name: pd.concat([i for i in pd.read_sql_query("SELECT * FROM " + name,
-                                                                       self.conn,
-                                                                       chunksize=sql_chunksize)],
-                                         ignore_index=True)
-                         for name in table_names if name != 'SupportedVariables'}
-        self.analysis['Variables'] = pd.concat([i for i in pd.read_sql_query('SELECT * FROM Variables',
-                                                                             self.conn,
-                                                                             chunksize=sql_chunksize)],
-                                               ignore_index=True)
-        self.analysis['Properties'] = {row['Key']: row['Value']
-                                       for index, row in self.analysis['Properties'].iterrows()}
-        cursor.close()
+        self.analysis.sql_chunksize = sql_chunksize
+        for name in (self.analysis.table_names if tables is None else tables):
+            self.analysis.load(name, self.conn)
+
+    def build_indexes(self):
+        """
+        Build all lookup indexes now rather than the first time each one is accessed. Indexes are dictionaries keyed
+        on IDs from the analysis.sqlite tables so that per-spectrum metadata can be looked up in constant time instead
+        of filtering pandas.DataFrames for every spectrum. The following indexes are available from
+        pyBaf2Sql.classes.BafData:
+
+        - spectra_index: Spectra.Id -> Spectra row
+        - acquisitionkeys_index: AcquisitionKeys.Id -> AcquisitionKeys row
+        - steps_index: Steps.TargetSpectrum -> first Steps row for that spectrum
+        - variables_index: (Variables.Spectrum, Variables.Variable) -> Variables.Value
+        """
+        for name in ('spectra_index', 'acquisitionkeys_index', 'steps_index', 'variables_index'):
+            self.__dict__.pop(name, None)
+            getattr(self, name)
+
+    @cached_property
+    def spectra_index(self):
+        """
+        Dictionary of Spectra.Id -> Spectra row.
+        """
+        return {row['Id']: row for row in self.analysis['Spectra'].to_dict(orient='records')}
+
+    @cached_property
+    def acquisitionkeys_index(self):
+        """
+        Dictionary of AcquisitionKeys.Id -> AcquisitionKeys row.
+        """
+        return {row['Id']: row for row in self.analysis['AcquisitionKeys'].to_dict(orient='records')}
+
+    @cached_property
+    def steps_index(self):
+        """
+        Dictionary of Steps.TargetSpectrum -> first Steps row for that spectrum.
+        """
+        steps_index = {}
+        for row in self.analysis['Steps'].to_dict(orient='records'):
+            steps_index.setdefault(row['TargetSpectrum'], row)
+        return steps_index
+
+    @cached_property
+    def variables_index(self):
+        """
+        Dictionary of (Variables.Spectrum, Variables.Variable) -> Variables.Value. If a variable is listed more than
+        once for a spectrum, the first value is used.
+        """
+        variables = self.analysis['Variables']
+        # Insert in reverse so that the first value wins for duplicate (Spectrum, Variable) pairs.
+        return dict(zip(zip(variables['Spectrum'].values[::-1].tolist(), variables['Variable'].values[::-1].tolist()),
+                        variables['Value'].values[::-1].tolist()))
+
+    @cached_property
+    def variables_table(self):
+        """
+        Wide view of the Variables table as a pandas.DataFrame of float64 values indexed by Variables.Spectrum in
+        ascending order with one column per Variables.Variable. Missing values are NaN. If a variable is listed more
+        than once for a spectrum, the first value is used.
+        """
+        import pandas as pd
+        variables = self.analysis['Variables']
+        values = pd.to_numeric(pd.Series(variables['Value'].values), errors='coerce').values.astype(np.float64)
+        spectra, rows = np.unique(variables['Spectrum'].values, return_inverse=True)
+        variable_ids, columns = np.unique(variables['Variable'].values, return_inverse=True)
+        matrix = np.full((spectra.size, variable_ids.size), np.nan)
+        # Assign in reverse so that the first value wins for duplicate (Spectrum, Variable) pairs.
+        matrix[rows[::-1], columns[::-1]] = values[::-1]
+        return pd.DataFrame(matrix, index=pd.Index(spectra, name='Spectrum'),
+                            columns=pd.Index(variable_ids, name='Variable'), copy=False)
+
+    def get_variable(self, frame, variable):
+        """
+        Get the value of a variable from the Variables table for a given spectrum.
+
+        :param frame: ID of the frame of interest.
+        :type frame: int
+        :param variable: ID of the variable as listed in the SupportedVariables table.
+        :type variable: int
+        :return: Variable value.
+        :rtype: float
+        """
+        try:
+            value = float(self.variables_index[(frame, variable)])
+        except (KeyError, TypeError, ValueError):
+            raise KeyError((frame, variable))
+        if np.isnan(value):
+            raise KeyError((frame, variable))
+        return float(value)
+
+    def get_variable_array(self, variable, frames=None):
+        """
+        Get the values of a variable from the Variables table for a batch of spectra as a dense array.
+
+        :param variable: ID of the variable as listed in the SupportedVariables table.
+        :type variable: int
+        :param frames: IDs of the frames of interest, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :return: Array of variable values in the same order as frames with NaN for missing values.
+        :rtype: numpy.array
+        """
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+        table = self.variables_table
+        values = np.full(frames.size, np.nan)
+        if variable not in table.columns or table.index.size == 0:
+            return values
+        spectra = table.index.values
+        rows = np.clip(np.searchsorted(spectra, frames), 0, spectra.size - 1)
+        found = spectra[rows] == frames
+        values[found] = table[variable].values[rows[found]]
+        return values
+
+    def get_spectrum_metadata(self, frames=None, mode='centroid', batch_size=1000, profile_bins=0):
+        """
+        Get the scalar metadata of all spectra as a single structured array with dtype
+        pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE, using about 90 bytes per spectrum.
+
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode used to compute the total ion current, base peak, and m/z range with
+            pyBaf2Sql.classes.BafData.get_run_summary(), either "profile", "centroid", "centroid_from_profile", or
+            "raw", or None to skip reading the data arrays and leave these fields as NaN.
+        :type mode: str | None
+        :param batch_size: Number of spectra to summarize at once.
+        :type batch_size: int
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :return: Structured array with one element per frame.
+        :rtype: numpy.array
+        """
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+        rows = self.get_spectra_rows(frames)
+        index = self._selection_index
+        metadata = np.zeros(frames.size, dtype=SPECTRUM_METADATA_DTYPE)
+        for field in SPECTRUM_METADATA_DTYPE.names:
+            if SPECTRUM_METADATA_DTYPE[field].kind == 'f':
+                metadata[field] = np.nan
+        metadata['frame'] = frames
+        metadata['parent_frame'] = -1
+        metadata['ms_level'] = index['ms_level'][rows]
+        metadata['scan_mode'] = index['scan_mode'][rows]
+        metadata['polarity'] = index['polarity'][rows]
+        metadata['retention_time'] = index['retention_time'][rows]
+
+        if mode is not None:
+            summary = self.get_run_summary(mode=mode, frames=frames, batch_size=batch_size,
+                                           profile_bins=profile_bins)
+            for field in ('total_ion_current', 'base_peak_mz', 'base_peak_intensity', 'low_mz', 'high_mz'):
+                metadata[field] = summary[field]
+
+        # Auto MS/MS and MRM MS/MS
+        precursors = self.get_precursor_table(frames)
+        is_precursor = metadata['scan_mode'] == 2
+        parent_frame = precursors['parent_frame'].values.astype(np.float64)
+        metadata['parent_frame'][is_precursor] = np.where(np.isnan(parent_frame), -1, parent_frame)
+        for field in ('target_mz', 'isolation_width', 'selected_ion_mz', 'charge_state'):
+            metadata[field][is_precursor] = precursors[field].values
+        # Auto MS/MS and MRM MS/MS, isCID MS/MS, bbCID MS/MS
+        is_msms = np.isin(metadata['scan_mode'], (2, 4, 5))
+        metadata['collision_energy'][is_msms] = self.get_variable_array(5, frames[is_msms])
+        return metadata
+
+    def get_precursor_table(self, frames=None):
+        """
+        Get precursor metadata for all Auto MS/MS and MRM MS/MS spectra (ScanMode 2) at once.
+
+        :param frames: IDs of the frames to include, defaults to all frames in ID order; frames that are not Auto
+            MS/MS or MRM MS/MS spectra are left out.
+        :type frames: list[int] | numpy.array | None
+        :return: Table with columns frame, parent_frame, target_mz, isolation_width, selected_ion_mz, charge_state,
+            and collision_energy.
+        :rtype: pandas.DataFrame
+        """
+        import pandas as pd
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+        spectra = self.analysis['Spectra']
+        acquisition_keys = self.analysis['AcquisitionKeys']
+        rows = self.get_spectra_rows(frames)
+        key_rows = self._get_acquisition_key_rows(spectra['AcquisitionKey'].values[rows])
+        frames = frames[acquisition_keys['ScanMode'].values[key_rows] == 2]
+        rows = self.get_spectra_rows(frames)
+
+        steps = self.analysis['Steps']
+        target_spectra, first_steps = np.unique(steps['TargetSpectrum'].values, return_index=True)
+        selected_ion_mz = np.full(frames.size, np.nan)
+        if target_spectra.size != 0:
+            step_rows = np.clip(np.searchsorted(target_spectra, frames), 0, target_spectra.size - 1)
+            found = target_spectra[step_rows] == frames
+            selected_ion_mz[found] = steps['Mass'].values[first_steps[step_rows[found]]]
+
+        return pd.DataFrame({'frame': frames,
+                             'parent_frame': spectra['Parent'].values[rows],
+                             'target_mz': self.get_variable_array(7, frames),
+                             'isolation_width': self.get_variable_array(8, frames),
+                             'selected_ion_mz': selected_ion_mz,
+                             'charge_state': self.get_variable_array(6, frames),
+                             'collision_energy': self.get_variable_array(5, frames)})
+
+    def iter_spectra(self, mode='centroid', frames=None, batch_size=1000, profile_bins=0, mz_encoding=64,
+                     intensity_encoding=64, copy=True, bin_edges=None):
+        """
+        Iterate over spectra from the BAF dataset, yielding a pyBaf2Sql.classes.BafSpectrumArrays record for each
+        frame. Arrays are read into buffers that are reused across spectra and grow to the size of the largest array
+        seen. By default, each record holds its own arrays. With copy=False, the arrays of a record may be views into
+        the shared buffers in every mode and are only valid until the next record is yielded, so records must be
+        consumed or copied before advancing the iterator.
+
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param frames: IDs of the frames to read in the order they should be yielded, defaults to all frames in ID
+            order.
+        :type frames: list[int] | numpy.array | None
+        :param batch_size: Number of frames for which array IDs are looked up from the Spectra table at once.
+        :type batch_size: int
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :param copy: Whether to yield arrays owned by each record instead of arrays that are only valid until the next
+            record is yielded, defaults to True.
+        :type copy: bool
+        :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+            spectra to bin profile mode spectra to instead of binning each spectrum over its own m/z range.
+        :type bin_edges: numpy.array | None
+        :return: Generator of spectrum records.
+        :rtype: collections.abc.Iterator[pyBaf2Sql.classes.BafSpectrumArrays]
+        """
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+
+        instrumentation = self.instrumentation
+        mz_buffer = ArrayBuffer(get_encoding_dtype(mz_encoding))
+        intensity_buffer = ArrayBuffer(get_encoding_dtype(intensity_encoding))
+        for start in range(0, frames.size, batch_size):
+            batch = frames[start:start + batch_size]
+            mz_ids, intensity_ids = self.get_array_ids(batch, mode)
+            for frame, mz_id, intensity_id in zip(batch.tolist(), mz_ids.tolist(), intensity_ids.tolist()):
+                read_start = perf_counter()
+                mz_array = mz_buffer.read(self.api, self.handle, int(mz_id))
+                intensity_array = intensity_buffer.read(self.api, self.handle, int(intensity_id))
+                if instrumentation is not None:
+                    instrumentation.record('ctypes', perf_counter() - read_start,
+                                           mz_array.nbytes + intensity_array.nbytes,
+                                           source_file=self.source_file, frame=frame)
+                if mode == 'profile' and (profile_bins != 0 or bin_edges is not None):
+                    bin_start = perf_counter()
+                    mz_array, intensity_array = bin_profile_spectrum(mz_array, intensity_array, profile_bins,
+                                                                     mz_encoding, bin_edges)
+                    if instrumentation is not None:
+                        instrumentation.record('binning', perf_counter() - bin_start,
+                                               mz_array.nbytes + intensity_array.nbytes,
+                                               source_file=self.source_file, frame=frame)
+                elif mode == 'centroid_from_profile':
+                    centroid_start = perf_counter()
+                    mz_array, intensity_array = centroid_profile_spectrum(mz_array, intensity_array,
+                                                                          mz_encoding=mz_encoding,
+                                                                          intensity_encoding=intensity_encoding)
+                    if instrumentation is not None:
+                        instrumentation.record('centroiding', perf_counter() - centroid_start,
+                                               mz_array.nbytes + intensity_array.nbytes,
+                                               source_file=self.source_file, frame=frame)
+                elif copy:
+                    mz_array, intensity_array = mz_array.copy(), intensity_array.copy()
+                yield BafSpectrumArrays(frame, mz_array, intensity_array)
+
+    def get_frames(self):
+        """
+        Get the IDs of all spectra in the BAF dataset.
+
+        :return: Array of frame IDs in ascending order.
+        :rtype: numpy.array
+        """
+        return np.sort(self.analysis['Spectra']['Id'].values)
+
+    def get_array_ids(self, frames, mode):
+        """
+        Look up the IDs of the m/z and intensity arrays for a batch of frames from the Spectra table.
+
+        :param frames: IDs of the frames of interest.
+        :type frames: list[int] | numpy.array
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :return: Tuple of mz_ids (np.array) and intensity_ids (np.array) in the same order as frames.
+        :rtype: tuple[numpy.array]
+        """
+        if mode == 'raw' or mode == 'centroid':
+            mz_column, intensity_column = 'LineMzId', 'LineIntensityId'
+        elif mode == 'profile' or mode == 'centroid_from_profile':
+            mz_column, intensity_column = 'ProfileMzId', 'ProfileIntensityId'
+        else:
+            raise ValueError('Unsupported mode: ' + str(mode))
+        rows = self.get_spectra_rows(frames)
+        return (self.analysis['Spectra'][mz_column].values[rows],
+                self.analysis['Spectra'][intensity_column].values[rows])
+
+    @cached_property
+    def _spectra_order(self):
+        """
+        Positions of the rows of the Spectra table sorted by Spectra.Id.
+        """
+        return np.argsort(self.analysis['Spectra']['Id'].values, kind='stable')
+
+    def get_spectra_rows(self, frames):
+        """
+        Get the positions of a batch of frames in the Spectra table.
+
+        :param frames: IDs of the frames of interest.
+        :type frames: list[int] | numpy.array
+        :return: Array of row positions in the same order as frames.
+        :rtype: numpy.array
+        """
+        frames = np.asarray(frames)
+        spectra_ids = self.analysis['Spectra']['Id'].values
+        order = self._spectra_order
+        if order.size == 0:
+            if frames.size != 0:
+                raise KeyError(int(frames.flat[0]))
+            return np.zeros(0, dtype=np.int64)
+        rows = order[np.clip(np.searchsorted(spectra_ids, frames, sorter=order), 0, order.size - 1)]
+        missing = spectra_ids[rows] != frames
+        if np.any(missing):
+            raise KeyError(int(frames[missing][0]))
+        return rows
+
+    def _get_acquisition_key_rows(self, keys):
+        """
+        Get the positions of a batch of acquisition keys in the AcquisitionKeys table.
+
+        :param keys: IDs of the acquisition keys of interest.
+        :type keys: numpy.array
+        :return: Array of row positions in the same order as keys.
+        :rtype: numpy.array
+        """
+        keys = np.asarray(keys)
+        key_ids = self.analysis['AcquisitionKeys']['Id'].values
+        if key_ids.size == 0:
+            if keys.size != 0:
+                raise KeyError(int(keys[0]))
+            return np.zeros(0, dtype=np.int64)
+        key_order = np.argsort(key_ids, kind='stable')
+        key_rows = key_order[np.clip(np.searchsorted(key_ids, keys, sorter=key_order), 0, key_order.size - 1)]
+        missing = key_ids[key_rows] != keys
+        if np.any(missing):
+            raise KeyError(int(keys[missing][0]))
+        return key_rows
+
+    @cached_property
+    def _selection_index(self):
+        """
+        Arrays aligned with the rows of the Spectra table and sorted arrays of retention times and precursor masses
+        used by pyBaf2Sql.classes.BafData.select().
+        """
+        spectra = self.analysis['Spectra']
+        acquisition_keys = self.analysis['AcquisitionKeys']
+        key_rows = self._get_acquisition_key_rows(spectra['AcquisitionKey'].values)
+        scan_mode = acquisition_keys['ScanMode'].values[key_rows].astype(np.int64)
+        # Polarity == 0 -> 'positive'; Polarity == 1 -> 'negative"?
+        polarity = np.where(acquisition_keys['Polarity'].values[key_rows] == 0, '+', '-')
+        # ScanMode == 0 -> MS1; ScanMode in (2, 4, 5) -> Auto MS/MS and MRM MS/MS, isCID MS/MS, bbCID MS/MS
+        ms_level = np.select([scan_mode == 0, np.isin(scan_mode, (2, 4, 5))], [1, 2], 0)
+        retention_time = spectra['Rt'].values.astype(np.float64) / 60
+        rt_order = np.argsort(retention_time, kind='stable')
+
+        steps = self.analysis['Steps']
+        target_spectra, first_steps = np.unique(steps['TargetSpectrum'].values, return_index=True)
+        precursor_mz = steps['Mass'].values[first_steps].astype(np.float64)
+        precursor_order = np.argsort(precursor_mz, kind='stable')
+        return {'frame': spectra['Id'].values,
+                'retention_time': retention_time,
+                'scan_mode': scan_mode,
+                'polarity': polarity,
+                'ms_level': ms_level,
+                'rt_order': rt_order,
+                'rt_sorted': retention_time[rt_order],
+                'precursor_frames': target_spectra[precursor_order],
+                'precursor_mz_sorted': precursor_mz[precursor_order]}
+
+    def select(self, rt_range=None, ms_level=None, polarity=None, scan_mode=None, precursor_mz_range=None):
+        """
+        Select the IDs of spectra matching all of the given filters. Retention time and precursor m/z ranges are
+        resolved by binary search over sorted arrays, so the cost of a narrow selection is proportional to the number
+        of spectra in the range rather than the size of the run. The returned IDs can be passed directly as frames to
+        extraction methods such as pyBaf2Sql.classes.BafData.iter_spectra().
+
+        :param rt_range: Tuple of the lower and upper retention time in minutes (inclusive).
+        :type rt_range: tuple[float] | None
+        :param ms_level: MS level or list of MS levels, where MS1 spectra are level 1 and Auto MS/MS, MRM MS/MS,
+            isCID MS/MS, and bbCID MS/MS spectra are level 2.
+        :type ms_level: int | list[int] | None
+        :param polarity: Polarity, either "+" or "-".
+        :type polarity: str | None
+        :param scan_mode: ScanMode value or list of values from the AcquisitionKeys table.
+        :type scan_mode: int | list[int] | None
+        :param precursor_mz_range: Tuple of the lower and upper precursor m/z from the Steps table (inclusive); spectra
+            without a precursor are left out.
+        :type precursor_mz_range: tuple[float] | None
+        :return: Array of frame IDs in ascending order.
+        :rtype: numpy.array
+        """
+        index = self._selection_index
+        rows = None
+        if rt_range is not None:
+            start = np.searchsorted(index['rt_sorted'], rt_range[0], side='left')
+            stop = np.searchsorted(index['rt_sorted'], rt_range[1], side='right')
+            rows = index['rt_order'][start:stop]
+        if precursor_mz_range is not None:
+            start = np.searchsorted(index['precursor_mz_sorted'], precursor_mz_range[0], side='left')
+            stop = np.searchsorted(index['precursor_mz_sorted'], precursor_mz_range[1], side='right')
+            precursor_rows = self.get_spectra_rows(index['precursor_frames'][start:stop])
+            rows = precursor_rows if rows is None else np.intersect1d(rows, precursor_rows)
+        if rows is None:
+            rows = np.arange(index['frame'].size)
+        if ms_level is not None:
+            rows = rows[np.isin(index['ms_level'][rows], ms_level)]
+        if polarity is not None:
+            rows = rows[index['polarity'][rows] == polarity]
+        if scan_mode is not None:
+            rows = rows[np.isin(index['scan_mode'][rows], scan_mode)]
+        return np.sort(index['frame'][rows])
+
+    def get_tic(self, frames=None, mode='centroid'):
+        """
+        Get the total ion chromatogram. Values are taken from the SumIntensity column of the Spectra table when it is
+        present; otherwise they are computed from the spectra in a single pass.
+
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode used when values must be computed from spectra, either "profile", "centroid",
+            or "raw".
+        :type mode: str
+        :return: Tuple of retention_time (np.array) in minutes and intensity (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        return self._get_summary_chromatogram('SumIntensity', np.sum, frames, mode)
+
+    def get_bpc(self, frames=None, mode='centroid'):
+        """
+        Get the base peak chromatogram. Values are taken from the MaxIntensity column of the Spectra table when it is
+        present; otherwise they are computed from the spectra in a single pass.
+
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode used when values must be computed from spectra, either "profile", "centroid",
+            or "raw".
+        :type mode: str
+        :return: Tuple of retention_time (np.array) in minutes and intensity (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        return self._get_summary_chromatogram('MaxIntensity', np.max, frames, mode)
+
+    def _get_summary_chromatogram(self, column, func, frames, mode):
+        """
+        Get a chromatogram from a summary column of the Spectra table or, if the column is missing or incomplete, by
+        applying func to the intensity array of each spectrum.
+
+        :param column: Name of the column in the Spectra table.
+        :type column: str
+        :param func: Function reducing an intensity array to a single value.
+        :type func: collections.abc.Callable
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :return: Tuple of retention_time (np.array) in minutes and intensity (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        if frames is None:
+            frames = self.get_frames()
+        rows = self.get_spectra_rows(frames)
+        spectra = self.analysis['Spectra']
+        retention_time = spectra['Rt'].values[rows].astype(np.float64) / 60
+        if column in spectra.columns and not spectra[column].isna().values[rows].any():
+            return retention_time, spectra[column].values[rows].astype(np.float64)
+        intensity = np.zeros(rows.size, dtype=np.float64)
+        for i, spectrum in enumerate(self.iter_spectra(mode=mode, frames=frames, copy=False)):
+            if spectrum.intensity_array.size != 0:
+                intensity[i] = func(spectrum.intensity_array)
+        return retention_time, intensity
+
+    def get_xic(self, mz_windows, frames=None, mode='centroid', batch_size=1000):
+        """
+        Get extracted ion chromatograms for a batch of m/z windows in a single pass over the spectra.
+
+        :param mz_windows: Array of shape (N, 2) containing the lower and upper m/z bound of each window (inclusive).
+        :type mz_windows: list[tuple[float]] | numpy.array
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param batch_size: Number of frames for which array IDs are looked up from the Spectra table at once.
+        :type batch_size: int
+        :return: Tuple of retention_time (np.array) in minutes with shape (M,) and intensity (np.array) with shape
+            (M, N) for M frames and N windows.
+        :rtype: tuple[numpy.array]
+        """
+        mz_windows = np.asarray(mz_windows, dtype=np.float64).reshape(-1, 2)
+        if frames is None:
+            frames = self.get_frames()
+        rows = self.get_spectra_rows(frames)
+        retention_time = self.analysis['Spectra']['Rt'].values[rows].astype(np.float64) / 60
+        intensity = np.zeros((rows.size, mz_windows.shape[0]), dtype=np.float64)
+        for i, spectrum in enumerate(self.iter_spectra(mode=mode, frames=frames, batch_size=batch_size,
+                                                       copy=False)):
+            intensity[i] = get_window_sums(spectrum.mz_array, spectrum.intensity_array, mz_windows[:, 0],
+                                           mz_windows[:, 1])
+        return retention_time, intensity
+
+    def get_run_bin_edges(self, profile_bins, mz_encoding=64):
+        """
+        Get evenly spaced bin edges spanning the acquisition m/z range of the whole run from the MzAcqRangeLower and
+        MzAcqRangeUpper columns of the Spectra table, so that all spectra can be binned onto the same bins.
+
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :return: Array of bin edges.
+        :rtype: numpy.array
+        """
+        return get_profile_bin_edges(np.nanmin(self.analysis['Spectra']['MzAcqRangeLower'].values),
+                                     np.nanmax(self.analysis['Spectra']['MzAcqRangeUpper'].values),
+                                     profile_bins,
+                                     mz_encoding)
+
+    def get_binned_matrix(self, bin_edges, frames=None, batch_size=1000, intensity_encoding=64):
+        """
+        Bin profile mode spectra onto a shared set of bins as a 2D matrix of summed intensities with one row per
+        spectrum using pyBaf2Sql.util.bin_profile_spectra().
+
+        :param bin_edges: Array of evenly spaced bin edges, e.g. from pyBaf2Sql.classes.BafData.get_run_bin_edges().
+        :type bin_edges: numpy.array
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param batch_size: Number of spectra to bin at once.
+        :type batch_size: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Matrix of binned intensities with shape (number of frames, number of bins).
+        :rtype: numpy.array
+        """
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+        matrix = np.empty((frames.size, bin_edges.size), dtype=get_encoding_dtype(intensity_encoding))
+        for start in range(0, frames.size, batch_size):
+            spectra = list(self.iter_spectra(mode='profile', frames=frames[start:start + batch_size],
+                                             batch_size=batch_size, copy=True))
+            matrix[start:start + len(spectra)] = bin_profile_spectra([i.mz_array for i in spectra],
+                                                                     [i.intensity_array for i in spectra],
+                                                                     bin_edges,
+                                                                     intensity_encoding)
+        return matrix
+
+    def get_run_summary(self, mode='centroid', frames=None, batch_size=1000, profile_bins=0):
+        """
+        Get the total ion current, base peak, and m/z range of every spectrum computed from the data arrays, processing
+        batch_size spectra at a time with pyBaf2Sql.util.get_spectra_summary().
+
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param frames: IDs of the frames to include, defaults to all frames in ID order.
+        :type frames: list[int] | numpy.array | None
+        :param batch_size: Number of spectra to summarize at once.
+        :type batch_size: int
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :return: Dictionary of frame, total_ion_current, base_peak_mz, base_peak_intensity, low_mz, and high_mz
+            arrays.
+        :rtype: dict
+        """
+        if frames is None:
+            frames = self.get_frames()
+        frames = np.asarray(frames)
+        summary = {'frame': frames}
+        columns = ('total_ion_current', 'base_peak_mz', 'base_peak_intensity', 'low_mz', 'high_mz')
+        for column in columns:
+            summary[column] = np.empty(frames.size, dtype=np.float64)
+        for start in range(0, frames.size, batch_size):
+            spectra = list(self.iter_spectra(mode=mode, frames=frames[start:start + batch_size],
+                                             batch_size=batch_size, profile_bins=profile_bins, copy=True))
+            values = get_spectra_summary([i.mz_array for i in spectra], [i.intensity_array for i in spectra])
+            for column, value in zip(columns, values):
+                summary[column][start:start + len(spectra)] = value
+        return summary
+
+    def set_coordinates(self, frames, x, y):
+        """
+        Set the raster positions of the spectra of a MALDI imaging run, e.g. when they are stored in a table layout
+        that pyBaf2Sql.imaging.find_coordinates() does not recognize or in an external file. Overrides the positions
+        detected from analysis.sqlite.
+
+        :param frames: IDs of the frames.
+        :type frames: list[int] | numpy.array
+        :param x: x positions of the frames.
+        :type x: list[int] | numpy.array
+        :param y: y positions of the frames.
+        :type y: list[int] | numpy.array
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        x = np.asarray(x, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        if not frames.size == x.size == y.size:
+            raise ValueError('frames, x, and y must have the same size.')
+        self.__dict__['_coordinates'] = (frames, x, y)
+        self.__dict__.pop('coordinate_index', None)
+
+    @cached_property
+    def coordinate_index(self):
+        """
+        Index of frame IDs to (x, y) raster positions from pyBaf2Sql.classes.BafData.set_coordinates() or detected
+        from analysis.sqlite with pyBaf2Sql.imaging.find_coordinates(), or None if the run has no raster positions.
+
+        :return: Dictionary of frame IDs to tuples of x and y positions, or None.
+        :rtype: dict | None
+        """
+        coordinates = self.__dict__.get('_coordinates')
+        if coordinates is None:
+            coordinates = find_coordinates(self.analysis)
+        if coordinates is None:
+            return None
+        frames, x, y = coordinates
+        return dict(zip(frames.tolist(), zip(x.tolist(), y.tolist())))
+
+    def get_coordinate(self, frame):
+        """
+        Get the raster position of a spectrum from a MALDI imaging run.
+
+        :param frame: ID of the frame.
+        :type frame: int
+        :return: Tuple of x and y positions, or None if the frame has no raster position.
+        :rtype: tuple[int] | None
+        """
+        if self.coordinate_index is None:
+            return None
+        return self.coordinate_index.get(int(frame))
+
+    def get_coordinates(self, frames=None):
+        """
+        Get the raster positions of the spectra of a MALDI imaging run.
+
+        :param frames: IDs of the frames to include, defaults to all frames with a raster position in ID order.
+        :type frames: list[int] | numpy.array | None
+        :return: Tuple of frames (np.array), x (np.array), and y (np.array) positions.
+        :rtype: tuple[numpy.array]
+        """
+        if self.coordinate_index is None:
+            raise ValueError('No raster positions found for ' + self.source_file + '; use set_coordinates() to set '
+                             'them.')
+        if frames is None:
+            frames = np.array(sorted(self.coordinate_index.keys()), dtype=np.int64)
+        frames = np.asarray(frames, dtype=np.int64)
+        try:
+            positions = np.array([self.coordinate_index[frame] for frame in frames.tolist()],
+                                 dtype=np.int64).reshape(-1, 2)
+        except KeyError as error:
+            raise KeyError('Frame ' + str(error.args[0]) + ' has no raster position.') from None
+        return frames, positions[:, 0], positions[:, 1]
+
+    def get_ion_images(self, mz_windows, frames=None, mode='centroid', batch_size=1000):
+        """
+        Get dense ion images for a batch of m/z windows from a MALDI imaging run in a single pass over the spectra.
+        Pixel [i, j] of each image holds position y = min(y) + i and x = min(x) + j; pixels that were not acquired
+        are 0.
+
+        :param mz_windows: Array of shape (N, 2) containing the lower and upper m/z bound of each window (inclusive).
+        :type mz_windows: list[tuple[float]] | numpy.array
+        :param frames: IDs of the frames to include, defaults to all frames with a raster position.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param batch_size: Number of frames for which array IDs are looked up from the Spectra table at once.
+        :type batch_size: int
+        :return: Images of summed intensities with shape (N, height, width).
+        :rtype: numpy.array
+        """
+        frames, x, y = self.get_coordinates(frames)
+        intensity = self.get_xic(mz_windows, frames, mode, batch_size)[1]
+        return get_image(intensity, x, y)
+
+    def get_ion_cube(self, bin_edges, frames=None, mode='profile', batch_size=1000, intensity_encoding=64):
+        """
+        Bin the spectra of a MALDI imaging run onto a shared set of bins as a sparse ion cube in a single pass over
+        the spectra, processing batch_size spectra at a time with pyBaf2Sql.util.bin_spectra_sparse(). Only non-zero
+        bins are kept in memory.
+
+        :param bin_edges: Array of evenly spaced bin edges, e.g. from pyBaf2Sql.classes.BafData.get_run_bin_edges().
+        :type bin_edges: numpy.array
+        :param frames: IDs of the frames to include, defaults to all frames with a raster position.
+        :type frames: list[int] | numpy.array | None
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param batch_size: Number of spectra to bin at once.
+        :type batch_size: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Sparse ion cube with one row per pixel and one column per bin.
+        :rtype: pyBaf2Sql.imaging.SparseIonCube
+        """
+        frames, x, y = self.get_coordinates(frames)
+        indptr = [np.zeros(1, dtype=np.int64)]
+        indices = []
+        data = []
+        num_values = 0
+        for start in range(0, frames.size, batch_size):
+            spectra = list(self.iter_spectra(mode=mode, frames=frames[start:start + batch_size],
+                                             batch_size=batch_size, copy=True))
+            batch_indptr, batch_indices, batch_data = bin_spectra_sparse([i.mz_array for i in spectra],
+                                                                         [i.intensity_array for i in spectra],
+                                                                         bin_edges,
+                                                                         intensity_encoding)
+            indptr.append(batch_indptr[1:] + num_values)
+            indices.append(batch_indices)
+            data.append(batch_data)
+            num_values += batch_data.size
+        if not data:
+            indices.append(np.zeros(0, dtype=np.int64))
+            data.append(np.zeros(0, dtype=get_encoding_dtype(intensity_encoding)))
+        return SparseIonCube(np.concatenate(indptr),
+                             np.concatenate(indices),
+                             np.concatenate(data),
+                             frames,
+                             x,
+                             y,
+                             bin_edges)
 
     def close_sql_connection(self):
         """
         Close the connection to analysis.sqlite.
         """
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.close()
 
 
-class BafSpectrum(object):
+class BafSpectrumRecord(object):
     """
-    Class for parsing and storing spectrum metadata and data arrays from BAF format data.
+    Slotted record of the metadata and data arrays of a spectrum from BAF format data. Unlike
+    pyBaf2Sql.classes.BafSpectrum, records have no per-instance dictionary and do not keep a reference to the BafData
+    object they were read from.
 
-    :param baf_data: BafData object containing metadata from analysis.sqlite database.
-    :type baf_data: pyBaf2Sql.classes.BafData
     :param frame: ID of the frame of interest.
     :type frame: int
-    :param mode: Data array mode, either "profile", "centroid", or "raw".
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
     :type mode: str
     :param profile_bins: Number of bins to bin spectrum to.
     :type profile_bins: int
@@ -102,12 +1188,17 @@ class BafSpectrum(object):
     :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
     :type intensity_encoding: int
     """
+    __slots__ = ('scan_number', 'scan_type', 'ms_level', 'mz_array', 'intensity_array', 'mobility_array', 'polarity',
+                 'centroided', 'retention_time', 'coord', 'total_ion_current', 'base_peak_mz', 'base_peak_intensity',
+                 'high_mz', 'low_mz', 'target_mz', 'isolation_lower_offset', 'isolation_upper_offset',
+                 'selected_ion_mz', 'selected_ion_intensity', 'selected_ion_mobility', 'selected_ion_ccs',
+                 'charge_state', 'activation', 'collision_energy', 'frame', 'parent_frame', 'parent_scan',
+                 'ms2_no_precursor', 'mode', 'profile_bins', 'mz_encoding', 'intensity_encoding')
 
-    def __init__(self, baf_data, frame: int, mode: str, profile_bins=0, mz_encoding=64, intensity_encoding=64):
+    def __init__(self, frame: int, mode: str, profile_bins=0, mz_encoding=64, intensity_encoding=64):
         """
         Constructor Method
         """
-        self.baf_data = baf_data
         self.scan_number = None
         self.scan_type = None
         self.ms_level = None
@@ -142,13 +1233,40 @@ class BafSpectrum(object):
         self.mz_encoding = mz_encoding
         self.intensity_encoding = intensity_encoding
 
-        self.get_baf_data()
+    @classmethod
+    def from_baf_data(cls, baf_data, frame: int, mode: str, profile_bins=0, mz_encoding=64, intensity_encoding=64):
+        """
+        Read a spectrum record from a BAF dataset.
 
-    def get_baf_data(self):
-        frames_dict = self.baf_data.analysis['Spectra'][self.baf_data.analysis['Spectra']['Id'] ==
-                                                        self.frame].to_dict(orient='records')[0]
-        acquisitionkey_dict = self.baf_data.analysis['AcquisitionKeys'][self.baf_data.analysis['AcquisitionKeys']['Id'] ==
-                                                                        frames_dict['AcquisitionKey']].to_dict(orient='records')[0]
+        :param baf_data: BafData object containing metadata from analysis.sqlite database.
+        :type baf_data: pyBaf2Sql.classes.BafData
+        :param frame: ID of the frame of interest.
+        :type frame: int
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :return: Spectrum record.
+        :rtype: pyBaf2Sql.classes.BafSpectrumRecord
+        """
+        record = cls(frame, mode, profile_bins, mz_encoding, intensity_encoding)
+        record.get_baf_data(baf_data)
+        return record
+
+    def get_baf_data(self, baf_data):
+        """
+        Read the metadata and data arrays of the spectrum from a BAF dataset.
+
+        :param baf_data: BafData object containing metadata from analysis.sqlite database.
+        :type baf_data: pyBaf2Sql.classes.BafData
+        """
+        start = perf_counter()
+        frames_dict = baf_data.spectra_index[self.frame]
+        acquisitionkey_dict = baf_data.acquisitionkeys_index[frames_dict['AcquisitionKey']]
         # Polarity == 0 -> 'positive'; Polarity == 1 -> 'negative"?
         if int(acquisitionkey_dict['Polarity']) == 0:
             self.polarity = '+'
@@ -156,7 +1274,9 @@ class BafSpectrum(object):
             self.polarity = '-'
         self.centroided = get_centroid_status(self.mode)
         self.retention_time = float(frames_dict['Rt']) / 60
-        self.mz_array, self.intensity_array = extract_baf_spectrum(self.baf_data,
+        self.coord = baf_data.get_coordinate(self.frame)
+        lookup_seconds = perf_counter() - start
+        self.mz_array, self.intensity_array = extract_baf_spectrum(baf_data,
                                                                    self.frame,
                                                                    self.mode,
                                                                    self.profile_bins,
@@ -165,33 +1285,25 @@ class BafSpectrum(object):
         if self.mz_array is not None and self.intensity_array is not None and \
                 self.mz_array.size != 0 and self.intensity_array.size != 0 and \
                 self.mz_array.size == self.intensity_array.size:
-            self.total_ion_current = sum(self.intensity_array)
-            base_peak_index = np.where(self.intensity_array == np.max(self.intensity_array))
-            self.base_peak_mz = self.mz_array[base_peak_index][0].astype(float)
-            self.base_peak_intensity = self.intensity_array[base_peak_index][0].astype(float)
-            self.high_mz = float(max(self.mz_array))
-            self.low_mz = float(min(self.mz_array))
+            self.total_ion_current, self.base_peak_mz, self.base_peak_intensity, self.low_mz, self.high_mz = \
+                get_spectrum_summary(self.mz_array, self.intensity_array)
+            start = perf_counter()
             # MS1
             if int(acquisitionkey_dict['ScanMode']) == 0:
                 self.scan_type = 'MS1 spectrum'
                 self.ms_level = 1
             # Auto MS/MS and MRM MS/MS
             elif int(acquisitionkey_dict['ScanMode']) == 2:
-                steps_dict = self.baf_data.analysis['Steps'][self.baf_data.analysis['Steps']['TargetSpectrum'] ==
-                                                             self.frame].to_dict(orient='records')[0]
+                steps_dict = baf_data.steps_index[self.frame]
                 self.scan_type = 'MSn spectrum'
                 self.ms_level = 2
-                self.target_mz = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                           (self.baf_data.analysis['Variables']['Variable'] == 7)].to_dict(orient='records')[0]['Value'])
-                isolation_width = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                            (self.baf_data.analysis['Variables']['Variable'] == 8)].to_dict(orient='records')[0]['Value'])
+                self.target_mz = baf_data.get_variable(self.frame, 7)
+                isolation_width = baf_data.get_variable(self.frame, 8)
                 self.isolation_lower_offset = isolation_width / 2
                 self.isolation_upper_offset = isolation_width / 2
                 self.selected_ion_mz = float(steps_dict['Mass'])
-                self.charge_state = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                              (self.baf_data.analysis['Variables']['Variable'] == 6)].to_dict(orient='records')[0]['Value'])
-                self.collision_energy = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                                  (self.baf_data.analysis['Variables']['Variable'] == 5)].to_dict(orient='records')[0]['Value'])
+                self.charge_state = baf_data.get_variable(self.frame, 6)
+                self.collision_energy = baf_data.get_variable(self.frame, 5)
                 self.activation = 'collision-induced dissociation'
                 self.parent_frame = int(frames_dict['Parent'])
             # isCID MS/MS
@@ -199,14 +1311,54 @@ class BafSpectrum(object):
                 self.scan_type = 'MSn spectrum'
                 self.ms_level = 2
                 self.activation = 'in-source collision-induced dissociation'
-                self.collision_energy = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                                  (self.baf_data.analysis['Variables']['Variable'] == 5)].to_dict(orient='records')[0]['Value'])
+                self.collision_energy = baf_data.get_variable(self.frame, 5)
                 self.ms2_no_precursor = True
             # bbCID MS/MS
             elif int(acquisitionkey_dict['ScanMode']) == 5:
                 self.scan_type = 'MSn spectrum'
                 self.ms_level = 2
                 self.activation = 'collision-induced dissociation'
-                self.collision_energy = float(self.baf_data.analysis['Variables'][(self.baf_data.analysis['Variables']['Spectrum'] == self.frame) &
-                                                                                  (self.baf_data.analysis['Variables']['Variable'] == 5)].to_dict(orient='records')[0]['Value'])
+                self.collision_energy = baf_data.get_variable(self.frame, 5)
                 self.ms2_no_precursor = True
+            lookup_seconds += perf_counter() - start
+        instrumentation = getattr(baf_data, 'instrumentation', None)
+        if instrumentation is not None:
+            instrumentation.record('lookup', lookup_seconds, source_file=baf_data.source_file, frame=self.frame)
+
+
+class BafSpectrum(BafSpectrumRecord):
+    """
+    Class for parsing and storing spectrum metadata and data arrays from BAF format data.
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param frame: ID of the frame of interest.
+    :type frame: int
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    """
+
+    def __init__(self, baf_data, frame: int, mode: str, profile_bins=0, mz_encoding=64, intensity_encoding=64):
+        """
+        Constructor Method
+        """
+        self.baf_data = baf_data
+        super().__init__(frame, mode, profile_bins, mz_encoding, intensity_encoding)
+
+        self.get_baf_data()
+
+    def get_baf_data(self, baf_data=None):
+        """
+        Read the metadata and data arrays of the spectrum from a BAF dataset.
+
+        :param baf_data: BafData object containing metadata from analysis.sqlite database, defaults to the BafData
+            object this spectrum was created with.
+        :type baf_data: pyBaf2Sql.classes.BafData | None
+        """
+        super().get_baf_data(self.baf_data if baf_data is None else baf_data)
@@ -0,0 +1,461 @@
+import importlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pyBaf2Sql.classes import SPECTRUM_METADATA_DTYPE
+from pyBaf2Sql.parallel import iter_spectra_parallel
+from pyBaf2Sql.util import get_encoding_dtype, get_spectra_summary
+
+
+EXPORT_FORMATS = {'parquet': ('.parquet', '.pq'),
+                  'hdf5': ('.h5', '.hdf5', '.hdf'),
+                  'zarr': ('.zarr',)}
+EXPORT_LAYOUT_VERSION = 1
+DEFAULT_COMPRESSION = {'parquet': 'zstd', 'hdf5': 'gzip', 'zarr': 'zstd'}
+
+
+def _import_optional(module_name, extra):
+    """
+    Import an optional dependency.
+
+    :param module_name: Name of the module.
+    :type module_name: str
+    :param extra: Name of the pyBaf2Sql extra that installs the module.
+    :type extra: str
+    :return: Module.
+    :rtype: module
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as error:
+        raise ImportError(module_name + ' is required to export to ' + extra + '; install it with pip install '
+                          'pyBaf2Sql[' + extra + '].') from error
+
+
+def get_export_format(file_name):
+    """
+    Infer the export format from the extension of the output file name.
+
+    :param file_name: Path of the output file or directory.
+    :type file_name: str
+    :return: Export format, either "parquet", "hdf5", or "zarr".
+    :rtype: str
+    """
+    extension = os.path.splitext(file_name.rstrip('/\\'))[1].lower()
+    for export_format, extensions in EXPORT_FORMATS.items():
+        if extension in extensions:
+            return export_format
+    raise ValueError('Unable to infer export format from file name ' + file_name + '; use one of the extensions ' +
+                     ', '.join(i for extensions in EXPORT_FORMATS.values() for i in extensions) + ' or pass '
+                     'export_format.')
+
+
+def _get_polarity_codes(polarity):
+    """
+    Convert polarity strings to int8 codes for HDF5 and Zarr.
+
+    :param polarity: Array of polarity strings.
+    :type polarity: numpy.array
+    :return: Array with 1 for "+", -1 for "-", and 0 otherwise.
+    :rtype: numpy.array
+    """
+    return np.select([polarity == '+', polarity == '-'], [1, -1], 0).astype(np.int8)
+
+
+class ParquetSpectrumWriter(object):
+    """
+    Writer of spectrum chunks to a Parquet file with pyarrow. The file has one row per spectrum with the metadata
+    columns and list<float> mz and intensity columns, which Arrow stores as flat value arrays with offsets. Each chunk
+    of spectra is written as one row group, and the export settings are stored in the schema metadata.
+
+    :param file_name: Path of the output file.
+    :type file_name: str
+    :param mz_dtype: Numpy dtype of the m/z arrays.
+    :type mz_dtype: numpy.dtype
+    :param intensity_dtype: Numpy dtype of the intensity arrays.
+    :type intensity_dtype: numpy.dtype
+    :param attributes: Export settings stored in the schema metadata.
+    :type attributes: dict
+    :param compression: Parquet compression codec, e.g. "zstd", "snappy", "gzip", or None.
+    :type compression: str | None
+    """
+    def __init__(self, file_name, mz_dtype, intensity_dtype, attributes, compression='zstd'):
+        """
+        Constructor Method
+        """
+        self.pa = _import_optional('pyarrow', 'parquet')
+        self.pq = _import_optional('pyarrow.parquet', 'parquet')
+        fields = [self.pa.field(name, self.pa.from_numpy_dtype(SPECTRUM_METADATA_DTYPE[name])
+                                if name != 'polarity' else self.pa.string())
+                  for name in SPECTRUM_METADATA_DTYPE.names]
+        fields.append(self.pa.field('mz', self.pa.large_list(self.pa.from_numpy_dtype(mz_dtype))))
+        fields.append(self.pa.field('intensity', self.pa.large_list(self.pa.from_numpy_dtype(intensity_dtype))))
+        self.schema = self.pa.schema(fields, metadata={'pyBaf2Sql.' + key: str(value)
+                                                       for key, value in attributes.items()})
+        self.writer = self.pq.ParquetWriter(file_name, self.schema, compression=compression or 'none')
+
+    def write(self, metadata, mz_array, intensity_array, offsets):
+        """
+        Write a chunk of spectra as one row group.
+
+        :param metadata: Structured array of spectrum metadata with dtype pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE.
+        :type metadata: numpy.array
+        :param mz_array: Concatenated m/z arrays of the chunk.
+        :type mz_array: numpy.array
+        :param intensity_array: Concatenated intensity arrays of the chunk.
+        :type intensity_array: numpy.array
+        :param offsets: Offsets of the spectra in the concatenated arrays, starting at 0.
+        :type offsets: numpy.array
+        """
+        offsets = self.pa.array(offsets, type=self.pa.int64())
+        columns = [self.pa.array(metadata[name]) for name in SPECTRUM_METADATA_DTYPE.names]
+        columns.append(self.pa.LargeListArray.from_arrays(offsets, self.pa.array(mz_array)))
+        columns.append(self.pa.LargeListArray.from_arrays(offsets, self.pa.array(intensity_array)))
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        """
+        Finish the Parquet file.
+        """
+        self.writer.close()
+
+
+class HDF5SpectrumWriter(object):
+    """
+    Writer of spectrum chunks to resizable chunked datasets in an HDF5 file with h5py. The file holds datasets mz,
+    intensity, and offsets and a metadata group with one dataset per field, with polarity stored as int8 with 1 for
+    "+", -1 for "-", and 0 if unknown. The export settings are stored as file attributes.
+
+    :param file_name: Path of the output file.
+    :type file_name: str
+    :param mz_dtype: Numpy dtype of the m/z arrays.
+    :type mz_dtype: numpy.dtype
+    :param intensity_dtype: Numpy dtype of the intensity arrays.
+    :type intensity_dtype: numpy.dtype
+    :param attributes: Export settings stored as file attributes.
+    :type attributes: dict
+    :param compression: HDF5 compression filter, e.g. "gzip" or "lzf", or None.
+    :type compression: str | None
+    :param chunk_elements: Number of elements per HDF5 chunk of the m/z and intensity datasets.
+    :type chunk_elements: int
+    """
+    def __init__(self, file_name, mz_dtype, intensity_dtype, attributes, compression='gzip', chunk_elements=2 ** 18):
+        """
+        Constructor Method
+        """
+        h5py = _import_optional('h5py', 'hdf5')
+        self.file = h5py.File(file_name, 'w')
+        self.file.attrs.update(attributes)
+        self.datasets = {}
+        for name, dtype, chunks in (('mz', mz_dtype, chunk_elements),
+                                    ('intensity', intensity_dtype, chunk_elements),
+                                    ('offsets', np.int64, 2 ** 14)):
+            self.datasets[name] = self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                           chunks=(chunks,), compression=compression)
+        self.datasets['offsets'].resize((1,))
+        self.datasets['offsets'][0] = 0
+        group = self.file.create_group('metadata')
+        for name in SPECTRUM_METADATA_DTYPE.names:
+            dtype = np.int8 if name == 'polarity' else SPECTRUM_METADATA_DTYPE[name]
+            self.datasets['metadata/' + name] = group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                                     chunks=(2 ** 14,), compression=compression)
+
+    def _append(self, name, array):
+        """
+        Append an array to a dataset.
+
+        :param name: Name of the dataset.
+        :type name: str
+        :param array: Array to append.
+        :type array: numpy.array
+        """
+        dataset = self.datasets[name]
+        start = dataset.shape[0]
+        dataset.resize((start + array.size,))
+        dataset[start:] = array
+
+    def write(self, metadata, mz_array, intensity_array, offsets):
+        """
+        Append a chunk of spectra.
+
+        :param metadata: Structured array of spectrum metadata with dtype pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE.
+        :type metadata: numpy.array
+        :param mz_array: Concatenated m/z arrays of the chunk.
+        :type mz_array: numpy.array
+        :param intensity_array: Concatenated intensity arrays of the chunk.
+        :type intensity_array: numpy.array
+        :param offsets: Offsets of the spectra in the concatenated arrays, starting at 0.
+        :type offsets: numpy.array
+        """
+        self._append('offsets', offsets[1:] + self.datasets['mz'].shape[0])
+        self._append('mz', mz_array)
+        self._append('intensity', intensity_array)
+        for name in SPECTRUM_METADATA_DTYPE.names:
+            column = _get_polarity_codes(metadata[name]) if name == 'polarity' else metadata[name]
+            self._append('metadata/' + name, column)
+
+    def close(self):
+        """
+        Close the HDF5 file.
+        """
+        self.file.close()
+
+
+class ZarrSpectrumWriter(object):
+    """
+    Writer of spectrum chunks to a Zarr group with zarr-python. The group holds arrays mz, intensity, and offsets and
+    a metadata group with one array per field, with polarity stored as int8 with 1 for "+", -1 for "-", and 0 if
+    unknown. The export settings are stored as group attributes.
+
+    :param file_name: Path of the output directory.
+    :type file_name: str
+    :param mz_dtype: Numpy dtype of the m/z arrays.
+    :type mz_dtype: numpy.dtype
+    :param intensity_dtype: Numpy dtype of the intensity arrays.
+    :type intensity_dtype: numpy.dtype
+    :param attributes: Export settings stored as group attributes.
+    :type attributes: dict
+    :param compression: Compression codec, either "zstd", "blosc", "gzip", or None.
+    :type compression: str | None
+    :param chunk_elements: Number of elements per Zarr chunk of the m/z and intensity arrays.
+    :type chunk_elements: int
+    """
+    def __init__(self, file_name, mz_dtype, intensity_dtype, attributes, compression='zstd', chunk_elements=2 ** 18):
+        """
+        Constructor Method
+        """
+        self.zarr = _import_optional('zarr', 'zarr')
+        self.group = self.zarr.open_group(file_name, mode='w')
+        self.group.attrs.update(attributes)
+        self.compression = compression
+        self.arrays = {}
+        for name, dtype, chunks in (('mz', mz_dtype, chunk_elements),
+                                    ('intensity', intensity_dtype, chunk_elements),
+                                    ('offsets', np.int64, 2 ** 14)):
+            self.arrays[name] = self._create_array(self.group, name, dtype, chunks)
+        self.arrays['offsets'].append(np.zeros(1, dtype=np.int64))
+        metadata_group = self.group.create_group('metadata')
+        for name in SPECTRUM_METADATA_DTYPE.names:
+            dtype = np.int8 if name == 'polarity' else SPECTRUM_METADATA_DTYPE[name]
+            self.arrays['metadata/' + name] = self._create_array(metadata_group, name, dtype, 2 ** 14)
+        self.num_elements = 0
+
+    def _create_array(self, group, name, dtype, chunks):
+        """
+        Create an empty one-dimensional array with the zarr-python 3 API, or the zarr-python 2 API if it is not
+        available.
+
+        :param group: Group to create the array in.
+        :type group: zarr.Group
+        :param name: Name of the array.
+        :type name: str
+        :param dtype: Numpy dtype of the array.
+        :type dtype: numpy.dtype
+        :param chunks: Number of elements per chunk.
+        :type chunks: int
+        :return: Array.
+        :rtype: zarr.Array
+        """
+        if hasattr(group, 'create_array'):
+            codecs = self.zarr.codecs
+            compressors = {'zstd': codecs.ZstdCodec(),
+                           'blosc': codecs.BloscCodec(cname='zstd'),
+                           'gzip': codecs.GzipCodec(),
+                           None: None}[self.compression]
+            return group.create_array(name, shape=(0,), dtype=dtype, chunks=(chunks,), compressors=compressors)
+        numcodecs = _import_optional('numcodecs', 'zarr')
+        compressor = {'zstd': numcodecs.Zstd(),
+                      'blosc': numcodecs.Blosc(cname='zstd'),
+                      'gzip': numcodecs.GZip(),
+                      None: None}[self.compression]
+        return group.create_dataset(name, shape=(0,), dtype=dtype, chunks=(chunks,), compressor=compressor)
+
+    def write(self, metadata, mz_array, intensity_array, offsets):
+        """
+        Append a chunk of spectra.
+
+        :param metadata: Structured array of spectrum metadata with dtype pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE.
+        :type metadata: numpy.array
+        :param mz_array: Concatenated m/z arrays of the chunk.
+        :type mz_array: numpy.array
+        :param intensity_array: Concatenated intensity arrays of the chunk.
+        :type intensity_array: numpy.array
+        :param offsets: Offsets of the spectra in the concatenated arrays, starting at 0.
+        :type offsets: numpy.array
+        """
+        self.arrays['offsets'].append(offsets[1:] + self.num_elements)
+        self.arrays['mz'].append(mz_array)
+        self.arrays['intensity'].append(intensity_array)
+        self.num_elements += mz_array.size
+        for name in SPECTRUM_METADATA_DTYPE.names:
+            column = _get_polarity_codes(metadata[name]) if name == 'polarity' else metadata[name]
+            self.arrays['metadata/' + name].append(column)
+
+    def close(self):
+        """
+        Finish the Zarr group. Arrays are written as they are appended, so there is nothing left to flush.
+        """
+        pass
+
+
+SPECTRUM_WRITERS = {'parquet': ParquetSpectrumWriter,
+                    'hdf5': HDF5SpectrumWriter,
+                    'zarr': ZarrSpectrumWriter}
+
+
+def iter_spectrum_chunks(baf_data, mode='centroid', frames=None, chunk_size=10000, profile_bins=0, mz_encoding=64,
+                         intensity_encoding=64, bin_edges=None, num_workers=0, worker_chunk_size=100):
+    """
+    Iterate over the spectra of a BAF run in chunks of concatenated arrays and metadata. The total ion current, base
+    peak, and m/z range fields of the metadata are computed from the arrays of each chunk.
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param frames: IDs of the frames to export in the order they should be written, defaults to all frames in ID
+        order.
+    :type frames: list[int] | numpy.array | None
+    :param chunk_size: Number of spectra per chunk.
+    :type chunk_size: int
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :param num_workers: Number of worker processes to read spectra with pyBaf2Sql.parallel.iter_spectra_parallel(),
+        defaults to 0 (read in the current process).
+    :type num_workers: int
+    :param worker_chunk_size: Number of spectra read by a worker per task.
+    :type worker_chunk_size: int
+    :return: Generator of tuples of metadata, mz_array, intensity_array, and offsets starting at 0.
+    :rtype: collections.abc.Iterator[tuple]
+    """
+    if frames is None:
+        frames = baf_data.get_frames()
+    frames = np.asarray(frames)
+    metadata = baf_data.get_spectrum_metadata(frames, mode=None)
+    if num_workers > 1:
+        spectra = iter_spectra_parallel(baf_data, mode=mode, frames=frames, num_workers=num_workers,
+                                        chunk_size=worker_chunk_size, profile_bins=profile_bins,
+                                        mz_encoding=mz_encoding, intensity_encoding=intensity_encoding,
+                                        bin_edges=bin_edges)
+    else:
+        spectra = baf_data.iter_spectra(mode=mode, frames=frames, profile_bins=profile_bins, mz_encoding=mz_encoding,
+                                        intensity_encoding=intensity_encoding, copy=True, bin_edges=bin_edges)
+    mz_dtype = get_encoding_dtype(mz_encoding)
+    intensity_dtype = get_encoding_dtype(intensity_encoding)
+    for start in range(0, frames.size, chunk_size):
+        chunk_metadata = metadata[start:start + chunk_size].copy()
+        mz_arrays = []
+        intensity_arrays = []
+        for _ in range(chunk_metadata.size):
+            spectrum = next(spectra)
+            mz_arrays.append(spectrum.mz_array)
+            intensity_arrays.append(spectrum.intensity_array)
+        offsets = np.zeros(chunk_metadata.size + 1, dtype=np.int64)
+        np.cumsum([i.size for i in mz_arrays], out=offsets[1:])
+        mz_array = np.concatenate(mz_arrays + [np.empty(0, dtype=mz_dtype)]).astype(mz_dtype, copy=False)
+        intensity_array = np.concatenate(intensity_arrays +
+                                         [np.empty(0, dtype=intensity_dtype)]).astype(intensity_dtype, copy=False)
+        del mz_arrays, intensity_arrays
+        for field, values in zip(('total_ion_current', 'base_peak_mz', 'base_peak_intensity', 'low_mz', 'high_mz'),
+                                 get_spectra_summary(mz_array, intensity_array, offsets)):
+            chunk_metadata[field] = values
+        yield chunk_metadata, mz_array, intensity_array, offsets
+
+
+def export_spectra(baf_data, file_name, export_format=None, mode='centroid', frames=None, chunk_size=10000,
+                   profile_bins=0, mz_encoding=64, intensity_encoding=64, bin_edges=None, compression='default',
+                   num_workers=0, worker_chunk_size=100, background_write=True):
+    """
+    Export the spectra of a BAF run to Parquet, HDF5, or Zarr in a ragged columnar layout. In all formats, the m/z and
+    intensity arrays of all spectra are concatenated into two flat arrays, spectrum i spans offsets[i]:offsets[i + 1],
+    and a metadata table holds one row per spectrum with the fields of pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE; see
+    pyBaf2Sql.export.ParquetSpectrumWriter, pyBaf2Sql.export.HDF5SpectrumWriter, and
+    pyBaf2Sql.export.ZarrSpectrumWriter for the layout of each format. Spectra are read and written chunk_size spectra
+    at a time, so memory use is bounded by the size of two chunks regardless of the run length.
+
+    pyarrow, h5py, and zarr are optional dependencies that are only imported when exporting to the matching format.
+    They can be installed with the "parquet", "hdf5", and "zarr" extras, e.g. pip install pyBaf2Sql[parquet].
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param file_name: Path of the output file, or directory for Zarr.
+    :type file_name: str
+    :param export_format: Export format, either "parquet", "hdf5", or "zarr", defaults to inferring the format from
+        the extension of file_name.
+    :type export_format: str | None
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param frames: IDs of the frames to export in the order they should be written, defaults to all frames in ID
+        order.
+    :type frames: list[int] | numpy.array | None
+    :param chunk_size: Number of spectra per chunk, i.e. per Parquet row group.
+    :type chunk_size: int
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :param compression: Compression codec of the chosen format, None to disable compression, or "default" to use
+        pyBaf2Sql.export.DEFAULT_COMPRESSION.
+    :type compression: str | None
+    :param num_workers: Number of worker processes to read spectra with pyBaf2Sql.parallel.iter_spectra_parallel(),
+        defaults to 0 (read in the current process).
+    :type num_workers: int
+    :param worker_chunk_size: Number of spectra read by a worker per task.
+    :type worker_chunk_size: int
+    :param background_write: Whether to compress and write each chunk on a background thread while the next chunk is
+        read, defaults to True.
+    :type background_write: bool
+    :return: Number of spectra exported.
+    :rtype: int
+    """
+    if export_format is None:
+        export_format = get_export_format(file_name)
+    if export_format not in SPECTRUM_WRITERS:
+        raise ValueError('Unsupported export format: ' + str(export_format))
+    if compression == 'default':
+        compression = DEFAULT_COMPRESSION[export_format]
+    attributes = {'layout_version': EXPORT_LAYOUT_VERSION,
+                  'source_file': str(baf_data.source_file),
+                  'mode': mode,
+                  'profile_bins': profile_bins,
+                  'mz_encoding': mz_encoding,
+                  'intensity_encoding': intensity_encoding}
+    writer = SPECTRUM_WRITERS[export_format](file_name,
+                                             np.dtype(get_encoding_dtype(mz_encoding)),
+                                             np.dtype(get_encoding_dtype(intensity_encoding)),
+                                             attributes,
+                                             compression=compression)
+    num_spectra = 0
+    executor = ThreadPoolExecutor(max_workers=1) if background_write else None
+    pending = None
+    try:
+        for chunk in iter_spectrum_chunks(baf_data, mode=mode, frames=frames, chunk_size=chunk_size,
+                                          profile_bins=profile_bins, mz_encoding=mz_encoding,
+                                          intensity_encoding=intensity_encoding, bin_edges=bin_edges,
+                                          num_workers=num_workers, worker_chunk_size=worker_chunk_size):
+            if executor is None:
+                writer.write(*chunk)
+            else:
+                if pending is not None:
+                    pending.result()
+                pending = executor.submit(writer.write, *chunk)
+            num_spectra += chunk[0].size
+        if pending is not None:
+            pending.result()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        writer.close()
+    return num_spectra
@@ -0,0 +1,234 @@
+import re
+import numpy as np
+
+
+SPOT_NAME_PATTERN = re.compile(r'(?:R(\d+))?X(\d+)Y(\d+)', re.IGNORECASE)
+COORDINATE_FRAME_COLUMNS = ('Spectrum', 'SpectrumId', 'Frame', 'FrameId', 'TargetSpectrum')
+COORDINATE_X_COLUMNS = ('XIndexPos', 'XIndex', 'XPos', 'PosX', 'RasterX', 'X')
+COORDINATE_Y_COLUMNS = ('YIndexPos', 'YIndex', 'YPos', 'PosY', 'RasterY', 'Y')
+COORDINATE_SPOT_COLUMNS = ('SpotName', 'Spot', 'SpotNumber', 'Position')
+
+
+def parse_spot_names(spot_names):
+    """
+    Parse the raster positions of MALDI spots from spot names such as "R00X012Y034" or "X012Y034".
+
+    :param spot_names: Spot names.
+    :type spot_names: list[str] | numpy.array
+    :return: Tuple of x (np.array) and y (np.array) positions, with -1 for spot names that could not be parsed.
+    :rtype: tuple[numpy.array]
+    """
+    x = np.full(len(spot_names), -1, dtype=np.int64)
+    y = np.full(len(spot_names), -1, dtype=np.int64)
+    for i, spot_name in enumerate(spot_names):
+        match = SPOT_NAME_PATTERN.search(str(spot_name)) if spot_name is not None else None
+        if match is not None:
+            x[i] = int(match.group(2))
+            y[i] = int(match.group(3))
+    return x, y
+
+
+def _find_column(columns, candidates):
+    """
+    Find the first candidate column name in a list of columns, ignoring case.
+
+    :param columns: Column names of a table.
+    :type columns: list[str]
+    :param candidates: Candidate column names in order of preference.
+    :type candidates: tuple[str]
+    :return: Matching column name, or None.
+    :rtype: str | None
+    """
+    lower_columns = {str(column).lower(): column for column in columns}
+    for candidate in candidates:
+        if candidate.lower() in lower_columns:
+            return lower_columns[candidate.lower()]
+    return None
+
+
+def _to_float(values):
+    """
+    Convert the values of a table column to float64, with NaN for values that are not numeric.
+
+    :param values: Values of the column.
+    :type values: numpy.array
+    :return: Array of float64 values.
+    :rtype: numpy.array
+    """
+    import pandas as pd
+    return pd.to_numeric(pd.Series(values), errors='coerce').values.astype(np.float64)
+
+
+def find_coordinates(analysis):
+    """
+    Detect the raster positions of the spectra of a MALDI imaging run from the tables of analysis.sqlite. Tables are
+    searched for a column referencing the spectrum ID together with either x and y position columns or a spot name
+    column that can be parsed with pyBaf2Sql.imaging.parse_spot_names(). Position columns in the Spectra table itself
+    are also recognized. Position columns without numeric values are skipped.
+
+    :param analysis: Tables of analysis.sqlite as found in pyBaf2Sql.classes.BafData.analysis.
+    :type analysis: pyBaf2Sql.classes.AnalysisTables
+    :return: Tuple of frames (np.array), x (np.array), and y (np.array) positions, or None if no positions were
+        found.
+    :rtype: tuple[numpy.array] | None
+    """
+    spot_name_match = None
+    for name in analysis.table_names:
+        if name == 'Properties':
+            continue
+        columns = analysis.get_columns(name)
+        frame_column = 'Id' if name == 'Spectra' else _find_column(columns, COORDINATE_FRAME_COLUMNS)
+        if frame_column is None or frame_column not in columns:
+            continue
+        x_column = _find_column(columns, COORDINATE_X_COLUMNS)
+        y_column = _find_column(columns, COORDINATE_Y_COLUMNS)
+        if x_column is not None and y_column is not None:
+            table = analysis[name]
+            x = _to_float(table[x_column].values)
+            y = _to_float(table[y_column].values)
+            valid = ~(np.isnan(x) | np.isnan(y))
+            if valid.any():
+                return (table[frame_column].values[valid].astype(np.int64),
+                        np.round(x[valid]).astype(np.int64),
+                        np.round(y[valid]).astype(np.int64))
+        spot_column = _find_column(columns, COORDINATE_SPOT_COLUMNS)
+        if spot_column is not None and spot_name_match is None:
+            spot_name_match = (name, frame_column, spot_column)
+    if spot_name_match is not None:
+        table = analysis[spot_name_match[0]]
+        x, y = parse_spot_names(table[spot_name_match[2]].values)
+        valid = (x >= 0) & (y >= 0)
+        if valid.any():
+            return table[spot_name_match[1]].values[valid].astype(np.int64), x[valid], y[valid]
+    return None
+
+
+class SparseIonCube(object):
+    """
+    Binned MALDI imaging data cube stored as a sparse matrix in compressed sparse row (CSR) format with one row per
+    pixel and one column per m/z bin, as returned by pyBaf2Sql.classes.BafData.get_ion_cube(). Only non-zero bins are
+    stored, so acquisitions with many pixels and bins fit in memory.
+
+    :param indptr: Array of N + 1 row offsets for N pixels.
+    :type indptr: numpy.array
+    :param indices: Array of the bin indices of the stored values.
+    :type indices: numpy.array
+    :param data: Array of the stored summed intensities.
+    :type data: numpy.array
+    :param frames: Array of the frame IDs of the pixels.
+    :type frames: numpy.array
+    :param x: Array of the x positions of the pixels.
+    :type x: numpy.array
+    :param y: Array of the y positions of the pixels.
+    :type y: numpy.array
+    :param bin_edges: Array of evenly spaced bin edges; column j holds bin_edges[j] <= m/z < bin_edges[j] + bin width.
+    :type bin_edges: numpy.array
+    """
+    def __init__(self, indptr, indices, data, frames, x, y, bin_edges):
+        """
+        Constructor Method
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.frames = frames
+        self.x = x
+        self.y = y
+        self.bin_edges = bin_edges
+
+    @property
+    def shape(self):
+        """
+        Shape of the sparse matrix.
+
+        :return: Tuple of the number of pixels and number of bins.
+        :rtype: tuple[int]
+        """
+        return self.frames.size, self.bin_edges.size
+
+    @property
+    def image_shape(self):
+        """
+        Shape of the images of the cube spanning the bounding box of all pixels.
+
+        :return: Tuple of the height and width.
+        :rtype: tuple[int]
+        """
+        if self.x.size == 0:
+            return 0, 0
+        return int(self.y.max() - self.y.min() + 1), int(self.x.max() - self.x.min() + 1)
+
+    def get_image(self, bin_start, bin_stop=None):
+        """
+        Get a dense ion image of the summed intensities of a range of bins. Pixel [i, j] of the image holds position
+        y = min(y) + i and x = min(x) + j; pixels that were not acquired are 0.
+
+        :param bin_start: Index of the first bin.
+        :type bin_start: int
+        :param bin_stop: Index after the last bin, defaults to bin_start + 1.
+        :type bin_stop: int | None
+        :return: Image with shape pyBaf2Sql.imaging.SparseIonCube.image_shape.
+        :rtype: numpy.array
+        """
+        if bin_stop is None:
+            bin_stop = bin_start + 1
+        rows = np.repeat(np.arange(self.frames.size), np.diff(self.indptr))
+        selected = (self.indices >= bin_start) & (self.indices < bin_stop)
+        values = np.bincount(rows[selected], weights=self.data[selected], minlength=self.frames.size)
+        return get_image(values, self.x, self.y)
+
+    def get_pixel_spectrum(self, pixel):
+        """
+        Get the dense binned spectrum of a pixel.
+
+        :param pixel: Row index of the pixel.
+        :type pixel: int
+        :return: Array of summed intensities with one value per bin.
+        :rtype: numpy.array
+        """
+        spectrum = np.zeros(self.bin_edges.size, dtype=self.data.dtype)
+        start = self.indptr[pixel]
+        stop = self.indptr[pixel + 1]
+        spectrum[self.indices[start:stop]] = self.data[start:stop]
+        return spectrum
+
+    def to_scipy(self):
+        """
+        Convert the cube to a scipy.sparse.csr_matrix. Requires scipy.
+
+        :return: Sparse matrix with shape pyBaf2Sql.imaging.SparseIonCube.shape.
+        :rtype: scipy.sparse.csr_matrix
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+
+def get_image(values, x, y, fill_value=0):
+    """
+    Arrange one value per pixel into a dense image spanning the bounding box of the pixel positions. Pixel [i, j] of
+    the image holds position y = min(y) + i and x = min(x) + j. Values of pixels that share a position are summed.
+
+    :param values: Array of values with shape (N,) or (N, K) for N pixels.
+    :type values: numpy.array
+    :param x: Array of the x positions of the pixels.
+    :type x: numpy.array
+    :param y: Array of the y positions of the pixels.
+    :type y: numpy.array
+    :param fill_value: Value of pixels that were not acquired, defaults to 0.
+    :type fill_value: float
+    :return: Image with shape (height, width) or (K, height, width).
+    :rtype: numpy.array
+    """
+    values = np.asarray(values)
+    if x.size == 0:
+        return np.full(values.shape[1:] + (0, 0), fill_value, dtype=values.dtype)
+    rows = y - y.min()
+    columns = x - x.min()
+    image_shape = (int(rows.max()) + 1, int(columns.max()) + 1)
+    image = np.zeros(image_shape + values.shape[1:],
+                     dtype=np.result_type(values.dtype, np.min_scalar_type(fill_value)))
+    np.add.at(image, (rows, columns), values)
+    acquired = np.zeros(image_shape, dtype=bool)
+    acquired[rows, columns] = True
+    image[~acquired] = fill_value
+    return np.ascontiguousarray(np.moveaxis(image, (0, 1), (-2, -1)))
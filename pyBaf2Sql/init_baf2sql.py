@@ -4,12 +4,19 @@
 
 import os
 import platform
+import threading
 from ctypes import cdll, c_uint64, c_uint32, c_char_p, c_int, c_double, c_float, POINTER
 
 
+_baf2sql_libraries = {}
+_baf2sql_libraries_lock = threading.Lock()
+
+
 def init_baf2sql_api(bruker_api_file_name=''):
     """
-    Initialize functions from Bruker's Baf2Sql library using ctypes.
+    Initialize functions from Bruker's Baf2Sql library using ctypes. The library is only loaded and its function
+    signatures are only declared the first time this is called for a library path; later calls return the same handle,
+    so this can be called from every function or worker without repeating the work.
 
     :param bruker_api_file_name: Path to Baf2Sql library, defaults to packaged library paths if no custom paths are
         provided.
@@ -27,6 +34,21 @@ def init_baf2sql_api(bruker_api_file_name=''):
                                                 'Baf2Sql',
                                                 'libbaf2sql_c.so')
 
+    with _baf2sql_libraries_lock:
+        if bruker_api_file_name not in _baf2sql_libraries:
+            _baf2sql_libraries[bruker_api_file_name] = _load_baf2sql_api(bruker_api_file_name)
+        return _baf2sql_libraries[bruker_api_file_name]
+
+
+def _load_baf2sql_api(bruker_api_file_name):
+    """
+    Load Bruker's Baf2Sql library and declare the argument and return types of its functions.
+
+    :param bruker_api_file_name: Path to Baf2Sql library.
+    :type bruker_api_file_name: str
+    :return: Handle for Baf2Sql library.
+    :rtype: ctypes.CDLL
+    """
     baf2sql = cdll.LoadLibrary(bruker_api_file_name)
 
     baf2sql.baf2sql_array_close_storage.argtypes = [c_uint64]
@@ -0,0 +1,166 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+
+STAGES = ('open', 'sqlite_cache', 'sql', 'lookup', 'ctypes', 'binning', 'centroiding')
+"""
+Stages recorded by pyBaf2Sql when instrumentation is enabled:
+    - open: Opening the storage handle with pyBaf2Sql.baf.open_storage().
+    - sqlite_cache: Generating or locating analysis.sqlite with pyBaf2Sql.baf.get_sqlite_cache_filename_v2().
+    - sql: Reading tables from analysis.sqlite; bytes are the memory used by the loaded tables.
+    - lookup: Spectrum metadata lookups in pyBaf2Sql.classes.BafSpectrum.
+    - ctypes: Reading data arrays through the Baf2Sql library; bytes are the size of the arrays read.
+    - binning: Binning profile spectra with pyBaf2Sql.util.bin_profile_spectrum(); bytes are the size of the binned
+      arrays.
+    - centroiding: Centroiding profile spectra in "centroid_from_profile" mode with
+      pyBaf2Sql.util.centroid_profile_spectrum(); bytes are the size of the centroided arrays.
+"""
+
+
+class StageStats(object):
+    """
+    Call count, cumulative wall clock time, and bytes processed by an instrumented stage.
+    """
+    __slots__ = ('calls', 'seconds', 'bytes')
+
+    def __init__(self):
+        """
+        Constructor Method
+        """
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def __repr__(self):
+        return 'StageStats(calls={}, seconds={:.6f}, bytes={})'.format(self.calls, self.seconds, self.bytes)
+
+
+class Instrumentation(object):
+    """
+    Opt-in recorder of per-stage call counts, wall clock time, and bytes processed by the hot paths of pyBaf2Sql. An
+    Instrumentation object can be passed to pyBaf2Sql.classes.BafData to record a single run or shared between several
+    BafData objects to record a whole pipeline. Hooks are called for every recorded call with the stage name, the
+    elapsed seconds, the number of bytes, and a dictionary of attributes that includes the source_file of the run, and
+    can be used to export timings to logging, metrics, or tracing systems.
+
+    :param hooks: Callables with the signature hook(stage, seconds, num_bytes, attributes).
+    :type hooks: list[collections.abc.Callable] | None
+    """
+    def __init__(self, hooks=None):
+        """
+        Constructor Method
+        """
+        self.stages = {}
+        self.hooks = list(hooks) if hooks is not None else []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        Register a hook that is called for every recorded call.
+
+        :param hook: Callable with the signature hook(stage, seconds, num_bytes, attributes).
+        :type hook: collections.abc.Callable
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+        Unregister a hook.
+
+        :param hook: Previously registered hook.
+        :type hook: collections.abc.Callable
+        """
+        self.hooks.remove(hook)
+
+    def record(self, stage, seconds, num_bytes=0, **attributes):
+        """
+        Record a call of a stage and pass it on to the hooks.
+
+        :param stage: Name of the stage, usually one of pyBaf2Sql.instrumentation.STAGES.
+        :type stage: str
+        :param seconds: Elapsed wall clock time in seconds.
+        :type seconds: float
+        :param num_bytes: Number of bytes processed.
+        :type num_bytes: int
+        :param attributes: Attributes passed to the hooks, e.g. source_file or frame.
+        """
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bytes += num_bytes
+        for hook in self.hooks:
+            hook(stage, seconds, num_bytes, attributes)
+
+    @contextmanager
+    def stage(self, stage, **attributes):
+        """
+        Context manager that records the wall clock time spent inside the with block as one call of a stage.
+
+        :param stage: Name of the stage.
+        :type stage: str
+        :param attributes: Attributes passed to the hooks.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - start, **attributes)
+
+    def get_stats(self):
+        """
+        Get a snapshot of the recorded stages.
+
+        :return: Dictionary of stage names to dictionaries of calls, seconds, and bytes.
+        :rtype: dict
+        """
+        with self.lock:
+            return {stage: {'calls': stats.calls, 'seconds': stats.seconds, 'bytes': stats.bytes}
+                    for stage, stats in self.stages.items()}
+
+    def reset(self):
+        """
+        Clear all recorded stages. Hooks are kept.
+        """
+        with self.lock:
+            self.stages.clear()
+
+    def log_stats(self, logger=None, level=logging.INFO):
+        """
+        Log the recorded time breakdown with one line per stage.
+
+        :param logger: Logger to log to, defaults to the pyBaf2Sql logger.
+        :type logger: logging.Logger | None
+        :param level: Logging level.
+        :type level: int
+        """
+        if logger is None:
+            logger = logging.getLogger('pyBaf2Sql')
+        for stage, stats in sorted(self.get_stats().items(), key=lambda item: -item[1]['seconds']):
+            logger.log(level, '%s: %d calls, %.6f s, %d bytes', stage, stats['calls'], stats['seconds'],
+                       stats['bytes'])
+
+
+def get_logging_hook(logger=None, level=logging.DEBUG):
+    """
+    Get a hook for pyBaf2Sql.instrumentation.Instrumentation that logs every recorded call.
+
+    :param logger: Logger to log to, defaults to the pyBaf2Sql logger.
+    :type logger: logging.Logger | None
+    :param level: Logging level.
+    :type level: int
+    :return: Hook.
+    :rtype: collections.abc.Callable
+    """
+    if logger is None:
+        logger = logging.getLogger('pyBaf2Sql')
+
+    def logging_hook(stage, seconds, num_bytes, attributes):
+        if logger.isEnabledFor(level):
+            logger.log(level, '%s: %.6f s, %d bytes, %s', stage, seconds, num_bytes, attributes)
+
+    return logging_hook
@@ -0,0 +1,504 @@
+import base64
+import hashlib
+import importlib
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import PackageNotFoundError, version
+from xml.sax.saxutils import quoteattr
+import numpy as np
+from pyBaf2Sql.export import iter_spectrum_chunks
+from pyBaf2Sql.util import get_centroid_status
+
+
+MZML_EXTENSIONS = ('.mzML', '.mzml')
+MZML_COMPRESSIONS = ('zlib', None)
+NUMPRESS_ENCODINGS = ('linear', 'slof', 'pic')
+COMPRESSION_CV_PARAMS = {(None, None): ('MS:1000576', 'no compression'),
+                         ('zlib', None): ('MS:1000574', 'zlib compression'),
+                         (None, 'linear'): ('MS:1002312', 'MS-Numpress linear prediction compression'),
+                         (None, 'pic'): ('MS:1002313', 'MS-Numpress positive integer compression'),
+                         (None, 'slof'): ('MS:1002314', 'MS-Numpress short logged float compression'),
+                         ('zlib', 'linear'): ('MS:1002746', 'MS-Numpress linear prediction compression followed by '
+                                                            'zlib compression'),
+                         ('zlib', 'pic'): ('MS:1002747', 'MS-Numpress positive integer compression followed by zlib '
+                                                         'compression'),
+                         ('zlib', 'slof'): ('MS:1002748', 'MS-Numpress short logged float compression followed by '
+                                                          'zlib compression')}
+SPECTRUM_INDENT = '      '
+
+
+def _import_numpress():
+    """
+    Import the optional pynumpress package.
+
+    :return: pynumpress module.
+    :rtype: module
+    """
+    try:
+        return importlib.import_module('pynumpress')
+    except ImportError as error:
+        raise ImportError('pynumpress is required for MS-Numpress encoding; install it with pip install '
+                          'pyBaf2Sql[numpress].') from error
+
+
+def encode_array(array, compression='zlib', numpress=None):
+    """
+    Encode a binary data array for mzML by optionally applying MS-Numpress encoding, then optionally zlib
+    compression, and finally base64 encoding.
+
+    :param array: Array to encode.
+    :type array: numpy.array
+    :param compression: Compression, either "zlib" or None.
+    :type compression: str | None
+    :param numpress: MS-Numpress encoding, either "linear", "slof", "pic", or None.
+    :type numpress: str | None
+    :return: Base64 encoded bytes.
+    :rtype: bytes
+    """
+    if numpress is not None:
+        pynumpress = _import_numpress()
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        if numpress == 'linear':
+            data = pynumpress.encode_linear(array, pynumpress.optimal_linear_fixed_point(array))
+        elif numpress == 'slof':
+            data = pynumpress.encode_slof(array, pynumpress.optimal_slof_fixed_point(array))
+        elif numpress == 'pic':
+            data = pynumpress.encode_pic(array)
+        else:
+            raise ValueError('Unsupported MS-Numpress encoding: ' + str(numpress))
+        data = np.asarray(data, dtype=np.uint8).tobytes()
+    else:
+        data = np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<'), copy=False).tobytes()
+    if compression == 'zlib':
+        data = zlib.compress(data)
+    elif compression is not None:
+        raise ValueError('Unsupported compression: ' + str(compression))
+    return base64.b64encode(data)
+
+
+def _cv_param(accession, name, value='', unit=None, cv_ref='MS'):
+    """
+    Render a cvParam element.
+
+    :param accession: Accession of the term, e.g. "MS:1000511".
+    :type accession: str
+    :param name: Name of the term.
+    :type name: str
+    :param value: Value of the parameter.
+    :type value: str | int | float
+    :param unit: Tuple of the unit accession and unit name, e.g. ("UO:0000031", "minute").
+    :type unit: tuple[str] | None
+    :param cv_ref: Controlled vocabulary of the term.
+    :type cv_ref: str
+    :return: XML of the element.
+    :rtype: str
+    """
+    xml = '<cvParam cvRef="' + cv_ref + '" accession="' + accession + '" name="' + name + '" value=' + \
+        quoteattr(str(value))
+    if unit is not None:
+        xml += ' unitCvRef="' + unit[0].split(':')[0] + '" unitAccession="' + unit[0] + '" unitName="' + unit[1] + '"'
+    return xml + '/>'
+
+
+def _binary_data_array(array, array_param, unit, float_param, compression, numpress, indent):
+    """
+    Render a binaryDataArray element.
+
+    :param array: Array to encode.
+    :type array: numpy.array
+    :param array_param: Tuple of the accession and name of the array type.
+    :type array_param: tuple[str]
+    :param unit: Tuple of the unit accession and unit name.
+    :type unit: tuple[str]
+    :param float_param: Tuple of the accession and name of the binary data type.
+    :type float_param: tuple[str]
+    :param compression: Compression, either "zlib" or None.
+    :type compression: str | None
+    :param numpress: MS-Numpress encoding, either "linear", "slof", "pic", or None.
+    :type numpress: str | None
+    :param indent: Indentation of the element.
+    :type indent: str
+    :return: XML of the element.
+    :rtype: str
+    """
+    encoded = encode_array(array, compression, numpress).decode('ascii')
+    return ''.join([indent, '<binaryDataArray encodedLength="', str(len(encoded)), '">\n',
+                    indent, '  ', _cv_param(*float_param), '\n',
+                    indent, '  ', _cv_param(*COMPRESSION_CV_PARAMS[(compression, numpress)]), '\n',
+                    indent, '  ', _cv_param(*array_param, unit=unit), '\n',
+                    indent, '  <binary>', encoded, '</binary>\n',
+                    indent, '</binaryDataArray>\n'])
+
+
+def _finite(value):
+    """
+    Check whether a metadata value is present.
+
+    :param value: Metadata value.
+    :type value: float
+    :return: Whether the value is not NaN.
+    :rtype: bool
+    """
+    return not np.isnan(value)
+
+
+def _render_spectrum(index, record, mz_array, intensity_array, centroided, mz_float_param, intensity_float_param,
+                     compression, mz_numpress, intensity_numpress):
+    """
+    Render a spectrum element.
+
+    :param index: Index of the spectrum in the file.
+    :type index: int
+    :param record: Metadata of the spectrum with the fields of pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE.
+    :type record: numpy.void
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param centroided: Whether the spectrum is centroided.
+    :type centroided: bool
+    :param mz_float_param: Tuple of the accession and name of the binary data type of the m/z array.
+    :type mz_float_param: tuple[str]
+    :param intensity_float_param: Tuple of the accession and name of the binary data type of the intensity array.
+    :type intensity_float_param: tuple[str]
+    :param compression: Compression, either "zlib" or None.
+    :type compression: str | None
+    :param mz_numpress: MS-Numpress encoding of the m/z array.
+    :type mz_numpress: str | None
+    :param intensity_numpress: MS-Numpress encoding of the intensity array.
+    :type intensity_numpress: str | None
+    :return: XML of the element.
+    :rtype: str
+    """
+    i1 = SPECTRUM_INDENT + '  '
+    i2 = i1 + '  '
+    i3 = i2 + '  '
+    i4 = i3 + '  '
+    i5 = i4 + '  '
+    ms_level = int(record['ms_level'])
+    lines = [SPECTRUM_INDENT + '<spectrum index="' + str(index) + '" id="scan=' + str(int(record['frame'])) +
+             '" defaultArrayLength="' + str(mz_array.size) + '">']
+    if ms_level > 0:
+        lines.append(i1 + _cv_param('MS:1000511', 'ms level', ms_level))
+        lines.append(i1 + (_cv_param('MS:1000579', 'MS1 spectrum') if ms_level == 1 else
+                           _cv_param('MS:1000580', 'MSn spectrum')))
+    lines.append(i1 + (_cv_param('MS:1000127', 'centroid spectrum') if centroided else
+                       _cv_param('MS:1000128', 'profile spectrum')))
+    if record['polarity'] == '+':
+        lines.append(i1 + _cv_param('MS:1000130', 'positive scan'))
+    elif record['polarity'] == '-':
+        lines.append(i1 + _cv_param('MS:1000129', 'negative scan'))
+    for accession, name, field in (('MS:1000285', 'total ion current', 'total_ion_current'),
+                                   ('MS:1000504', 'base peak m/z', 'base_peak_mz'),
+                                   ('MS:1000505', 'base peak intensity', 'base_peak_intensity'),
+                                   ('MS:1000528', 'lowest observed m/z', 'low_mz'),
+                                   ('MS:1000527', 'highest observed m/z', 'high_mz')):
+        if _finite(record[field]):
+            unit = ('MS:1000040', 'm/z') if field.endswith('mz') else None
+            lines.append(i1 + _cv_param(accession, name, float(record[field]), unit))
+    lines.append(i1 + '<scanList count="1">')
+    lines.append(i2 + _cv_param('MS:1000795', 'no combination'))
+    lines.append(i2 + '<scan>')
+    lines.append(i3 + _cv_param('MS:1000016', 'scan start time', float(record['retention_time']),
+                                ('UO:0000031', 'minute')))
+    lines.append(i2 + '</scan>')
+    lines.append(i1 + '</scanList>')
+    scan_mode = int(record['scan_mode'])
+    if ms_level == 2 and scan_mode in (2, 4, 5):
+        lines.append(i1 + '<precursorList count="1">')
+        if int(record['parent_frame']) > 0:
+            lines.append(i2 + '<precursor spectrumRef="scan=' + str(int(record['parent_frame'])) + '">')
+        else:
+            lines.append(i2 + '<precursor>')
+        if scan_mode == 2:
+            target_mz = record['target_mz'] if _finite(record['target_mz']) else record['selected_ion_mz']
+            if _finite(target_mz):
+                lines.append(i3 + '<isolationWindow>')
+                lines.append(i4 + _cv_param('MS:1000827', 'isolation window target m/z', float(target_mz),
+                                            ('MS:1000040', 'm/z')))
+                if _finite(record['isolation_width']):
+                    offset = float(record['isolation_width']) / 2
+                    lines.append(i4 + _cv_param('MS:1000828', 'isolation window lower offset', offset,
+                                                ('MS:1000040', 'm/z')))
+                    lines.append(i4 + _cv_param('MS:1000829', 'isolation window upper offset', offset,
+                                                ('MS:1000040', 'm/z')))
+                lines.append(i3 + '</isolationWindow>')
+            if _finite(record['selected_ion_mz']):
+                lines.append(i3 + '<selectedIonList count="1">')
+                lines.append(i4 + '<selectedIon>')
+                lines.append(i5 + _cv_param('MS:1000744', 'selected ion m/z', float(record['selected_ion_mz']),
+                                            ('MS:1000040', 'm/z')))
+                if _finite(record['charge_state']) and int(record['charge_state']) > 0:
+                    lines.append(i5 + _cv_param('MS:1000041', 'charge state', int(record['charge_state'])))
+                lines.append(i4 + '</selectedIon>')
+                lines.append(i3 + '</selectedIonList>')
+        lines.append(i3 + '<activation>')
+        if scan_mode == 4:
+            lines.append(i4 + _cv_param('MS:1001880', 'in-source collision-induced dissociation'))
+        else:
+            lines.append(i4 + _cv_param('MS:1000133', 'collision-induced dissociation'))
+        if _finite(record['collision_energy']):
+            lines.append(i4 + _cv_param('MS:1000045', 'collision energy', float(record['collision_energy']),
+                                        ('UO:0000266', 'electronvolt')))
+        lines.append(i3 + '</activation>')
+        lines.append(i2 + '</precursor>')
+        lines.append(i1 + '</precursorList>')
+    lines.append(i1 + '<binaryDataArrayList count="2">')
+    return '\n'.join(lines) + '\n' + \
+        _binary_data_array(mz_array, ('MS:1000514', 'm/z array'), ('MS:1000040', 'm/z'), mz_float_param,
+                           compression, mz_numpress, i2) + \
+        _binary_data_array(intensity_array, ('MS:1000515', 'intensity array'),
+                           ('MS:1000131', 'number of detector counts'), intensity_float_param, compression,
+                           intensity_numpress, i2) + \
+        i1 + '</binaryDataArrayList>\n' + SPECTRUM_INDENT + '</spectrum>\n'
+
+
+def _render_spectra(start_index, metadata, mz_array, intensity_array, offsets, options):
+    """
+    Render a batch of spectra on a worker thread.
+
+    :param start_index: Index of the first spectrum of the batch in the file.
+    :type start_index: int
+    :param metadata: Metadata of the spectra.
+    :type metadata: numpy.array
+    :param mz_array: Concatenated m/z array of the chunk containing the batch.
+    :type mz_array: numpy.array
+    :param intensity_array: Concatenated intensity array of the chunk containing the batch.
+    :type intensity_array: numpy.array
+    :param offsets: Array of the N + 1 offsets of the N spectra of the batch in the concatenated arrays.
+    :type offsets: numpy.array
+    :param options: Keyword arguments passed to pyBaf2Sql.mzml._render_spectrum().
+    :type options: dict
+    :return: List of the UTF-8 encoded XML of each spectrum.
+    :rtype: list[bytes]
+    """
+    return [_render_spectrum(start_index + i, record, mz_array[offsets[i]:offsets[i + 1]],
+                             intensity_array[offsets[i]:offsets[i + 1]], **options).encode('utf-8')
+            for i, record in enumerate(metadata)]
+
+
+class _IndexedFile(object):
+    """
+    Output file that keeps track of the number of bytes written and their SHA-1 checksum for the index of an indexed
+    mzML file.
+
+    :param file: Binary file object to write to.
+    :type file: io.BufferedWriter
+    """
+    def __init__(self, file):
+        """
+        Constructor Method
+        """
+        self.file = file
+        self.offset = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        """
+        Write bytes or a string encoded as UTF-8.
+
+        :param data: Data to write.
+        :type data: bytes | str
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.file.write(data)
+        self.sha1.update(data)
+        self.offset += len(data)
+
+
+def _get_header(baf_data, run_id, num_spectra, centroided, version):
+    """
+    Render the start of an indexed mzML file up to the opening spectrumList element.
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param run_id: ID of the run.
+    :type run_id: str
+    :param num_spectra: Number of spectra in the file.
+    :type num_spectra: int
+    :param centroided: Whether the spectra are centroided by the conversion.
+    :type centroided: bool
+    :param version: Version of pyBaf2Sql.
+    :type version: str
+    :return: XML of the header.
+    :rtype: str
+    """
+    location = 'file:///' + os.path.abspath(str(baf_data.source_file)).replace('\\', '/').lstrip('/')
+    processing = '          ' + _cv_param('MS:1000544', 'Conversion to mzML') + '\n'
+    if centroided:
+        processing += '          ' + _cv_param('MS:1000035', 'peak picking') + '\n'
+    return ''.join(['<?xml version="1.0" encoding="utf-8"?>\n',
+                    '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                    'xsi:schemaLocation="http://psi.hupo.org/ms/mzml '
+                    'http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd">\n',
+                    '  <mzML xmlns="http://psi.hupo.org/ms/mzml" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                    'xsi:schemaLocation="http://psi.hupo.org/ms/mzml '
+                    'http://psidev.info/files/ms/mzML/xsd/mzML1.1.0.xsd" id=', quoteattr(run_id),
+                    ' version="1.1.0">\n',
+                    '    <cvList count="2">\n',
+                    '      <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" '
+                    'URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>\n',
+                    '      <cv id="UO" fullName="Unit Ontology" '
+                    'URI="https://raw.githubusercontent.com/bio-ontology-research-group/unit-ontology/master/'
+                    'unit.obo"/>\n',
+                    '    </cvList>\n',
+                    '    <fileDescription>\n',
+                    '      <fileContent>\n',
+                    '        ', _cv_param('MS:1000579', 'MS1 spectrum'), '\n',
+                    '        ', _cv_param('MS:1000580', 'MSn spectrum'), '\n',
+                    '      </fileContent>\n',
+                    '      <sourceFileList count="1">\n',
+                    '        <sourceFile id="analysis.baf" name="analysis.baf" location=', quoteattr(location),
+                    '>\n',
+                    '          ', _cv_param('MS:1000772', 'Bruker BAF nativeID format'), '\n',
+                    '          ', _cv_param('MS:1000815', 'Bruker BAF format'), '\n',
+                    '        </sourceFile>\n',
+                    '      </sourceFileList>\n',
+                    '    </fileDescription>\n',
+                    '    <softwareList count="1">\n',
+                    '      <software id="pyBaf2Sql" version=', quoteattr(version), '>\n',
+                    '        ', _cv_param('MS:1000799', 'custom unreleased software tool', 'pyBaf2Sql'), '\n',
+                    '      </software>\n',
+                    '    </softwareList>\n',
+                    '    <instrumentConfigurationList count="1">\n',
+                    '      <instrumentConfiguration id="IC1">\n',
+                    '        ', _cv_param('MS:1000122', 'Bruker Daltonics instrument model'), '\n',
+                    '      </instrumentConfiguration>\n',
+                    '    </instrumentConfigurationList>\n',
+                    '    <dataProcessingList count="1">\n',
+                    '      <dataProcessing id="pyBaf2Sql_conversion">\n',
+                    '        <processingMethod order="1" softwareRef="pyBaf2Sql">\n',
+                    processing,
+                    '        </processingMethod>\n',
+                    '      </dataProcessing>\n',
+                    '    </dataProcessingList>\n',
+                    '    <run id=', quoteattr(run_id), ' defaultInstrumentConfigurationRef="IC1">\n',
+                    '      <spectrumList count="', str(num_spectra),
+                    '" defaultDataProcessingRef="pyBaf2Sql_conversion">\n'])
+
+
+def write_mzml(baf_data, file_name, mode='centroid', frames=None, profile_bins=0, mz_encoding=64,
+               intensity_encoding=64, bin_edges=None, compression='zlib', mz_numpress=None, intensity_numpress=None,
+               chunk_size=1000, encode_batch_size=100, num_threads=None, num_workers=0, worker_chunk_size=100):
+    """
+    Write the spectra of a BAF run to an indexed mzML file. Spectra are read chunk_size spectra at a time with
+    pyBaf2Sql.export.iter_spectrum_chunks(), and their binary arrays are compressed, base64 encoded, and rendered to
+    XML in batches of encode_batch_size spectra on a pool of threads while the next spectra are read. The rendered
+    spectra are written in order, so memory use is bounded by the chunks in flight rather than by the run length. The
+    byte offset of every spectrum is written to the index at the end of the file together with the SHA-1 checksum of
+    the file.
+
+    Binary arrays can be compressed with zlib and/or MS-Numpress. MS-Numpress encoding requires the optional
+    pynumpress package, which can be installed with pip install pyBaf2Sql[numpress].
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param file_name: Path of the output mzML file.
+    :type file_name: str
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param frames: IDs of the frames to write in the order they should be written, defaults to all frames in ID
+        order.
+    :type frames: list[int] | numpy.array | None
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :param compression: Compression of the binary arrays, either "zlib" or None.
+    :type compression: str | None
+    :param mz_numpress: MS-Numpress encoding of the m/z arrays, either "linear" or None. MS-Numpress encoded arrays
+        are decoded as 64-bit floats regardless of mz_encoding.
+    :type mz_numpress: str | None
+    :param intensity_numpress: MS-Numpress encoding of the intensity arrays, either "slof", "pic", or None.
+    :type intensity_numpress: str | None
+    :param chunk_size: Number of spectra to read at once.
+    :type chunk_size: int
+    :param encode_batch_size: Number of spectra encoded by a thread per task.
+    :type encode_batch_size: int
+    :param num_threads: Number of encoding threads, defaults to the number of CPUs.
+    :type num_threads: int | None
+    :param num_workers: Number of worker processes to read spectra with pyBaf2Sql.parallel.iter_spectra_parallel(),
+        defaults to 0 (read in the current process).
+    :type num_workers: int
+    :param worker_chunk_size: Number of spectra read by a worker per task.
+    :type worker_chunk_size: int
+    :return: Number of spectra written.
+    :rtype: int
+    """
+    if compression not in MZML_COMPRESSIONS:
+        raise ValueError('Unsupported compression: ' + str(compression))
+    if mz_numpress not in (None, 'linear'):
+        raise ValueError('Unsupported MS-Numpress encoding for m/z arrays: ' + str(mz_numpress))
+    if intensity_numpress not in (None, 'slof', 'pic'):
+        raise ValueError('Unsupported MS-Numpress encoding for intensity arrays: ' + str(intensity_numpress))
+    if mz_numpress is not None or intensity_numpress is not None:
+        _import_numpress()
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    if frames is None:
+        frames = baf_data.get_frames()
+    frames = np.asarray(frames)
+    float_params = {32: ('MS:1000521', '32-bit float'), 64: ('MS:1000523', '64-bit float')}
+    options = {'centroided': get_centroid_status(mode),
+               'mz_float_param': float_params[64 if mz_numpress is not None else mz_encoding],
+               'intensity_float_param': float_params[64 if intensity_numpress is not None else intensity_encoding],
+               'compression': compression,
+               'mz_numpress': mz_numpress,
+               'intensity_numpress': intensity_numpress}
+    run_id = os.path.splitext(os.path.basename(os.path.normpath(str(baf_data.source_file))))[0]
+    try:
+        pybaf2sql_version = version('pyBaf2Sql')
+    except PackageNotFoundError:
+        pybaf2sql_version = 'unknown'
+
+    spectrum_offsets = []
+    with open(file_name, 'wb') as mzml_file, ThreadPoolExecutor(max_workers=num_threads) as executor:
+        output = _IndexedFile(mzml_file)
+        output.write(_get_header(baf_data, run_id, frames.size, mode == 'centroid_from_profile', pybaf2sql_version))
+        pending = deque()
+
+        def write_batch(future):
+            for xml in future.result():
+                spectrum_offsets.append(output.offset + len(SPECTRUM_INDENT))
+                output.write(xml)
+
+        try:
+            num_spectra = 0
+            for metadata, mz_array, intensity_array, offsets in iter_spectrum_chunks(
+                    baf_data, mode=mode, frames=frames, chunk_size=chunk_size, profile_bins=profile_bins,
+                    mz_encoding=mz_encoding, intensity_encoding=intensity_encoding, bin_edges=bin_edges,
+                    num_workers=num_workers, worker_chunk_size=worker_chunk_size):
+                for start in range(0, metadata.size, encode_batch_size):
+                    stop = min(start + encode_batch_size, metadata.size)
+                    pending.append(executor.submit(_render_spectra, num_spectra + start, metadata[start:stop],
+                                                   mz_array, intensity_array, offsets[start:stop + 1], options))
+                    if len(pending) >= 2 * num_threads:
+                        write_batch(pending.popleft())
+                num_spectra += metadata.size
+            while pending:
+                write_batch(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+        output.write('      </spectrumList>\n    </run>\n  </mzML>\n  ')
+        index_offset = output.offset
+        output.write('<indexList count="1">\n    <index name="spectrum">\n')
+        for start in range(0, num_spectra, chunk_size):
+            output.write(''.join('      <offset idRef="scan=' + str(frame) + '">' + str(offset) + '</offset>\n'
+                                 for frame, offset in zip(frames[start:start + chunk_size].tolist(),
+                                                          spectrum_offsets[start:start + chunk_size])))
+        output.write('    </index>\n  </indexList>\n  <indexListOffset>' + str(index_offset) +
+                     '</indexListOffset>\n  <fileChecksum>')
+        mzml_file.write((output.sha1.hexdigest() + '</fileChecksum>\n</indexedmzML>\n').encode('utf-8'))
+    return num_spectra
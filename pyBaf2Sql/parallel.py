@@ -0,0 +1,222 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory, util
+import numpy as np
+from pyBaf2Sql.init_baf2sql import init_baf2sql_api
+from pyBaf2Sql.baf import ArrayBuffer, open_storage, close_storage
+from pyBaf2Sql.classes import BafSpectrumArrays
+from pyBaf2Sql.util import get_encoding_dtype, bin_profile_spectrum, centroid_profile_spectra
+from pyBaf2Sql.error import throw_last_baf2sql_error
+
+
+# Baf2Sql library and storage handle opened once in each worker process by _init_worker().
+_worker = {}
+
+
+def _init_worker(bruker_api_file_name, bruker_d_folder_name, raw_calibration):
+    """
+    Initialize a worker process by loading the Baf2Sql library and opening its own storage handle to the BAF dataset.
+
+    :param bruker_api_file_name: Path to Baf2Sql library.
+    :type bruker_api_file_name: str
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True).
+    :type raw_calibration: bool
+    """
+    baf2sql = init_baf2sql_api(bruker_api_file_name)
+    handle = open_storage(baf2sql, bruker_d_folder_name, raw_calibration)
+    if handle == 0:
+        throw_last_baf2sql_error(baf2sql)
+    _worker['api'] = baf2sql
+    _worker['handle'] = handle
+    # atexit handlers do not run in forked workers, which exit with os._exit(), but multiprocessing finalizers do.
+    util.Finalize(None, close_storage, args=(baf2sql, handle, None), exitpriority=10)
+
+
+def _extract_chunk(frames, mz_ids, intensity_ids, mode, profile_bins, mz_encoding, intensity_encoding, bin_edges):
+    """
+    Read a chunk of spectra in a worker process and copy the concatenated m/z and intensity arrays into a new shared
+    memory block. Ownership of the shared memory block is handed to the parent process, which unlinks it.
+
+    :param frames: IDs of the frames in the chunk.
+    :type frames: list[int]
+    :param mz_ids: IDs of the m/z arrays of the frames.
+    :type mz_ids: list[int]
+    :param intensity_ids: IDs of the intensity arrays of the frames.
+    :type intensity_ids: list[int]
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges shared by all spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :return: Tuple of the shared memory block name, the frame IDs, and the offsets of each spectrum in the
+        concatenated arrays.
+    :rtype: tuple
+    """
+    mz_dtype = np.dtype(get_encoding_dtype(mz_encoding))
+    intensity_dtype = np.dtype(get_encoding_dtype(intensity_encoding))
+    mz_buffer = ArrayBuffer(mz_dtype)
+    intensity_buffer = ArrayBuffer(intensity_dtype)
+    mz_arrays = []
+    intensity_arrays = []
+    for mz_id, intensity_id in zip(mz_ids, intensity_ids):
+        mz_array = mz_buffer.read(_worker['api'], _worker['handle'], int(mz_id))
+        intensity_array = intensity_buffer.read(_worker['api'], _worker['handle'], int(intensity_id))
+        if mode == 'profile' and (profile_bins != 0 or bin_edges is not None):
+            mz_array, intensity_array = bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding,
+                                                             bin_edges)
+        mz_arrays.append(np.array(mz_array, dtype=mz_dtype))
+        intensity_arrays.append(np.array(intensity_array, dtype=intensity_dtype))
+    if mode == 'centroid_from_profile':
+        # Centroid the whole chunk at once rather than one spectrum at a time.
+        mz_array, intensity_array, offsets = centroid_profile_spectra(mz_arrays, intensity_arrays,
+                                                                      mz_encoding=mz_encoding,
+                                                                      intensity_encoding=intensity_encoding)
+        mz_arrays, intensity_arrays = [mz_array], [intensity_array]
+    else:
+        offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+        np.cumsum([i.size for i in mz_arrays], out=offsets[1:])
+    intensity_start = _intensity_start(offsets[-1], mz_dtype)
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(intensity_start + int(offsets[-1]) * intensity_dtype.itemsize, 1))
+    try:
+        np.concatenate(mz_arrays + [np.empty(0, dtype=mz_dtype)],
+                       out=np.ndarray(int(offsets[-1]), dtype=mz_dtype, buffer=shm.buf))
+        np.concatenate(intensity_arrays + [np.empty(0, dtype=intensity_dtype)],
+                       out=np.ndarray(int(offsets[-1]), dtype=intensity_dtype, buffer=shm.buf,
+                                      offset=intensity_start))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    finally:
+        shm.close()
+    return shm.name, frames, offsets
+
+
+def _intensity_start(num_elements, mz_dtype):
+    """
+    Get the byte offset of the intensity array in a shared memory block, aligned to 8 bytes after the m/z array.
+
+    :param num_elements: Total number of elements in the concatenated m/z array.
+    :type num_elements: int
+    :param mz_dtype: Numpy dtype of the m/z array.
+    :type mz_dtype: numpy.dtype
+    :return: Byte offset.
+    :rtype: int
+    """
+    return (int(num_elements) * mz_dtype.itemsize + 7) // 8 * 8
+
+
+def iter_spectra_parallel(baf_data, mode='centroid', frames=None, num_workers=None, chunk_size=100, profile_bins=0,
+                          mz_encoding=64, intensity_encoding=64, bruker_api_file_name=None, mp_context=None,
+                          bin_edges=None):
+    """
+    Iterate over spectra from a BAF dataset using a pool of worker processes. Frames are partitioned into chunks that
+    are read by workers that each open their own storage handle, and the arrays are returned through shared memory.
+    Spectra are yielded in the same order as the frames as pyBaf2Sql.classes.BafSpectrumArrays records that own their
+    arrays. At most two chunks per worker are in flight at once, so memory use does not grow with the run length.
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param frames: IDs of the frames to read in the order they should be yielded, defaults to all frames in ID
+        order.
+    :type frames: list[int] | numpy.array | None
+    :param num_workers: Number of worker processes, defaults to the number of CPUs.
+    :type num_workers: int | None
+    :param chunk_size: Number of spectra read by a worker per task.
+    :type chunk_size: int
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bruker_api_file_name: Path to Baf2Sql library to load in each worker, defaults to the library used by
+        baf_data.
+    :type bruker_api_file_name: str | None
+    :param mp_context: Multiprocessing context used to start the worker processes, defaults to the platform default.
+    :type mp_context: multiprocessing.context.BaseContext | None
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to instead of binning each spectrum over its own m/z range.
+    :type bin_edges: numpy.array | None
+    :return: Generator of spectrum records.
+    :rtype: collections.abc.Iterator[pyBaf2Sql.classes.BafSpectrumArrays]
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if bruker_api_file_name is None:
+        bruker_api_file_name = baf_data.api._name
+    if frames is None:
+        frames = baf_data.get_frames()
+    frames = np.asarray(frames)
+    mz_dtype = np.dtype(get_encoding_dtype(mz_encoding))
+    intensity_dtype = np.dtype(get_encoding_dtype(intensity_encoding))
+
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(bruker_api_file_name, baf_data.source_file, baf_data.raw_calibration)) as pool:
+        pending = deque()
+        try:
+            for start in range(0, frames.size, chunk_size):
+                chunk = frames[start:start + chunk_size]
+                mz_ids, intensity_ids = baf_data.get_array_ids(chunk, mode)
+                pending.append(pool.submit(_extract_chunk, chunk.tolist(), mz_ids.tolist(), intensity_ids.tolist(),
+                                           mode, profile_bins, mz_encoding, intensity_encoding, bin_edges))
+                if len(pending) >= 2 * num_workers:
+                    yield from _collect_chunk(pending.popleft(), mz_dtype, intensity_dtype)
+            while pending:
+                yield from _collect_chunk(pending.popleft(), mz_dtype, intensity_dtype)
+        finally:
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    _unlink(future.result()[0])
+
+
+def _collect_chunk(future, mz_dtype, intensity_dtype):
+    """
+    Copy the spectra of a chunk read by a worker out of shared memory and release the shared memory block.
+
+    :param future: Future returned when submitting pyBaf2Sql.parallel._extract_chunk() to the pool.
+    :type future: concurrent.futures.Future
+    :param mz_dtype: Numpy dtype of the m/z arrays.
+    :type mz_dtype: numpy.dtype
+    :param intensity_dtype: Numpy dtype of the intensity arrays.
+    :type intensity_dtype: numpy.dtype
+    :return: Generator of spectrum records.
+    :rtype: collections.abc.Iterator[pyBaf2Sql.classes.BafSpectrumArrays]
+    """
+    name, frames, offsets = future.result()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        mz_array = np.ndarray(int(offsets[-1]), dtype=mz_dtype, buffer=shm.buf).copy()
+        intensity_array = np.ndarray(int(offsets[-1]), dtype=intensity_dtype, buffer=shm.buf,
+                                     offset=_intensity_start(offsets[-1], mz_dtype)).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    for i, frame in enumerate(frames):
+        yield BafSpectrumArrays(frame,
+                                mz_array[offsets[i]:offsets[i + 1]],
+                                intensity_array[offsets[i]:offsets[i + 1]])
+
+
+def _unlink(name):
+    """
+    Release a shared memory block created by a worker process that will not be collected.
+
+    :param name: Name of the shared memory block.
+    :type name: str
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
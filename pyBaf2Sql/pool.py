@@ -0,0 +1,255 @@
+import os
+import threading
+from collections import OrderedDict
+from pyBaf2Sql.baf import open_storage, close_storage
+from pyBaf2Sql.error import throw_last_baf2sql_error
+
+
+_default_handle_pool = None
+
+
+def get_default_handle_pool():
+    """
+    Get the process-wide storage handle pool. The pool is created on first use with the default maximum number of
+    open handles.
+
+    :return: Shared handle pool.
+    :rtype: pyBaf2Sql.pool.HandlePool
+    """
+    global _default_handle_pool
+    if _default_handle_pool is None:
+        _default_handle_pool = HandlePool()
+    return _default_handle_pool
+
+
+def get_storage_key(bruker_d_folder_name, raw_calibration=False):
+    """
+    Get the key under which the storage handle of a BAF dataset is pooled.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True), defaults to False.
+    :type raw_calibration: bool
+    :return: Tuple of the absolute path of the .d directory and raw_calibration.
+    :rtype: tuple
+    """
+    return os.path.abspath(bruker_d_folder_name), bool(raw_calibration)
+
+
+def _get_storage_stat(bruker_d_folder_name):
+    """
+    Get the modification time and size of analysis.baf, used to detect datasets that were rewritten after their
+    handle was pooled.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :return: Tuple of modification time in nanoseconds and size in bytes, or None if analysis.baf does not exist.
+    :rtype: tuple | None
+    """
+    try:
+        stat = os.stat(os.path.join(bruker_d_folder_name, 'analysis.baf'))
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _PoolEntry(object):
+    """
+    Open storage handle held by a pyBaf2Sql.pool.HandlePool.
+
+    :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+    :type baf2sql: ctypes.CDLL
+    :param handle: Handle value for BAF dataset initialized using pyBaf2Sql.baf.open_storage().
+    :type handle: int
+    :param stat: Modification time and size of analysis.baf when the handle was opened.
+    :type stat: tuple | None
+    """
+    def __init__(self, baf2sql, handle, stat):
+        """
+        Constructor Method
+        """
+        self.api = baf2sql
+        self.handle = handle
+        self.stat = stat
+        self.leases = 0
+        self.detached = False
+        # Metadata tables shared by all leases of the handle, keyed by the all_variables flag they were read with.
+        self.analysis = {}
+
+    def close(self):
+        """
+        Close the storage handle.
+        """
+        self.handle = close_storage(self.api, self.handle, None)[0]
+        self.analysis.clear()
+
+
+class StorageLease(object):
+    """
+    Reference counted lease of a pooled storage handle returned by pyBaf2Sql.pool.HandlePool.acquire(). The handle
+    stays open at least until the lease is released.
+
+    :param pool: Pool the lease was acquired from.
+    :type pool: pyBaf2Sql.pool.HandlePool
+    :param key: Key of the pooled handle from pyBaf2Sql.pool.get_storage_key().
+    :type key: tuple
+    :param entry: Pooled handle.
+    :type entry: pyBaf2Sql.pool._PoolEntry
+    """
+    def __init__(self, pool, key, entry):
+        """
+        Constructor Method
+        """
+        self.pool = pool
+        self.key = key
+        self.entry = entry
+        self.handle = entry.handle
+
+    @property
+    def analysis(self):
+        """
+        Metadata tables shared by all leases of the handle, keyed by the all_variables flag they were read with.
+
+        :return: Dictionary of all_variables to pyBaf2Sql.classes.AnalysisTables.
+        :rtype: dict
+        """
+        return self.entry.analysis
+
+    def release(self):
+        """
+        Release the lease. Releasing a lease more than once has no effect.
+        """
+        if self.entry is not None:
+            self.pool.release(self)
+            self.entry = None
+            self.handle = None
+
+
+class HandlePool(object):
+    """
+    Thread-safe pool of Baf2Sql storage handles keyed by the .d directory path and raw_calibration. Handles are
+    leased with reference counting, so a dataset that is opened again while it is in the pool skips open_storage and
+    reuses the metadata tables read by earlier leases. When more than max_handles handles are open, the least
+    recently used handles without any outstanding leases are closed. Leased handles are never closed, so the number
+    of open handles can exceed max_handles while that many datasets are in use.
+
+    :param max_handles: Maximum number of open handles to keep, defaults to 16.
+    :type max_handles: int
+    """
+    def __init__(self, max_handles=16):
+        """
+        Constructor Method
+        """
+        self.max_handles = max_handles
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def acquire(self, baf2sql, bruker_d_folder_name, raw_calibration=False):
+        """
+        Lease the storage handle of a BAF dataset, opening it if it is not in the pool. A pooled handle is reopened if
+        it was opened by a different library or analysis.baf has changed since it was opened.
+
+        :param baf2sql: Library initialized by pyBaf2Sql.init_baf2sql.init_baf2sql_api().
+        :type baf2sql: ctypes.CDLL
+        :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+        :type bruker_d_folder_name: str
+        :param raw_calibration: Whether to use recalibrated data (False) or not (True), defaults to False.
+        :type raw_calibration: bool
+        :return: Lease of the storage handle.
+        :rtype: pyBaf2Sql.pool.StorageLease
+        """
+        key = get_storage_key(bruker_d_folder_name, raw_calibration)
+        stat = _get_storage_stat(bruker_d_folder_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry.api is not baf2sql or entry.stat != stat):
+                self._detach(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                handle = open_storage(baf2sql, bruker_d_folder_name, raw_calibration)
+                if handle == 0:
+                    throw_last_baf2sql_error(baf2sql)
+                entry = _PoolEntry(baf2sql, handle, stat)
+                self.entries[key] = entry
+            else:
+                self.hits += 1
+            self.entries.move_to_end(key)
+            entry.leases += 1
+            self._evict()
+            return StorageLease(self, key, entry)
+
+    def release(self, lease):
+        """
+        Release a lease returned by pyBaf2Sql.pool.HandlePool.acquire(). Use pyBaf2Sql.pool.StorageLease.release()
+        instead to guard against releasing a lease twice.
+
+        :param lease: Lease to release.
+        :type lease: pyBaf2Sql.pool.StorageLease
+        """
+        with self.lock:
+            entry = lease.entry
+            entry.leases -= 1
+            if entry.detached:
+                if entry.leases == 0:
+                    entry.close()
+            else:
+                self._evict()
+
+    def _detach(self, key):
+        """
+        Remove a handle from the pool, closing it now if it has no outstanding leases or otherwise when its last lease
+        is released.
+
+        :param key: Key of the pooled handle from pyBaf2Sql.pool.get_storage_key().
+        :type key: tuple
+        """
+        entry = self.entries.pop(key)
+        entry.detached = True
+        if entry.leases == 0:
+            entry.close()
+
+    def _evict(self):
+        """
+        Close the least recently used handles without outstanding leases until at most max_handles handles are open.
+        """
+        while len(self.entries) > self.max_handles:
+            key = next((key for key, entry in self.entries.items() if entry.leases == 0), None)
+            if key is None:
+                break
+            self._detach(key)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all handles from the pool. Handles with outstanding leases are closed when their last lease is released.
+        Counters are not reset.
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._detach(key)
+
+    def get_stats(self):
+        """
+        Get the pool counters.
+
+        :return: Dictionary of hits, misses, evictions, number of pooled handles, number of leased handles, and maximum
+            handles.
+        :rtype: dict
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'handles': len(self.entries),
+                    'leased': sum(1 for entry in self.entries.values() if entry.leases > 0),
+                    'max_handles': self.max_handles}
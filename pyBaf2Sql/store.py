@@ -0,0 +1,359 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from pyBaf2Sql.classes import BafSpectrumArrays
+from pyBaf2Sql.export import iter_spectrum_chunks
+from pyBaf2Sql.util import get_encoding_dtype
+
+
+SPECTRUM_STORE_VERSION = 1
+SPECTRUM_STORE_DIR_NAME = 'pyBaf2Sql_store'
+
+
+def get_spectrum_store_dir(bruker_d_folder_name, mode='centroid', profile_bins=0, mz_encoding=64,
+                           intensity_encoding=64, bin_edges=None, raw_calibration=False, store_dir=None):
+    """
+    Get the directory of the spectrum store of a BAF dataset for a mode and encoding. By default, stores are kept in a
+    "pyBaf2Sql_store" directory inside the .d directory. If a shared store directory is provided, the stores of each
+    dataset are kept in a subdirectory named after a hash of its absolute path.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges shared by all spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True), defaults to False.
+    :type raw_calibration: bool
+    :param store_dir: Shared directory in which to keep spectrum stores, defaults to None.
+    :type store_dir: str | None
+    :return: Path to the spectrum store directory.
+    :rtype: str
+    """
+    if store_dir is None:
+        store_dir = os.path.join(bruker_d_folder_name, SPECTRUM_STORE_DIR_NAME)
+    else:
+        store_dir = os.path.join(store_dir,
+                                 hashlib.sha1(os.path.abspath(bruker_d_folder_name).encode('utf-8')).hexdigest()[:16])
+    mode = 'centroid' if mode == 'raw' else mode
+    name = [mode, str(mz_encoding), str(intensity_encoding)]
+    if mode == 'profile' and bin_edges is not None:
+        edges_hash = hashlib.sha1(np.ascontiguousarray(bin_edges, dtype=np.float64).tobytes()).hexdigest()[:16]
+        name.append('edges' + edges_hash)
+    elif mode == 'profile' and profile_bins != 0:
+        name.append('bins' + str(profile_bins))
+    if raw_calibration:
+        name.append('raw_calibration')
+    return os.path.join(store_dir, '_'.join(name))
+
+
+def get_spectrum_store_key(bruker_d_folder_name, raw_calibration=False):
+    """
+    Get the key identifying the state of the arrays of a BAF dataset, made of the modification time and size of
+    analysis.baf. A spectrum store is only valid if its key matches the current key of the dataset.
+
+    :param bruker_d_folder_name: Path to Bruker .d directory containing analysis.baf and analysis.sqlite.
+    :type bruker_d_folder_name: str
+    :param raw_calibration: Whether to use recalibrated data (False) or not (True), defaults to False.
+    :type raw_calibration: bool
+    :return: Dictionary describing the dataset, or None if analysis.baf does not exist.
+    :rtype: dict | None
+    """
+    try:
+        stat = os.stat(os.path.join(bruker_d_folder_name, 'analysis.baf'))
+    except FileNotFoundError:
+        return None
+    return {'version': SPECTRUM_STORE_VERSION,
+            'raw_calibration': bool(raw_calibration),
+            'analysis.baf': [stat.st_mtime_ns, stat.st_size]}
+
+
+def _read_manifest(store_path):
+    """
+    Read the manifest of a spectrum store.
+
+    :param store_path: Path to the spectrum store directory.
+    :type store_path: str
+    :return: Manifest, or None if it does not exist or cannot be read.
+    :rtype: dict | None
+    """
+    try:
+        with open(os.path.join(store_path, 'manifest.json'), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def materialize_spectra(baf_data, mode='centroid', profile_bins=0, mz_encoding=64, intensity_encoding=64,
+                        bin_edges=None, frames=None, store_dir=None, chunk_size=10000, num_workers=0, overwrite=False):
+    """
+    Decode the spectra of a BAF dataset once into a spectrum store that can be memory-mapped with
+    pyBaf2Sql.store.SpectrumStore. The store holds the concatenated m/z and intensity arrays as flat binary files,
+    the offsets and frame IDs of the spectra, and their metadata with dtype pyBaf2Sql.classes.SPECTRUM_METADATA_DTYPE.
+    The store is written to a temporary directory that replaces any existing store once it is complete. An existing
+    store that matches the current state of analysis.baf is reused unless overwrite=True.
+
+    :param baf_data: BafData object containing metadata from analysis.sqlite database.
+    :type baf_data: pyBaf2Sql.classes.BafData
+    :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+    :type mode: str
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges() shared by all
+        spectra to bin profile mode spectra to.
+    :type bin_edges: numpy.array | None
+    :param frames: IDs of the frames to store, defaults to all frames.
+    :type frames: list[int] | numpy.array | None
+    :param store_dir: Shared directory in which to keep spectrum stores, defaults to storing the store inside the .d
+        directory.
+    :type store_dir: str | None
+    :param chunk_size: Number of spectra decoded and written at once.
+    :type chunk_size: int
+    :param num_workers: Number of worker processes to decode spectra with pyBaf2Sql.parallel.iter_spectra_parallel(),
+        defaults to 0 (decode in the current process).
+    :type num_workers: int
+    :param overwrite: Whether to rebuild an existing valid store, defaults to False.
+    :type overwrite: bool
+    :return: Path to the spectrum store directory.
+    :rtype: str
+    """
+    store_path = get_spectrum_store_dir(baf_data.source_file, mode, profile_bins, mz_encoding, intensity_encoding,
+                                        bin_edges, baf_data.raw_calibration, store_dir)
+    key = get_spectrum_store_key(baf_data.source_file, baf_data.raw_calibration)
+    if frames is None:
+        frames = baf_data.get_frames()
+    frames = np.asarray(frames)
+    manifest = _read_manifest(store_path)
+    if not overwrite and manifest is not None and manifest['key'] == key and \
+            manifest['num_spectra'] == frames.size and \
+            np.array_equal(np.load(os.path.join(store_path, 'frames.npy'), mmap_mode='r'), frames):
+        return store_path
+
+    parent_dir = os.path.dirname(os.path.abspath(store_path))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent_dir)
+    try:
+        offsets = [np.zeros(1, dtype=np.int64)]
+        metadata = []
+        num_elements = 0
+        with open(os.path.join(temp_dir, 'mz.bin'), 'wb') as mz_file, \
+                open(os.path.join(temp_dir, 'intensity.bin'), 'wb') as intensity_file:
+            for chunk_metadata, mz_array, intensity_array, chunk_offsets in \
+                    iter_spectrum_chunks(baf_data, mode=mode, frames=frames, chunk_size=chunk_size,
+                                         profile_bins=profile_bins, mz_encoding=mz_encoding,
+                                         intensity_encoding=intensity_encoding, bin_edges=bin_edges,
+                                         num_workers=num_workers):
+                mz_file.write(mz_array.tobytes())
+                intensity_file.write(intensity_array.tobytes())
+                offsets.append(chunk_offsets[1:] + num_elements)
+                metadata.append(chunk_metadata)
+                num_elements += mz_array.size
+        np.save(os.path.join(temp_dir, 'offsets.npy'), np.concatenate(offsets))
+        np.save(os.path.join(temp_dir, 'frames.npy'), frames)
+        np.save(os.path.join(temp_dir, 'metadata.npy'), np.concatenate(metadata) if metadata else
+                baf_data.get_spectrum_metadata(frames, mode=None))
+        manifest = {'key': key,
+                    'source': os.path.abspath(baf_data.source_file),
+                    'mode': 'centroid' if mode == 'raw' else mode,
+                    'profile_bins': profile_bins,
+                    'bin_edges': None if bin_edges is None else [float(bin_edges[0]), float(bin_edges[-1]),
+                                                                 int(bin_edges.size)],
+                    'mz_encoding': mz_encoding,
+                    'intensity_encoding': intensity_encoding,
+                    'mz_dtype': np.dtype(get_encoding_dtype(mz_encoding)).str,
+                    'intensity_dtype': np.dtype(get_encoding_dtype(intensity_encoding)).str,
+                    'num_spectra': int(frames.size),
+                    'num_elements': int(num_elements)}
+        with open(os.path.join(temp_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        shutil.rmtree(store_path, ignore_errors=True)
+        os.replace(temp_dir, store_path)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return store_path
+
+
+def _map_array(file_name, dtype, size):
+    """
+    Memory-map a flat binary array read-only.
+
+    :param file_name: Path to the binary file.
+    :type file_name: str
+    :param dtype: Numpy dtype of the array.
+    :type dtype: numpy.dtype
+    :param size: Number of elements in the array.
+    :type size: int
+    :return: Read-only array.
+    :rtype: numpy.array
+    """
+    if size == 0:
+        array = np.empty(0, dtype=dtype)
+        array.setflags(write=False)
+        return array
+    return np.memmap(file_name, dtype=dtype, mode='r', shape=(size,))
+
+
+class SpectrumStore(object):
+    """
+    Read-only, memory-mapped spectrum store written by pyBaf2Sql.store.materialize_spectra(). Arrays returned by the
+    store are zero-copy views into the page cache, so any number of processes can open the same store and share one
+    copy of the decoded data. SpectrumStore objects can be pickled; the store is mapped again when unpickled.
+
+    :param store_path: Path to the spectrum store directory.
+    :type store_path: str
+    """
+    def __init__(self, store_path):
+        """
+        Constructor Method
+        """
+        self.store_path = store_path
+        self.manifest = _read_manifest(store_path)
+        if self.manifest is None:
+            raise ValueError('No spectrum store found at ' + str(store_path))
+        self.mode = self.manifest['mode']
+        self.profile_bins = self.manifest['profile_bins']
+        self.mz_encoding = self.manifest['mz_encoding']
+        self.intensity_encoding = self.manifest['intensity_encoding']
+        self.mz_array = _map_array(os.path.join(store_path, 'mz.bin'), np.dtype(self.manifest['mz_dtype']),
+                                   self.manifest['num_elements'])
+        self.intensity_array = _map_array(os.path.join(store_path, 'intensity.bin'),
+                                          np.dtype(self.manifest['intensity_dtype']), self.manifest['num_elements'])
+        self.offsets = np.load(os.path.join(store_path, 'offsets.npy'), mmap_mode='r')
+        self.frames = np.load(os.path.join(store_path, 'frames.npy'), mmap_mode='r')
+        self.metadata = np.load(os.path.join(store_path, 'metadata.npy'), mmap_mode='r')
+        self._frame_order = np.argsort(self.frames, kind='stable')
+        self._sorted_frames = np.asarray(self.frames)[self._frame_order]
+
+    def __reduce__(self):
+        return self.__class__, (self.store_path,)
+
+    def __len__(self):
+        return self.frames.size
+
+    def __contains__(self, frame):
+        return self._get_index(frame) is not None
+
+    def __getitem__(self, frame):
+        return self.get_spectrum(frame)
+
+    def _get_index(self, frame):
+        """
+        Get the position of a frame in the store.
+
+        :param frame: ID of the frame.
+        :type frame: int
+        :return: Position of the frame, or None if it is not in the store.
+        :rtype: int | None
+        """
+        position = int(np.searchsorted(self._sorted_frames, frame))
+        if position == self._sorted_frames.size or self._sorted_frames[position] != frame:
+            return None
+        return int(self._frame_order[position])
+
+    def is_valid(self, bruker_d_folder_name=None):
+        """
+        Check whether the store matches the current state of analysis.baf of its dataset.
+
+        :param bruker_d_folder_name: Path to the .d directory of the dataset, defaults to the path the store was
+            materialized from.
+        :type bruker_d_folder_name: str | None
+        :return: Whether the store is valid.
+        :rtype: bool
+        """
+        if bruker_d_folder_name is None:
+            bruker_d_folder_name = self.manifest['source']
+        return get_spectrum_store_key(bruker_d_folder_name, self.manifest['key']['raw_calibration']) == \
+            self.manifest['key']
+
+    def get_spectrum(self, frame):
+        """
+        Get zero-copy views of the m/z and intensity arrays of a spectrum.
+
+        :param frame: ID of the frame.
+        :type frame: int
+        :return: Tuple of mz_array (np.array) and intensity_array (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        index = self._get_index(frame)
+        if index is None:
+            raise KeyError(frame)
+        start = int(self.offsets[index])
+        stop = int(self.offsets[index + 1])
+        return self.mz_array[start:stop], self.intensity_array[start:stop]
+
+    def extract_baf_spectrum(self, frame, mode, profile_bins=0, mz_encoding=64, intensity_encoding=64, out=None,
+                             bin_edges=None):
+        """
+        Get the arrays of a spectrum with the same arguments as pyBaf2Sql.baf.extract_baf_spectrum(). The mode,
+        binning, and encodings must match the ones the store was materialized with.
+
+        :param frame: Frame to extract spectrum from.
+        :type frame: int
+        :param mode: Data array mode, either "profile", "centroid", "centroid_from_profile", or "raw".
+        :type mode: str
+        :param profile_bins: Number of bins to bin spectrum to.
+        :type profile_bins: int
+        :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+        :type mz_encoding: int
+        :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+        :type intensity_encoding: int
+        :param out: Optional tuple of (mz_out, intensity_out) buffers to copy the arrays into; the returned arrays are
+            then views of these buffers. By default, zero-copy views into the store are returned.
+        :type out: tuple[numpy.array] | None
+        :param bin_edges: Array of evenly spaced bin edges shared by all spectra to bin profile mode spectra to.
+        :type bin_edges: numpy.array | None
+        :return: Tuple of mz_array (np.array) and intensity_array (np.array).
+        :rtype: tuple[numpy.array]
+        """
+        mode = 'centroid' if mode == 'raw' else mode
+        if bin_edges is not None:
+            binning = [float(bin_edges[0]), float(bin_edges[-1]), int(bin_edges.size)]
+        else:
+            binning = None
+        if mode != self.mode or mz_encoding != self.mz_encoding or intensity_encoding != self.intensity_encoding or \
+                (mode == 'profile' and (profile_bins != self.profile_bins or binning != self.manifest['bin_edges'])):
+            raise ValueError('Spectrum store ' + str(self.store_path) + ' was materialized with mode=' + self.mode +
+                             ', profile_bins=' + str(self.profile_bins) + ', mz_encoding=' + str(self.mz_encoding) +
+                             ', intensity_encoding=' + str(self.intensity_encoding) + '.')
+        mz_array, intensity_array = self.get_spectrum(frame)
+        if out is not None:
+            mz_out = out[0][:mz_array.size]
+            intensity_out = out[1][:intensity_array.size]
+            mz_out[:] = mz_array
+            intensity_out[:] = intensity_array
+            return mz_out, intensity_out
+        return mz_array, intensity_array
+
+    def iter_spectra(self, frames=None):
+        """
+        Iterate over spectra in the store, yielding pyBaf2Sql.classes.BafSpectrumArrays records of zero-copy views.
+
+        :param frames: IDs of the frames to read in the order they should be yielded, defaults to all frames in the
+            order they were stored.
+        :type frames: list[int] | numpy.array | None
+        :return: Generator of spectrum records.
+        :rtype: collections.abc.Iterator[pyBaf2Sql.classes.BafSpectrumArrays]
+        """
+        if frames is None:
+            offsets = np.asarray(self.offsets)
+            for index, frame in enumerate(self.frames.tolist()):
+                yield BafSpectrumArrays(frame,
+                                        self.mz_array[offsets[index]:offsets[index + 1]],
+                                        self.intensity_array[offsets[index]:offsets[index + 1]])
+        else:
+            for frame in frames:
+                yield BafSpectrumArrays(int(frame), *self.get_spectrum(frame))
@@ -24,7 +24,7 @@ def get_centroid_status(mode):
     """
     Use "mode" command line parameter to determine whether output data is centroided in psims compatible format.
 
-    :param mode: Mode command line parameter, either "profile", "centroid", or "raw".
+    :param mode: Mode command line parameter, either "profile", "centroid", "centroid_from_profile", or "raw".
     :type mode: str
     :return: Dictionary containing standard spectrum data.
     :return: Tuple of (centroided status (bool), exclude_mobility status (bool))
@@ -32,13 +32,62 @@ def get_centroid_status(mode):
     """
     if mode == 'profile':
         return False
-    elif mode == 'centroid' or mode == 'raw':
+    elif mode == 'centroid' or mode == 'raw' or mode == 'centroid_from_profile':
         return True
 
 
-def bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding):
+def get_profile_bin_edges(mz_lower, mz_upper, profile_bins, mz_encoding=64):
     """
-    Bin profile mode spectrum into N number of bins.
+    Get evenly spaced bin edges used to bin profile mode spectra into N number of bins. The edges can be computed once
+    for a whole run and passed to pyBaf2Sql.util.bin_profile_spectrum() so that all spectra share the same bins.
+
+    :param mz_lower: Lower m/z bound of the first bin.
+    :type mz_lower: float
+    :param mz_upper: m/z of the last bin edge.
+    :type mz_upper: float
+    :param profile_bins: Number of bins to bin spectrum to.
+    :type profile_bins: int
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :return: Array of bin edges.
+    :rtype: numpy.array
+    """
+    return np.linspace(float(mz_lower), float(mz_upper), profile_bins, dtype=get_encoding_dtype(mz_encoding))
+
+
+def get_bin_indices(mz_array, bin_edges):
+    """
+    Assign m/z values to evenly spaced bins in O(n) by direct computation rather than searching the bin edges. Indices
+    follow numpy.digitize(mz_array, bin_edges): index i holds values with bin_edges[i - 1] <= m/z < bin_edges[i], 0
+    holds values below the first edge, and len(bin_edges) holds values at or above the last edge.
+
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges().
+    :type bin_edges: numpy.array
+    :return: Array of bin indices.
+    :rtype: numpy.array
+    """
+    if bin_edges.size < 2:
+        return (mz_array >= bin_edges[0]).astype(np.int64)
+    lower = float(bin_edges[0])
+    width = (float(bin_edges[-1]) - lower) / (bin_edges.size - 1)
+    if not np.isfinite(width) or width <= 0:
+        # Edges without a usable spacing, e.g. a single-point spectrum binned to its own m/z range.
+        return np.searchsorted(bin_edges, mz_array, side='right').astype(np.int64)
+    bin_indices = np.floor((mz_array - lower) / width).astype(np.int64) + 1
+    np.clip(bin_indices, 0, bin_edges.size, out=bin_indices)
+    # Correct values on bin edges that were assigned to a neighbouring bin due to floating point rounding.
+    padded_edges = np.concatenate(([-np.inf], bin_edges, [np.inf]))
+    bin_indices -= mz_array < padded_edges[bin_indices]
+    bin_indices += mz_array >= padded_edges[bin_indices + 1]
+    return bin_indices
+
+
+def bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding, bin_edges=None, mz_sorted=True):
+    """
+    Bin profile mode spectrum into N number of bins. Each non-empty bin is represented by the mean m/z and summed
+    intensity of its data points. If no bin edges are provided, the bins span the m/z range of the spectrum itself.
 
     :param mz_array: Array containing m/z values.
     :type mz_array: numpy.array
@@ -48,15 +97,318 @@ def bin_profile_spectrum(mz_array, intensity_array, profile_bins, mz_encoding):
     :type profile_bins: int
     :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
     :type mz_encoding: int
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges(), defaults to
+        edges spanning the m/z range of the spectrum.
+    :type bin_edges: numpy.array | None
+    :param mz_sorted: Whether the m/z array is sorted in ascending order, which allows bins to be aggregated without
+        counting every bin, defaults to True.
+    :type mz_sorted: bool
     :return: Tuple of binned_mz_array (np.array) and binned_intensity_array (np.array).
     :rtype: tuple[numpy.array]
     """
-    mz_acq_range_lower = float(mz_array[0])
-    mz_acq_range_upper = float(mz_array[-1])
-    bins = np.linspace(mz_acq_range_lower, mz_acq_range_upper, profile_bins, dtype=get_encoding_dtype(mz_encoding))
-    unique_indices, inverse_indices = np.unique(np.digitize(mz_array, bins), return_inverse=True)
-    bin_counts = np.bincount(inverse_indices)
-    np.place(bin_counts, bin_counts < 1, [1])
-    mz_array = np.bincount(inverse_indices, weights=mz_array) / bin_counts
-    intensity_array = np.bincount(inverse_indices, weights=intensity_array)
-    return mz_array, intensity_array
\ No newline at end of file
+    if mz_array.size == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+    if bin_edges is None:
+        bin_edges = get_profile_bin_edges(mz_array[0], mz_array[-1], profile_bins, mz_encoding)
+    bin_indices = get_bin_indices(mz_array, bin_edges)
+    if mz_sorted:
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bin_indices)) + 1))
+        bin_counts = np.diff(np.append(starts, bin_indices.size))
+        mz_array = np.add.reduceat(mz_array, starts, dtype=np.float64) / bin_counts
+        intensity_array = np.add.reduceat(intensity_array, starts, dtype=np.float64)
+    else:
+        bin_counts = np.bincount(bin_indices)
+        nonempty = bin_counts > 0
+        mz_array = np.bincount(bin_indices, weights=mz_array)[nonempty] / bin_counts[nonempty]
+        intensity_array = np.bincount(bin_indices, weights=intensity_array)[nonempty]
+    return mz_array, intensity_array
+
+
+def bin_profile_spectra(mz_arrays, intensity_arrays, bin_edges, intensity_encoding=64):
+    """
+    Bin a batch of profile mode spectra onto a shared set of bins as a 2D matrix of summed intensities with one row
+    per spectrum. Column j holds the intensities of data points with bin_edges[j] <= m/z < bin_edges[j] + bin width;
+    data points outside of the bins are dropped.
+
+    :param mz_arrays: List of arrays containing m/z values.
+    :type mz_arrays: list[numpy.array]
+    :param intensity_arrays: List of arrays containing intensity values.
+    :type intensity_arrays: list[numpy.array]
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges().
+    :type bin_edges: numpy.array
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :return: Matrix of binned intensities with shape (number of spectra, number of bins).
+    :rtype: numpy.array
+    """
+    num_bins = bin_edges.size
+    num_spectra = len(mz_arrays)
+    if num_spectra == 0:
+        return np.zeros((0, num_bins), dtype=get_encoding_dtype(intensity_encoding))
+    counts = np.array([i.size for i in mz_arrays], dtype=np.int64)
+    mz_array = np.concatenate(list(mz_arrays))
+    intensity_array = np.concatenate(list(intensity_arrays))
+    bin_indices = get_bin_indices(mz_array, bin_edges) - 1
+    if num_bins > 1:
+        upper = float(bin_edges[-1]) + (float(bin_edges[-1]) - float(bin_edges[0])) / (num_bins - 1)
+        keep = (bin_indices >= 0) & (mz_array < upper)
+    else:
+        keep = bin_indices >= 0
+    flat_indices = np.repeat(np.arange(num_spectra, dtype=np.int64) * num_bins, counts) + bin_indices
+    matrix = np.bincount(flat_indices[keep], weights=intensity_array[keep], minlength=num_spectra * num_bins)
+    return matrix.reshape(num_spectra, num_bins).astype(get_encoding_dtype(intensity_encoding), copy=False)
+
+
+def bin_spectra_sparse(mz_arrays, intensity_arrays, bin_edges, intensity_encoding=64):
+    """
+    Bin a batch of spectra onto a shared set of bins as a sparse matrix of summed intensities in compressed sparse row
+    (CSR) format with one row per spectrum. Bins follow pyBaf2Sql.util.bin_profile_spectra(), but only non-zero bins
+    are stored, so the matrix stays small for centroid mode spectra or large numbers of bins. The m/z array of each
+    spectrum must be sorted in ascending order.
+
+    :param mz_arrays: List of arrays containing m/z values.
+    :type mz_arrays: list[numpy.array]
+    :param intensity_arrays: List of arrays containing intensity values.
+    :type intensity_arrays: list[numpy.array]
+    :param bin_edges: Array of evenly spaced bin edges from pyBaf2Sql.util.get_profile_bin_edges().
+    :type bin_edges: numpy.array
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :return: Tuple of indptr (np.array) with N + 1 row offsets, indices (np.array) of the bins, and data (np.array) of
+        the summed intensities for N spectra.
+    :rtype: tuple[numpy.array]
+    """
+    num_bins = bin_edges.size
+    num_spectra = len(mz_arrays)
+    indptr = np.zeros(num_spectra + 1, dtype=np.int64)
+    if num_spectra == 0:
+        return indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=get_encoding_dtype(intensity_encoding))
+    counts = np.array([i.size for i in mz_arrays], dtype=np.int64)
+    mz_array = np.concatenate([np.asarray(i, dtype=np.float64) for i in mz_arrays] + [np.empty(0)])
+    intensity_array = np.concatenate([np.asarray(i, dtype=np.float64) for i in intensity_arrays] + [np.empty(0)])
+    bin_indices = get_bin_indices(mz_array, bin_edges) - 1
+    if num_bins > 1:
+        upper = float(bin_edges[-1]) + (float(bin_edges[-1]) - float(bin_edges[0])) / (num_bins - 1)
+        keep = (bin_indices >= 0) & (mz_array < upper)
+    else:
+        keep = bin_indices >= 0
+    flat_indices = (np.repeat(np.arange(num_spectra, dtype=np.int64) * num_bins, counts) + bin_indices)[keep]
+    intensity_array = intensity_array[keep]
+    if flat_indices.size == 0:
+        return indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=get_encoding_dtype(intensity_encoding))
+    # Sorted m/z arrays give non-decreasing flat indices, so each run of equal indices is one bin of one spectrum.
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(flat_indices)) + 1))
+    data = np.add.reduceat(intensity_array, starts)
+    flat_indices = flat_indices[starts]
+    nonzero = data != 0
+    data = data[nonzero]
+    flat_indices = flat_indices[nonzero]
+    np.cumsum(np.bincount(flat_indices // num_bins, minlength=num_spectra), out=indptr[1:])
+    return indptr, flat_indices % num_bins, data.astype(get_encoding_dtype(intensity_encoding), copy=False)
+
+
+def centroid_profile_spectrum(mz_array, intensity_array, peak_height_fraction=0.5, min_intensity=0, mz_encoding=64,
+                              intensity_encoding=64):
+    """
+    Centroid a profile mode spectrum with pyBaf2Sql.util.centroid_profile_spectra().
+
+    :param mz_array: Array containing m/z values in ascending order.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param peak_height_fraction: Fraction of the apex intensity above which points of a peak contribute to its
+        centroid, defaults to 0.5 (points within the full width at half maximum).
+    :type peak_height_fraction: float
+    :param min_intensity: Minimum apex intensity of a peak, defaults to 0.
+    :type min_intensity: float
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :return: Tuple of centroid_mz_array (np.array) and centroid_intensity_array (np.array).
+    :rtype: tuple[numpy.array]
+    """
+    mz_array, intensity_array, _ = centroid_profile_spectra(mz_array,
+                                                            intensity_array,
+                                                            np.array([0, mz_array.size], dtype=np.int64),
+                                                            peak_height_fraction,
+                                                            min_intensity,
+                                                            mz_encoding,
+                                                            intensity_encoding)
+    return mz_array, intensity_array
+
+
+def centroid_profile_spectra(mz_arrays, intensity_arrays, offsets=None, peak_height_fraction=0.5, min_intensity=0,
+                             mz_encoding=64, intensity_encoding=64):
+    """
+    Centroid a batch of profile mode spectra at once. Each spectrum is split into peaks at its local minima, so that
+    every peak holds exactly one local maximum, and each peak is represented by the intensity weighted mean m/z of its
+    points at or above peak_height_fraction of the apex and by its apex intensity. All spectra are processed in a few
+    vectorized passes over their concatenated arrays. Spectra can either be provided as lists of arrays or as
+    concatenated arrays with offsets, where the spectrum i spans offsets[i]:offsets[i + 1].
+
+    :param mz_arrays: List of arrays containing m/z values in ascending order or a concatenated array if offsets is
+        provided.
+    :type mz_arrays: list[numpy.array] | numpy.array
+    :param intensity_arrays: List of arrays containing intensity values or a concatenated array if offsets is
+        provided.
+    :type intensity_arrays: list[numpy.array] | numpy.array
+    :param offsets: Array of N + 1 offsets of the N spectra in the concatenated arrays, defaults to None.
+    :type offsets: numpy.array | None
+    :param peak_height_fraction: Fraction of the apex intensity above which points of a peak contribute to its
+        centroid, defaults to 0.5 (points within the full width at half maximum).
+    :type peak_height_fraction: float
+    :param min_intensity: Minimum apex intensity of a peak, defaults to 0.
+    :type min_intensity: float
+    :param mz_encoding: m/z encoding command line parameter, either "64" or "32".
+    :type mz_encoding: int
+    :param intensity_encoding: Intensity encoding command line parameter, either "64" or "32".
+    :type intensity_encoding: int
+    :return: Tuple of the concatenated centroid_mz_array (np.array), centroid_intensity_array (np.array), and N + 1
+        offsets (np.array) of the centroided spectra.
+    :rtype: tuple[numpy.array]
+    """
+    if offsets is None:
+        offsets = np.zeros(len(mz_arrays) + 1, dtype=np.int64)
+        np.cumsum([i.size for i in mz_arrays], out=offsets[1:])
+        mz_array = np.concatenate([np.asarray(i, dtype=np.float64) for i in mz_arrays] + [np.empty(0)])
+        intensity_array = np.concatenate([np.asarray(i, dtype=np.float64) for i in intensity_arrays] + [np.empty(0)])
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        mz_array = np.asarray(mz_arrays, dtype=np.float64)[offsets[0]:offsets[-1]]
+        intensity_array = np.asarray(intensity_arrays, dtype=np.float64)[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+    num_points = intensity_array.size
+    num_spectra = offsets.size - 1
+    centroid_offsets = np.zeros(num_spectra + 1, dtype=np.int64)
+    if num_points == 0:
+        return (np.empty(0, dtype=get_encoding_dtype(mz_encoding)),
+                np.empty(0, dtype=get_encoding_dtype(intensity_encoding)),
+                centroid_offsets)
+
+    # A peak starts at the first point of each spectrum and after every local minimum within a spectrum.
+    spectrum_start = np.zeros(num_points + 1, dtype=bool)
+    spectrum_start[offsets[:-1][np.diff(offsets) > 0]] = True
+    peak_start = spectrum_start[:-1].copy()
+    slope = np.diff(intensity_array)
+    peak_start[1:-1] |= (slope[:-1] < 0) & (slope[1:] >= 0) & ~spectrum_start[2:-1]
+    starts = np.flatnonzero(peak_start)
+    counts = np.diff(np.append(starts, num_points))
+
+    apex = np.maximum.reduceat(intensity_array, starts)
+    weights = np.where(intensity_array >= np.repeat(apex * peak_height_fraction, counts), intensity_array, 0)
+    weight_sums = np.add.reduceat(weights, starts)
+    keep = (apex > min_intensity) & (weight_sums > 0)
+    centroid_mz = np.add.reduceat(weights * mz_array, starts)[keep] / weight_sums[keep]
+    peak_spectra = np.searchsorted(offsets, starts[keep], side='right') - 1
+    np.cumsum(np.bincount(peak_spectra, minlength=num_spectra), out=centroid_offsets[1:])
+    return (centroid_mz.astype(get_encoding_dtype(mz_encoding), copy=False),
+            apex[keep].astype(get_encoding_dtype(intensity_encoding), copy=False),
+            centroid_offsets)
+
+
+def get_window_sums(mz_array, intensity_array, mz_lower, mz_upper):
+    """
+    Sum the intensities of a spectrum within a batch of m/z windows using binary search on the sorted m/z array and a
+    cumulative sum of the intensities.
+
+    :param mz_array: Array containing m/z values in ascending order.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param mz_lower: Array containing the lower m/z bound of each window (inclusive).
+    :type mz_lower: numpy.array
+    :param mz_upper: Array containing the upper m/z bound of each window (inclusive).
+    :type mz_upper: numpy.array
+    :return: Array containing the summed intensity of each window.
+    :rtype: numpy.array
+    """
+    cumulative_intensity = np.zeros(intensity_array.size + 1, dtype=np.float64)
+    np.cumsum(intensity_array, dtype=np.float64, out=cumulative_intensity[1:])
+    lower_indices = np.searchsorted(mz_array, mz_lower, side='left')
+    upper_indices = np.searchsorted(mz_array, mz_upper, side='right')
+    return cumulative_intensity[upper_indices] - cumulative_intensity[lower_indices]
+
+
+def get_spectrum_summary(mz_array, intensity_array, mz_sorted=True):
+    """
+    Get the total ion current, base peak, and m/z range of a spectrum. If the m/z array is sorted, the m/z range is
+    taken from its first and last values instead of searching the array.
+
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param mz_sorted: Whether the m/z array is sorted in ascending order, defaults to True.
+    :type mz_sorted: bool
+    :return: Tuple of total_ion_current, base_peak_mz, base_peak_intensity, low_mz, and high_mz (float).
+    :rtype: tuple[float]
+    """
+    base_peak_index = int(np.argmax(intensity_array))
+    if mz_sorted:
+        low_mz, high_mz = mz_array[0], mz_array[-1]
+    else:
+        low_mz, high_mz = np.min(mz_array), np.max(mz_array)
+    return (float(np.sum(intensity_array, dtype=np.float64)),
+            float(mz_array[base_peak_index]),
+            float(intensity_array[base_peak_index]),
+            float(low_mz),
+            float(high_mz))
+
+
+def get_spectra_summary(mz_arrays, intensity_arrays, offsets=None, mz_sorted=True):
+    """
+    Get the total ion current, base peak, and m/z range of a batch of spectra at once. Spectra can either be provided
+    as lists of arrays or as concatenated arrays with offsets, where the spectrum i spans offsets[i]:offsets[i + 1].
+    Spectra without any data points get a total ion current of 0 and NaN for all other values.
+
+    :param mz_arrays: List of arrays containing m/z values or a concatenated array if offsets is provided.
+    :type mz_arrays: list[numpy.array] | numpy.array
+    :param intensity_arrays: List of arrays containing intensity values or a concatenated array if offsets is
+        provided.
+    :type intensity_arrays: list[numpy.array] | numpy.array
+    :param offsets: Array of N + 1 offsets of the N spectra in the concatenated arrays, defaults to None.
+    :type offsets: numpy.array | None
+    :param mz_sorted: Whether the m/z array of each spectrum is sorted in ascending order, defaults to True.
+    :type mz_sorted: bool
+    :return: Tuple of total_ion_current, base_peak_mz, base_peak_intensity, low_mz, and high_mz arrays.
+    :rtype: tuple[numpy.array]
+    """
+    if offsets is None:
+        offsets = np.zeros(len(mz_arrays) + 1, dtype=np.int64)
+        np.cumsum([i.size for i in mz_arrays], out=offsets[1:])
+        mz_array = np.concatenate(list(mz_arrays) + [np.empty(0)])
+        intensity_array = np.concatenate(list(intensity_arrays) + [np.empty(0)])
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        mz_array = np.asarray(mz_arrays)[offsets[0]:offsets[-1]]
+        intensity_array = np.asarray(intensity_arrays)[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    starts = offsets[:-1][nonempty]
+    ends = offsets[1:][nonempty]
+
+    total_ion_current = np.zeros(counts.size, dtype=np.float64)
+    base_peak_mz = np.full(counts.size, np.nan)
+    base_peak_intensity = np.full(counts.size, np.nan)
+    low_mz = np.full(counts.size, np.nan)
+    high_mz = np.full(counts.size, np.nan)
+    if starts.size == 0:
+        return total_ion_current, base_peak_mz, base_peak_intensity, low_mz, high_mz
+
+    # Segments of empty spectra have been dropped, so reduceat over starts only spans nonempty spectra.
+    total_ion_current[nonempty] = np.add.reduceat(intensity_array, starts, dtype=np.float64)
+    max_intensity = np.maximum.reduceat(intensity_array, starts)
+    is_max = intensity_array == np.repeat(max_intensity, counts[nonempty])
+    base_peak_indices = np.minimum.reduceat(np.where(is_max, np.arange(intensity_array.size), intensity_array.size),
+                                            starts)
+    base_peak_mz[nonempty] = mz_array[base_peak_indices]
+    base_peak_intensity[nonempty] = max_intensity
+    if mz_sorted:
+        low_mz[nonempty] = mz_array[starts]
+        high_mz[nonempty] = mz_array[ends - 1]
+    else:
+        low_mz[nonempty] = np.minimum.reduceat(mz_array, starts)
+        high_mz[nonempty] = np.maximum.reduceat(mz_array, starts)
+    return total_ion_current, base_peak_mz, base_peak_intensity, low_mz, high_mz
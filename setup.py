@@ -10,4 +10,10 @@ setup(name='pyBaf2Sql',
       packages=['pyBaf2Sql', 'Baf2Sql'],
       include_package_data=True,
       package_data={'': ['*.dll', '*.so']},
-      install_requires=['numpy', 'pandas'])
+      install_requires=['numpy', 'pandas'],
+      extras_require={'parquet': ['pyarrow'],
+                      'hdf5': ['h5py'],
+                      'zarr': ['zarr'],
+                      'imaging': ['scipy'],
+                      'numpress': ['pynumpress']},
+      entry_points={'console_scripts': ['pyBaf2Sql-batch=pyBaf2Sql.batch:main']})
@@ -0,0 +1,379 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import pyBaf2Sql.batch
+from pyBaf2Sql.baf import extract_baf_spectrum
+from pyBaf2Sql.cache import is_metadata_cache_valid, load_metadata_cache, save_metadata_cache
+from pyBaf2Sql.classes import BafData, BafSpectrum
+from pyBaf2Sql.imaging import find_coordinates
+from pyBaf2Sql.mzml import write_mzml
+from pyBaf2Sql.pool import HandlePool
+from pyBaf2Sql.store import SpectrumStore, materialize_spectra
+from pyBaf2Sql.util import (bin_profile_spectra, bin_profile_spectrum, centroid_profile_spectra,
+                            centroid_profile_spectrum, get_bin_indices, get_profile_bin_edges)
+from synthetic_baf2sql import ARRAY_INDEX_FILE_NAME, SyntheticBaf2Sql, make_synthetic_dataset
+
+
+NUM_SPECTRA = 24
+
+
+class CrashingBaf2Sql(SyntheticBaf2Sql):
+    """
+    Synthetic library that terminates the process when a dataset named crash.d is opened.
+    """
+    def _array_open_storage(self, raw_calibration, baf_file_name):
+        if b'crash.d' in os.fsencode(baf_file_name):
+            os._exit(3)
+        return super()._array_open_storage(raw_calibration, baf_file_name)
+
+
+def get_known_arrays(bruker_d_folder_name, frame):
+    """
+    Read the arrays of a frame straight from the synthetic analysis.baf, in which frame i stores its profile m/z,
+    profile intensity, centroid m/z, and centroid intensity arrays as array IDs 4i - 3 to 4i.
+    """
+    data = np.fromfile(os.path.join(bruker_d_folder_name, 'analysis.baf'), dtype=np.float64)
+    index = np.load(os.path.join(bruker_d_folder_name, ARRAY_INDEX_FILE_NAME))
+    arrays = [data[offset:offset + length] for offset, length in index[4 * frame - 4:4 * frame]]
+    return {'profile': (arrays[0], arrays[1]), 'centroid': (arrays[2], arrays[3])}
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return make_synthetic_dataset(str(tmp_path / 'run.d'), num_spectra=NUM_SPECTRA, profile_points=200,
+                                  centroid_points=20)
+
+
+@pytest.fixture
+def baf_data(dataset):
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        yield baf_data
+
+
+@pytest.mark.parametrize('mode', ['centroid', 'profile'])
+def test_extract_baf_spectrum(dataset, baf_data, mode):
+    for frame in (1, 2, NUM_SPECTRA):
+        mz_array, intensity_array = extract_baf_spectrum(baf_data, frame, mode)
+        known_mz_array, known_intensity_array = get_known_arrays(dataset, frame)[mode]
+        np.testing.assert_array_equal(mz_array, known_mz_array)
+        np.testing.assert_array_equal(intensity_array, known_intensity_array)
+
+
+def test_extract_baf_spectrum_encoding(dataset, baf_data):
+    mz_array, intensity_array = extract_baf_spectrum(baf_data, 3, 'centroid', mz_encoding=32, intensity_encoding=32)
+    known_mz_array, known_intensity_array = get_known_arrays(dataset, 3)['centroid']
+    assert mz_array.dtype == np.float32 and intensity_array.dtype == np.float32
+    np.testing.assert_array_equal(mz_array, known_mz_array.astype(np.float32))
+    np.testing.assert_array_equal(intensity_array, known_intensity_array.astype(np.float32))
+
+
+def test_bin_profile_spectra(dataset, baf_data):
+    profile_arrays = [get_known_arrays(dataset, frame)['profile'] for frame in range(1, NUM_SPECTRA + 1)]
+    # Column j of the matrix holds the data points of bin j + 1 of bin_profile_spectrum(), including the last profile
+    # point, which lies on the last edge.
+    bin_edges = get_profile_bin_edges(100.0, 1000.0, 37)
+    matrix = bin_profile_spectra([i[0] for i in profile_arrays], [i[1] for i in profile_arrays], bin_edges)
+    assert matrix.shape == (NUM_SPECTRA, 37)
+    for row, (mz_array, intensity_array) in zip(matrix, profile_arrays):
+        binned_mz_array, binned_intensity_array = bin_profile_spectrum(mz_array, intensity_array, 37, 64, bin_edges)
+        columns = np.unique(get_bin_indices(mz_array, bin_edges)) - 1
+        np.testing.assert_allclose(row[columns], binned_intensity_array)
+        np.testing.assert_allclose(np.delete(row, columns), 0)
+        assert np.all(binned_mz_array >= bin_edges[columns])
+    np.testing.assert_allclose(baf_data.get_binned_matrix(bin_edges), matrix)
+
+
+def centroid_reference(mz_array, intensity_array, peak_height_fraction=0.5):
+    """
+    Centroid a profile spectrum one peak at a time, starting a new peak after every local minimum.
+    """
+    starts = [0] + [i for i in range(1, mz_array.size - 1)
+                    if intensity_array[i] < intensity_array[i - 1] and intensity_array[i + 1] >= intensity_array[i]]
+    centroid_mz = []
+    centroid_intensity = []
+    for start, stop in zip(starts, starts[1:] + [mz_array.size]):
+        apex = intensity_array[start:stop].max()
+        weights = np.where(intensity_array[start:stop] >= apex * peak_height_fraction, intensity_array[start:stop], 0)
+        if apex > 0 and weights.sum() > 0:
+            centroid_mz.append(np.sum(weights * mz_array[start:stop]) / weights.sum())
+            centroid_intensity.append(apex)
+    return np.array(centroid_mz), np.array(centroid_intensity)
+
+
+def test_centroid_profile_spectrum_gaussian_peaks():
+    mz_array = np.round(np.arange(199.7, 200.6, 0.001), 6)
+    intensity_array = (1000 * np.exp(-0.5 * ((mz_array - 200.0) / 0.05) ** 2) +
+                       500 * np.exp(-0.5 * ((mz_array - 200.3) / 0.05) ** 2))
+    centroid_mz, centroid_intensity = centroid_profile_spectrum(mz_array, intensity_array)
+    # Overlapping peaks are split at the minimum between them, and the intensity weighted mean of the points within
+    # the full width at half maximum of a symmetric peak is its apex.
+    np.testing.assert_allclose(centroid_mz, [200.0, 200.3], atol=1e-6)
+    np.testing.assert_allclose(centroid_intensity, [intensity_array.max(), intensity_array[mz_array == 200.3][0]])
+
+    centroid_mz, _ = centroid_profile_spectrum(mz_array, intensity_array, min_intensity=600)
+    np.testing.assert_allclose(centroid_mz, [200.0], atol=1e-6)
+
+
+def test_centroid_profile_spectra(dataset, baf_data):
+    profile_arrays = [get_known_arrays(dataset, frame)['profile'] for frame in range(1, NUM_SPECTRA + 1)]
+    centroid_mz, centroid_intensity, offsets = centroid_profile_spectra([i[0] for i in profile_arrays],
+                                                                        [i[1] for i in profile_arrays])
+    assert offsets.size == NUM_SPECTRA + 1
+    for frame, (mz_array, intensity_array) in enumerate(profile_arrays, start=1):
+        known_mz_array, known_intensity_array = centroid_reference(mz_array, intensity_array)
+        np.testing.assert_allclose(centroid_mz[offsets[frame - 1]:offsets[frame]], known_mz_array)
+        np.testing.assert_array_equal(centroid_intensity[offsets[frame - 1]:offsets[frame]], known_intensity_array)
+        np.testing.assert_allclose(extract_baf_spectrum(baf_data, frame, 'centroid_from_profile')[0], known_mz_array)
+
+
+def test_baf_spectrum(dataset, baf_data):
+    ms1 = BafSpectrum(baf_data, 1, 'centroid')
+    known_mz_array, known_intensity_array = get_known_arrays(dataset, 1)['centroid']
+    np.testing.assert_array_equal(ms1.mz_array, known_mz_array)
+    np.testing.assert_array_equal(ms1.intensity_array, known_intensity_array)
+    assert ms1.ms_level == 1
+    assert ms1.polarity == '+'
+    assert ms1.retention_time == pytest.approx(0.5 / 60)
+    assert ms1.total_ion_current == pytest.approx(known_intensity_array.sum())
+    assert ms1.base_peak_mz == known_mz_array[np.argmax(known_intensity_array)]
+    assert ms1.coord is None
+
+    ms2 = BafSpectrum(baf_data, 2, 'centroid')
+    assert ms2.ms_level == 2
+    assert ms2.parent_frame == 1
+    assert ms2.target_mz == baf_data.get_variable(2, 7)
+    assert ms2.charge_state == 2.0
+    assert ms2.collision_energy == 25.0
+
+
+def test_select(dataset):
+    # Make the MS/MS acquisition key negative so that the polarity filter has spectra to tell apart.
+    with sqlite3.connect(os.path.join(dataset, 'analysis.sqlite')) as conn:
+        conn.execute('UPDATE AcquisitionKeys SET Polarity = 1 WHERE Id = 2')
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        spectra = baf_data.analysis['Spectra'].merge(baf_data.analysis['AcquisitionKeys'], left_on='AcquisitionKey',
+                                                     right_on='Id', suffixes=('', '_key'))
+        spectra = spectra.merge(baf_data.analysis['Steps'], left_on='Id', right_on='TargetSpectrum', how='left')
+        spectra['RtMinutes'] = spectra['Rt'] / 60
+        spectra['MsLevel'] = np.where(spectra['ScanMode'] == 0, 1, 2)
+        filters = [({}, np.ones(len(spectra), dtype=bool)),
+                   ({'rt_range': (0.05, 0.15)}, spectra['RtMinutes'].between(0.05, 0.15)),
+                   ({'ms_level': 1}, spectra['MsLevel'] == 1),
+                   ({'ms_level': [1, 2]}, spectra['MsLevel'].isin([1, 2])),
+                   ({'polarity': '-'}, spectra['Polarity'] == 1),
+                   ({'scan_mode': 2}, spectra['ScanMode'] == 2),
+                   ({'precursor_mz_range': (300, 700)}, spectra['Mass'].between(300, 700)),
+                   ({'rt_range': (0.0, 0.1), 'precursor_mz_range': (200, 900), 'polarity': '-'},
+                    spectra['RtMinutes'].between(0.0, 0.1) & spectra['Mass'].between(200, 900) &
+                    (spectra['Polarity'] == 1)),
+                   ({'rt_range': (1.0, 2.0)}, np.zeros(len(spectra), dtype=bool))]
+        for kwargs, mask in filters:
+            np.testing.assert_array_equal(baf_data.select(**kwargs), np.sort(spectra['Id'].values[np.asarray(mask)]))
+        assert 0 < baf_data.select(precursor_mz_range=(300, 700)).size < NUM_SPECTRA
+
+    with sqlite3.connect(os.path.join(dataset, 'analysis.sqlite')) as conn:
+        conn.execute('DELETE FROM Spectra')
+        conn.execute('DELETE FROM Steps')
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        assert baf_data.select(rt_range=(0.0, 1.0), precursor_mz_range=(300, 700)).size == 0
+        with pytest.raises(KeyError):
+            baf_data.get_spectra_rows([1])
+
+
+def test_imaging(dataset):
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        assert find_coordinates(baf_data.analysis) is None
+    # Acquire the spectra as a 6 x 4 raster with spot names, row by row.
+    frames = np.arange(1, NUM_SPECTRA + 1)
+    x = (frames - 1) % 6
+    y = (frames - 1) // 6
+    with sqlite3.connect(os.path.join(dataset, 'analysis.sqlite')) as conn:
+        conn.execute('CREATE TABLE Spots (Spectrum INTEGER, SpotName TEXT)')
+        conn.executemany('INSERT INTO Spots VALUES (?, ?)',
+                         [(int(i), 'R00X{:03d}Y{:03d}'.format(j, k)) for i, j, k in zip(frames, x, y)])
+
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        for known, found in zip((frames, x, y), find_coordinates(baf_data.analysis)):
+            np.testing.assert_array_equal(found, known)
+        assert BafSpectrum(baf_data, 7, 'centroid').coord == (0, 1)
+
+        mz_windows = np.array([[200.0, 400.0], [500.0, 900.0]])
+        known_xic = np.zeros((NUM_SPECTRA, 2))
+        for frame in frames:
+            mz_array, intensity_array = get_known_arrays(dataset, frame)['centroid']
+            for window, (lower, upper) in enumerate(mz_windows):
+                known_xic[frame - 1, window] = intensity_array[(mz_array >= lower) & (mz_array <= upper)].sum()
+        retention_time, xic = baf_data.get_xic(mz_windows)
+        np.testing.assert_allclose(retention_time, frames * 0.5 / 60)
+        np.testing.assert_allclose(xic, known_xic)
+
+        images = baf_data.get_ion_images(mz_windows)
+        assert images.shape == (2, 4, 6)
+        np.testing.assert_allclose(images[:, y, x], known_xic.T)
+
+        bin_edges = baf_data.get_run_bin_edges(50)
+        cube = baf_data.get_ion_cube(bin_edges)
+        known_matrix = bin_profile_spectra([get_known_arrays(dataset, frame)['profile'][0] for frame in frames],
+                                           [get_known_arrays(dataset, frame)['profile'][1] for frame in frames],
+                                           bin_edges)
+        for pixel in range(NUM_SPECTRA):
+            np.testing.assert_allclose(cube.get_pixel_spectrum(pixel), known_matrix[pixel])
+        np.testing.assert_allclose(cube.get_image(0, 50)[y, x], known_matrix.sum(axis=1))
+
+        # Spectra acquired at the same position are summed into one pixel.
+        baf_data.set_coordinates([1, 2, 3], [0, 0, 1], [0, 0, 0])
+        images = baf_data.get_ion_images(mz_windows)
+        np.testing.assert_allclose(images[:, 0, 0], known_xic[0] + known_xic[1])
+        np.testing.assert_allclose(images[:, 0, 1], known_xic[2])
+
+
+def test_precursor_table(dataset):
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        precursors = baf_data.get_precursor_table()
+        np.testing.assert_array_equal(precursors['frame'].values, baf_data.select(scan_mode=2))
+        np.testing.assert_array_equal(precursors['target_mz'].values,
+                                      [baf_data.get_variable(frame, 7) for frame in precursors['frame']])
+    with sqlite3.connect(os.path.join(dataset, 'analysis.sqlite')) as conn:
+        conn.execute('UPDATE Spectra SET AcquisitionKey = 3 WHERE Id = 2')
+    with BafData(dataset, SyntheticBaf2Sql()) as baf_data:
+        with pytest.raises(KeyError):
+            baf_data.get_precursor_table()
+
+
+def test_iter_spectra_records_own_arrays(dataset, baf_data):
+    for mode in ('centroid', 'profile'):
+        spectra = list(baf_data.iter_spectra(mode=mode))
+        assert [i.frame for i in spectra] == list(range(1, NUM_SPECTRA + 1))
+        for spectrum in spectra:
+            np.testing.assert_array_equal(spectrum.intensity_array,
+                                          get_known_arrays(dataset, spectrum.frame)[mode][1])
+
+
+def test_metadata_cache_invalidation(dataset):
+    baf2sql = SyntheticBaf2Sql()
+    assert not is_metadata_cache_valid(dataset, True)
+    with BafData(dataset, baf2sql, metadata_cache=True) as baf_data:
+        spectra = baf_data.analysis['Spectra']
+    assert is_metadata_cache_valid(dataset, True)
+    assert not is_metadata_cache_valid(dataset, False)
+    tables = load_metadata_cache(dataset, True)
+    np.testing.assert_array_equal(tables['Spectra']['Id'].values, spectra['Id'].values)
+    assert tables['Properties']['InstrumentName'] == 'synthetic'
+
+    stat = os.stat(os.path.join(dataset, 'analysis.sqlite'))
+    os.utime(os.path.join(dataset, 'analysis.sqlite'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not is_metadata_cache_valid(dataset, True)
+    assert load_metadata_cache(dataset, True) is None
+    with BafData(dataset, baf2sql, metadata_cache=True):
+        pass
+    assert is_metadata_cache_valid(dataset, True)
+
+
+def test_metadata_cache_fallbacks(dataset, tmp_path):
+    tables = {'Spectra': pd.DataFrame({'Id': [1, 2, 3], 'Value': [1, 'a', None]}), 'Properties': {'Key': 'value'}}
+    save_metadata_cache(tables, dataset, True, str(tmp_path / 'cache'))
+    assert load_metadata_cache(dataset, True, str(tmp_path / 'cache'))['Spectra']['Value'].tolist() == [1, 'a', None]
+
+    # A dataset whose cache cannot be written is opened without the cache.
+    with BafData(dataset, SyntheticBaf2Sql(), metadata_cache=True, metadata_cache_dir=os.devnull) as baf_data:
+        assert len(baf_data.analysis['Spectra']) == NUM_SPECTRA
+
+
+def test_handle_pool_lru_and_leases(tmp_path):
+    baf2sql = SyntheticBaf2Sql()
+    first = make_synthetic_dataset(str(tmp_path / 'first.d'), num_spectra=4, profile_points=10, centroid_points=4)
+    second = make_synthetic_dataset(str(tmp_path / 'second.d'), num_spectra=4, profile_points=10, centroid_points=4)
+    pool = HandlePool(max_handles=1)
+
+    a = BafData(first, baf2sql, handle_pool=pool)
+    b = BafData(first, baf2sql, handle_pool=pool)
+    assert a.handle == b.handle
+    assert a.analysis is b.analysis
+    assert pool.get_stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'handles': 1, 'leased': 1, 'max_handles': 1}
+
+    # The leased handle of the first dataset cannot be evicted, so the pool holds two handles until it is released.
+    c = BafData(second, baf2sql, handle_pool=pool)
+    assert pool.get_stats()['handles'] == 2
+    a.close()
+    assert pool.get_stats()['evictions'] == 0
+    b.close()
+    assert pool.get_stats()['evictions'] == 1
+    assert pool.get_stats()['handles'] == 1
+    assert len(baf2sql.storages) == 1
+
+    c.close()
+    assert pool.get_stats()['leased'] == 0
+    pool.clear()
+    assert len(baf2sql.storages) == 0
+
+
+def test_spectrum_store_round_trip(dataset, baf_data, tmp_path):
+    store_path = materialize_spectra(baf_data, mode='centroid', store_dir=str(tmp_path / 'stores'))
+    store = SpectrumStore(store_path)
+    assert len(store) == NUM_SPECTRA
+    assert store.is_valid()
+    for frame in range(1, NUM_SPECTRA + 1):
+        mz_array, intensity_array = store.extract_baf_spectrum(frame, 'centroid')
+        known_mz_array, known_intensity_array = get_known_arrays(dataset, frame)['centroid']
+        np.testing.assert_array_equal(mz_array, known_mz_array)
+        np.testing.assert_array_equal(intensity_array, known_intensity_array)
+    assert materialize_spectra(baf_data, mode='centroid', store_dir=str(tmp_path / 'stores')) == store_path
+    with pytest.raises(ValueError):
+        store.extract_baf_spectrum(1, 'profile')
+
+
+def test_write_mzml_index_and_checksum(baf_data, tmp_path):
+    file_name = str(tmp_path / 'run.mzML')
+    assert write_mzml(baf_data, file_name, mode='centroid', chunk_size=7, encode_batch_size=3, num_threads=2) == \
+        NUM_SPECTRA
+    with open(file_name, 'rb') as mzml_file:
+        content = mzml_file.read()
+
+    offsets = re.findall(rb'<offset idRef="scan=(\d+)">(\d+)</offset>', content)
+    assert [int(frame) for frame, _ in offsets] == list(range(1, NUM_SPECTRA + 1))
+    for frame, offset in offsets:
+        assert content[int(offset):].startswith(b'<spectrum ')
+        assert b'id="scan=' + frame + b'"' in content[int(offset):int(offset) + 200]
+    index_offset = int(re.search(rb'<indexListOffset>(\d+)</indexListOffset>', content).group(1))
+    assert content[index_offset:].startswith(b'<indexList ')
+
+    checksum_end = content.index(b'<fileChecksum>') + len(b'<fileChecksum>')
+    checksum = re.search(rb'<fileChecksum>([0-9a-f]+)</fileChecksum>', content).group(1).decode('utf-8')
+    assert checksum == hashlib.sha1(content[:checksum_end]).hexdigest()
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='requires the fork start method')
+def test_convert_runs_resume_and_failure_isolation(tmp_path, monkeypatch):
+    input_dir = tmp_path / 'input'
+    for name in ('run1.d', 'run2.d', 'crash.d'):
+        make_synthetic_dataset(str(input_dir / name), num_spectra=8, profile_points=10, centroid_points=4)
+    os.makedirs(str(input_dir / 'bad.d'))
+    # Worker processes are forked, so they inherit the synthetic library.
+    monkeypatch.setattr(pyBaf2Sql.batch, 'init_baf2sql_api', lambda bruker_api_file_name: CrashingBaf2Sql())
+    output_dir = str(tmp_path / 'output')
+    context = multiprocessing.get_context('fork')
+
+    results = pyBaf2Sql.batch.convert_runs(str(input_dir), output_dir=output_dir, export_format='mzml', num_workers=2,
+                                           mp_context=context)
+    statuses = {os.path.basename(i['source_file']): (i['status'], i['attempts']) for i in results}
+    # Runs in flight when the crash.d worker died are retried, so they may take a second attempt.
+    assert statuses['run1.d'][0] == 'done'
+    assert statuses['run2.d'][0] == 'done'
+    assert statuses['bad.d'][0] == 'failed'
+    assert statuses['crash.d'] == ('failed', 2)
+    assert sorted(os.listdir(output_dir)) == [pyBaf2Sql.batch.BATCH_STATE_FILE_NAME, 'run1.mzML', 'run2.mzML']
+
+    results = pyBaf2Sql.batch.convert_runs(str(input_dir), output_dir=output_dir, export_format='mzml', num_workers=2,
+                                           mp_context=context)
+    statuses = {os.path.basename(i['source_file']): i['status'] for i in results}
+    assert statuses['run1.d'] == 'skipped'
+    assert statuses['run2.d'] == 'skipped'